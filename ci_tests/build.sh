@@ -11,10 +11,33 @@ PID=$$
 TEST_DIR=$( pwd )                   # Directory with this script
 TOP_DIR=${TEST_DIR}/..              # Top level directory
 
+#-----------------------------------------------------------------------
+# Build options, set by the CI driver (jobs/build.py)
+#   CI_BUILD_DIR : build directory, one per compiler so builds with
+#                  different compilers can share the tree
+#   BUILD_JOBS : number of parallel make jobs
+#   CCACHE_DIR : compiler cache shared between builds, unset to disable
+#   CI_CHANGED_FILES : file listing the files changed since the last
+#                      build in this tree, unset for a fresh clone
+#-----------------------------------------------------------------------
+BUILD_DIR=${CI_BUILD_DIR:-${TOP_DIR}/build}
+BUILD_JOBS=${BUILD_JOBS:-4}
+CMAKE_OPTS=""
+if [[ -n "${CCACHE_DIR:-}" ]] && command -v ccache >/dev/null 2>&1; then
+  CMAKE_OPTS="-DCMAKE_C_COMPILER_LAUNCHER=ccache -DCMAKE_CXX_COMPILER_LAUNCHER=ccache"
+fi
+
 #-----------------------------------------------------------------------
 # Build GeoFLOW
 #-----------------------------------------------------------------------
-mkdir ${TOP_DIR}/build && cd ${TOP_DIR}/build
+mkdir -p ${BUILD_DIR} && cd ${BUILD_DIR} || exit 1
+# The build directory is kept between commits of a PR and rebuilt
+# incrementally; configure from scratch if the build system changed
+if [[ -n "${CI_CHANGED_FILES:-}" ]] && \
+   grep -qE '(^|/)(CMakeLists\.txt|[^/]*\.cmake)$' "${CI_CHANGED_FILES}"; then
+  echo "Build system changed, reconfiguring"
+  rm -f CMakeCache.txt
+fi
 # cmake -DGDIM=2 ..
-cmake ..
-make -j4 install
+cmake ${CMAKE_OPTS} ${TOP_DIR}
+make -j${BUILD_JOBS} install
@@ -3,17 +3,61 @@
 ## Usage:
 ##
 ##   bash integration_tests.sh <RUN_DIR> <EXEC_NAME> <INPUT_JSON> 
+##   bash integration_tests.sh --array <EXPTS_DIR> <EXEC_NAME> <TEST_LIST>
 ##
 ##   Arguments: 
 ##       RUN_DIR    : This is the directory to run the integration test in.
 ##       EXEC_NAME  : Path the the geoflow_cdg executable to run.  
 ##       INPUT_JSON : Path to the input.jsn configuration file.
+##       EXPTS_DIR  : Directory holding one run directory per test.
+##       TEST_LIST  : File with one test per line: <NAME> <INPUT_JSON>.
+##                    All tests are submitted as one Slurm job array. Task
+##                    N runs the test on line N+1 in <EXPTS_DIR>/<NAME> and
+##                    writes its output to <EXPTS_DIR>/<NAME>/slurm.out,
+##                    through the link <EXPTS_DIR>_by_index/N, so that
+##                    Slurm's own messages (time limit, cancellation)
+##                    land in the same file.
 ##
+##   Environment:
+##       CI_NTASKS   : MPI ranks to run with (default 5).
+##       CI_NTHREADS : OpenMP threads per rank (default 40 / CI_NTASKS).
+##
+
+if [ "$1" == "--array" ]; then
+  NUM_TESTS=$(grep -c . "$4")
+  # --output can only name a task by its index, the links lead from
+  # the index to the test's run directory
+  INDEX_DIR="$2_by_index"
+  rm -rf "${INDEX_DIR}" && mkdir -p "${INDEX_DIR}" || exit 1
+  INDEX=0
+  while read -r NAME _; do
+    ln -s "$2/${NAME}" "${INDEX_DIR}/${INDEX}"
+    INDEX=$((INDEX + 1))
+  done < "$4"
+  SBATCH_ARGS="--array=0-$((NUM_TESTS - 1))"
+  SBATCH_ARGS="${SBATCH_ARGS} --output=${INDEX_DIR}/%a/slurm.out"
+  SBATCH_ARGS="${SBATCH_ARGS} --error=${INDEX_DIR}/%a/slurm.out"
+  # Expanded inside the job, for its own array task
+  TEST_CONFIG="TEST_LINE=\$(sed -n \"\$((SLURM_ARRAY_TASK_ID + 1))p\" \"$4\")
+export RUN_DIR=\"$2/\${TEST_LINE%% *}\"
+export EXEC_NAME=\"$3\"
+export INPUT_JSON=\"\${TEST_LINE#* }\""
+else
+  SBATCH_ARGS="--output=$1/slurm.out --error=$1/slurm.out"
+  TEST_CONFIG="export RUN_DIR=\"$1\"
+export EXEC_NAME=\"$2\"
+export INPUT_JSON=\"$3\""
+fi
+
+# Ranks and threads, e.g. of the runs of a scaling sweep
+NTASKS=${CI_NTASKS:-5}
+NTHREADS=${CI_NTHREADS:-$(( (40 + NTASKS - 1) / NTASKS ))}
+if [ -n "${CI_NTASKS}" ]; then
+  SBATCH_ARGS="${SBATCH_ARGS} --ntasks=${NTASKS} --cpus-per-task=${NTHREADS}"
+fi
 
-sbatch <<EOT
+sbatch ${SBATCH_ARGS} <<EOT
 #!/bin/bash
-#SBATCH --output=slurm.out
-#SBATCH --error=slurm.out
 #SBATCH -A gsd-hpcs
 #SBATCH --exclusive
 #SBATCH -q batch   
@@ -31,11 +75,9 @@ sbatch <<EOT
 #
 # Configuration
 #
-export RUN_DIR="$1"
-export EXEC_NAME="$2"
-export INPUT_JSON="$3"
+${TEST_CONFIG}
 export SLURM_JOB_NAME=testinertgrav2d
-export SLURM_NTASKS=5
+export SLURM_NTASKS=${NTASKS}
 export SLURM_NTASKS_PER_NODE=5
 export SLURM_TIMELIMIT=08:00:00
 ## Modules Needed
@@ -49,26 +91,26 @@ module load gptl
 # Set Number of OpenMP threads per Node
 #
 export CORES_PER_NODE=40
-export OMP_NUM_THREADS=${CORES_PER_NODE}/${SLURM_NTASKS_PER_NODE}
+export OMP_NUM_THREADS=${NTHREADS}
 #
 # Print configuration 
 #
-echo "OMP_NUM_THREADS=" ${OMP_NUM_THREADS}
-echo "SLURM_NTASKS=" ${SLURM_NTASKS}
-echo "RUN_DIR=" ${RUN_DIR}
-echo "EXEC_NAME=" ${EXEC_NAME}
-echo "INPUT_JSON=" ${INPUT_JSON}
-echo "SLURM_NTASKS_PER_NODE=" ${SLURM_NTASKS_PER_NODE}
+echo "OMP_NUM_THREADS=" \${OMP_NUM_THREADS}
+echo "SLURM_NTASKS=" \${SLURM_NTASKS}
+echo "RUN_DIR=" \${RUN_DIR}
+echo "EXEC_NAME=" \${EXEC_NAME}
+echo "INPUT_JSON=" \${INPUT_JSON}
+echo "SLURM_NTASKS_PER_NODE=" \${SLURM_NTASKS_PER_NODE}
 #
 # Create output directory
 #
-cd ${RUN_DIR}
+cd "\${RUN_DIR}"
 rm -rf outs/
 mkdir outs
 #
 # Run Commands
 #
-cd ${RUN_DIR}
-srun -n ${SLURM_NTASKS} ${EXEC_NAME} -i ${INPUT_JSON} 
+cd "\${RUN_DIR}"
+srun -n \${SLURM_NTASKS} "\${EXEC_NAME}" -i "\${INPUT_JSON}"
  
 EOT
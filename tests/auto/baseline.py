@@ -0,0 +1,176 @@
+"""
+Name: baseline.py
+Compares the GIO output files of an integration test run with the
+baseline outputs of the test in ci_tests/test_baselines/<test>/.
+Files are memory-mapped and compared in chunks, so large outputs are
+never loaded whole. A value matches if
+|run - baseline| <= atol + rtol * |baseline|, as in numpy.isclose.
+Needs NumPy; without it the comparison is skipped.
+"""
+
+# Imports
+import collections
+import glob
+import logging
+import os
+import struct
+from configparser import ConfigParser as config_parser
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Values compared at a time, 32 MB of doubles per file
+CHUNK_VALUES = 4 * 1024 * 1024
+
+FieldDiff = collections.namedtuple(
+    'FieldDiff', ['field', 'files', 'max_abs', 'max_rel', 'bad_values',
+                  'note'])
+
+
+def baseline_dir(run_dir):
+    ''' Baseline directory of the test run in
+        ci_tests/integration_tests/expt_dirs/<test> '''
+    ci_tests_loc = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(run_dir))))
+    return os.path.join(ci_tests_loc, 'test_baselines',
+                        os.path.basename(os.path.abspath(run_dir)))
+
+
+def gio_header_bytes(path):
+    ''' Size of the header of a GIO file (version 0, one variable):
+        ivers, dim (int32), nelems (uint64), porder (dim int32),
+        gtype (int32), cycle (uint64), time (double) '''
+    with open(path, 'rb') as fname:
+        ivers, dim = struct.unpack('<ii', fname.read(8))
+    header = 4 + 4 + 8 + 4 * dim + 4 + 8 + 8
+    data = os.path.getsize(path) - header
+    if ivers != 0 or dim not in [1, 2, 3] or data < 0 or data % 8:
+        raise ValueError(f'{path} is not a GIO file')
+    return header
+
+
+class BaselineComparator:
+    '''
+    This class compares the outputs of test runs with their baselines
+    ...
+
+    Attributes
+    ----------
+    atol : float
+        Absolute tolerance
+    rtol : float
+        Relative tolerance
+    pattern : str
+        Glob of the output files in the run's outs/ directory
+    '''
+
+    def __init__(self, atol=1e-12, rtol=1e-8, pattern='*.out'):
+        self.logger = logging.getLogger('BASELINE')
+        self.atol = atol
+        self.rtol = rtol
+        self.pattern = pattern
+
+    @classmethod
+    def from_config(cls, file_name='CImachine.cfg'):
+        ''' Build the comparator from the optional baseline_* entries
+            of the machine config file '''
+        config = config_parser()
+        config.read(file_name)
+        return cls(config['DEFAULT'].getfloat('baseline_atol',
+                                              fallback=1e-12),
+                   config['DEFAULT'].getfloat('baseline_rtol',
+                                              fallback=1e-8))
+
+    def compare_file(self, run_file, base_file):
+        ''' Return (max abs error, max rel error, values out of
+            tolerance) of one output file '''
+        run_data = np.memmap(run_file, dtype='<f8', mode='r',
+                             offset=gio_header_bytes(run_file))
+        base_data = np.memmap(base_file, dtype='<f8', mode='r',
+                              offset=gio_header_bytes(base_file))
+        if run_data.size != base_data.size:
+            raise ValueError(f'{run_data.size} values, baseline has '
+                             f'{base_data.size}')
+        max_abs = 0.0
+        max_rel = 0.0
+        bad_values = 0
+        for start in range(0, base_data.size, CHUNK_VALUES):
+            run_chunk = run_data[start:start + CHUNK_VALUES]
+            base_chunk = base_data[start:start + CHUNK_VALUES]
+            abs_err = np.abs(run_chunk - base_chunk)
+            # NaN where the baseline has none counts as infinitely wrong
+            abs_err[np.isnan(abs_err) &
+                    ~(np.isnan(run_chunk) & np.isnan(base_chunk))] = np.inf
+            abs_err[np.isnan(abs_err)] = 0.0
+            scale = np.abs(base_chunk)
+            rel_err = np.divide(abs_err, scale, out=np.zeros_like(abs_err),
+                                where=scale > 0)
+            max_abs = max(max_abs, float(abs_err.max(initial=0.0)))
+            max_rel = max(max_rel, float(rel_err.max(initial=0.0)))
+            bad_values += int(np.count_nonzero(
+                abs_err > self.atol + self.rtol * scale))
+        return max_abs, max_rel, bad_values
+
+    def compare_run(self, run_dir):
+        ''' Compare the outs/ of a test run with its baseline. Returns
+            a FieldDiff per field (the file name up to the first dot,
+            over all output times), or None without a baseline. '''
+        if np is None:
+            self.logger.info('NumPy not available, skipping comparison')
+            return None
+        base_dir = baseline_dir(run_dir)
+        base_files = sorted(glob.glob(os.path.join(base_dir, self.pattern)))
+        if not base_files:
+            self.logger.info(f'No baseline in {base_dir}')
+            return None
+        fields = collections.OrderedDict()
+        for base_file in base_files:
+            name = os.path.basename(base_file)
+            field = name.split('.')[0]
+            files, max_abs, max_rel, bad_values, note = \
+                fields.get(field, (0, 0.0, 0.0, 0, ''))
+            run_file = os.path.join(run_dir, 'outs', name)
+            try:
+                file_abs, file_rel, file_bad = \
+                    self.compare_file(run_file, base_file)
+                max_abs = max(max_abs, file_abs)
+                max_rel = max(max_rel, file_rel)
+                bad_values += file_bad
+            except (OSError, ValueError, struct.error) as e:
+                self.logger.info(f'{name}: {e}')
+                note = f'{name}: {getattr(e, "strerror", None) or e}'
+            fields[field] = (files + 1, max_abs, max_rel, bad_values, note)
+        return [FieldDiff(field, *values) for field, values in fields.items()]
+
+    def check(self, run_dir):
+        ''' (passed, comment text) of a finished test run; passed is
+            None when there is nothing to compare with '''
+        field_diffs = self.compare_run(run_dir)
+        if field_diffs is None:
+            return None, ''
+        return self.passed(field_diffs), self.table(field_diffs)
+
+    @staticmethod
+    def passed(field_diffs):
+        return all(not diff.bad_values and not diff.note
+                   for diff in field_diffs)
+
+    def table(self, field_diffs):
+        ''' Per-field markdown table for the PR comment '''
+        lines = [f'Baseline comparison (atol {self.atol:g}, '
+                 f'rtol {self.rtol:g}):',
+                 '| field | files | max abs err | max rel err | result |',
+                 '|---|---|---|---|---|']
+        for diff in field_diffs:
+            if diff.note:
+                result = diff.note
+            elif diff.bad_values:
+                result = f'{diff.bad_values} values differ'
+            else:
+                result = 'ok'
+            lines.append(f'| {diff.field} | {diff.files} | '
+                         f'{diff.max_abs:.3g} | {diff.max_rel:.3g} | '
+                         f'{result} |')
+        return '\n'.join(lines)
@@ -0,0 +1,430 @@
+"""
+Name: bench.py
+Offline benchmark of ci_auto.py and ci_long.py, to see how they scale
+with the number of repos, open PRs, labels and tracked experiments before
+a change is deployed. For each number of open PRs in --sizes:
+- fake_github.py serves that many PRs, spread over --repos repos. Each
+  has a ci-bench-gnu-build label and every --int-every-th one also a
+  ci-bench-intel-int label
+- --polls polls of the PR list are timed in a separate process, with
+  GraphQL and with REST: latency, API requests per poll and the peak size
+  of the Python heap
+- ci_auto.py runs once, with git and Slurm replaced by fake_tools.py,
+  for its wall time, peak RSS, API requests and jobs finished per minute.
+  Integration tests run --expt-seconds of fake Slurm time, so those still
+  running after the 12 s an int job waits for them are left to ci_long
+- once every fake Slurm job has ended, ci_long.py runs on the
+  experiments left, for the same numbers
+Everything runs in a scratch directory per size. The results are printed
+and, with --output, saved as JSON; --compare lists the numbers that got
+worse than in an earlier saved run by more than --tolerance and exits
+with status 1 if there are any.
+    python bench.py --sizes 1,10,100,500 --output bench.json
+"""
+
+# Imports
+import argparse
+import copy
+import datetime
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fake_tools
+from fake_github import FakeGitHub, load_deliveries
+from statestore import StateStore
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+MACHINE = 'bench'
+
+TEMPLATE_DELIVERY = os.path.join(HERE, 'webhook_payloads',
+                                 '01_labeled.json')
+
+# Numbers compared by --compare, with the unit they are printed in.
+# Request counts are compared exactly, times and memory within the
+# tolerance
+COMPARED = {'poll_graphql_seconds': ('s', False),
+            'poll_graphql_requests': ('', True),
+            'poll_graphql_heap_mb': ('MB', False),
+            'poll_rest_seconds': ('s', False),
+            'poll_rest_requests': ('', True),
+            'poll_rest_heap_mb': ('MB', False),
+            'ci_auto_seconds': ('s', False),
+            'ci_auto_rss_mb': ('MB', False),
+            'ci_auto_requests': ('', True),
+            'ci_long_seconds': ('s', False),
+            'ci_long_rss_mb': ('MB', False),
+            'ci_long_requests': ('', True)}
+
+
+def pr_delivery(template, owner, number, labels):
+    ''' A labeled delivery of PR number of owner/GeoFLOW, made from a
+        recorded one '''
+    delivery = copy.deepcopy(template)
+    text = json.dumps(delivery).replace('robgonzalezpita', owner)
+    for kind in ['pulls', 'issues', 'pull']:
+        text = text.replace(f'/{kind}/42"', f'/{kind}/{number}"')
+    delivery = json.loads(text)
+    delivery['delivery'] = f'bench-{owner}-{number}'
+    payload = delivery['payload']
+    pull = payload['pull_request']
+    payload['number'] = pull['number'] = number
+    pull['id'] = 500000000 + number
+    pull['head']['ref'] = f'feature/bench-{number}'
+    pull['head']['sha'] = fake_tools.branch_sha(f'{owner}/{number}')
+    pull['labels'] = [dict(payload['label'], name=name,
+                           id=payload['label']['id'] + index)
+                      for index, name in enumerate(labels)]
+    payload['label'] = pull['labels'][0]
+    return delivery
+
+
+def make_prs(size, repos, int_every):
+    ''' Deliveries of size PRs spread over the repos, and the number of
+        labels on them '''
+    template = load_deliveries(TEMPLATE_DELIVERY)[0]
+    deliveries = []
+    labels_total = 0
+    for index in range(size):
+        labels = [f'ci-{MACHINE}-gnu-build']
+        if int_every and index % int_every == int_every - 1:
+            labels.append(f'ci-{MACHINE}-intel-int')
+        labels_total += len(labels)
+        deliveries.append(pr_delivery(template, f'bench{index % repos}',
+                                      index + 1, labels))
+    return deliveries, labels_total
+
+
+def setup_scratch(scratch, base_url, repos, args):
+    ''' Config files, fake tools and the tree the fake git clones.
+        Returns the environment to run the CI with. '''
+    workdir = os.path.join(scratch, 'workdir')
+    os.makedirs(workdir)
+    with open(os.path.join(scratch, 'CImachine.cfg'), 'w') as fname:
+        fname.write(f'[DEFAULT]\n'
+                    f'machine={MACHINE}\n'
+                    f'hpc_acc={MACHINE}\n'
+                    f'workdir={workdir}\n'
+                    f'max_jobs={args.max_jobs}\n'
+                    f'max_jobs_per_compiler={args.max_jobs}\n'
+                    f'label_poll=3600\n'
+                    f'gh_base_url={base_url}\n'
+                    f'gh_write_interval={args.write_interval}\n'
+                    f'ccache_dir=\n'
+                    f'build_jobs=1\n'
+                    f'state_db=ci_state.db\n'
+                    f'metrics_dir=metrics\n')
+    with open(os.path.join(scratch, 'CIrepos.cfg'), 'w') as fname:
+        for repo in range(repos):
+            fname.write(f'[bench{repo}/GeoFLOW/feature/dcmip0]\n'
+                        f'base_name = bench{repo}\n'
+                        f'base_address = bench{repo}/GeoFLOW\n'
+                        f'base_branch = feature/dcmip0\n\n')
+    token = os.path.join(scratch, 'accesstoken')
+    with open(token, 'w') as fname:
+        fname.write('bench\n')
+    os.chmod(token, 0o600)
+
+    template = os.path.join(scratch, 'template')
+    shutil.copytree(os.path.join(HERE, 'bench_tree'), template)
+    tests_dir = os.path.join(template, 'ci_tests', 'tests')
+    os.makedirs(tests_dir)
+    for test in range(args.tests):
+        with open(os.path.join(tests_dir, f'test_{test}.jsn'), 'w') \
+                as fname:
+            fname.write('{}\n')
+    env = fake_tools.install(os.path.join(scratch, 'bin'),
+                             os.path.join(scratch, 'fake_tools'),
+                             template, args.expt_seconds,
+                             args.fail_every)
+    env['FAKE_BUILD_SECONDS'] = str(args.build_seconds)
+    return env
+
+
+def measure_poll(scratch, env, use_graphql, polls, results):
+    ''' Time polls of the PR list, run in its own process '''
+    os.chdir(scratch)
+    os.environ.update(env)
+    logging.basicConfig(filename='poll.log', filemode='a',
+                        level=logging.INFO)
+    from ci_auto import get_preqs_with_actions, setup_env
+    from ghclient import GHInterface
+    machine_dict, repos, actions = setup_env()
+    machine_dict['use_graphql'] = use_graphql
+    ghinterface_obj = GHInterface()
+    seconds = []
+    requests = []
+    for _ in range(polls):
+        start = time.time()
+        get_preqs_with_actions(repos, machine_dict, ghinterface_obj,
+                               actions)
+        seconds.append(time.time() - start)
+        requests.append(ghinterface_obj.limiter.log_stats()['requests'])
+    # Traced separately, tracing slows the polls down
+    tracemalloc.start()
+    jobs = get_preqs_with_actions(repos, machine_dict, ghinterface_obj,
+                                  actions)
+    heap = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results.put({'seconds': statistics.median(seconds),
+                 'requests': statistics.median(requests),
+                 'heap_mb': heap / 1024 ** 2, 'jobs': len(jobs)})
+
+
+def run_poll(scratch, env, use_graphql, polls):
+    # spawn: a fresh interpreter, not a fork of the threads serving the
+    # fake API
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=measure_poll,
+                              args=(scratch, env, use_graphql, polls,
+                                    results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f'Poll benchmark exited with {process.exitcode},'
+                           f' see {scratch}/poll.log')
+    return results.get(timeout=60)
+
+
+def run_script(script, scratch, env, timeout):
+    ''' Run a CI script in the scratch directory. Returns its wall time
+        in seconds, peak RSS in MB and exit status. '''
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, script)], cwd=scratch, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    deadline = start + timeout
+    while True:
+        # wait4 returns the peak RSS of the finished process
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if time.time() > deadline:
+            process.kill()
+            pid, status, usage = os.wait4(process.pid, 0)
+            break
+        time.sleep(0.1)
+    process.returncode = os.WEXITSTATUS(status) \
+        if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return time.time() - start, usage.ru_maxrss / 1024, process.returncode
+
+
+def span_events(scratch, process):
+    ''' The span events a CI script wrote, by span name '''
+    spans = {}
+    for path in glob.glob(os.path.join(scratch, 'metrics',
+                                       'events_*.ndjson')):
+        with open(path) as fname:
+            for line in fname:
+                record = json.loads(line)
+                if record['event'] == 'span' and \
+                        record['process'] == process:
+                    spans.setdefault(record['span'], []).append(record)
+    return spans
+
+
+def median_seconds(records):
+    return statistics.median(record['seconds'] for record in records) \
+        if records else 0.0
+
+
+def wait_for_slurm(scratch):
+    ''' Sleep until every fake Slurm job has ended '''
+    ends = [job['submitted'] + job['seconds'] for job in
+            fake_tools.jobs(os.path.join(scratch, 'fake_tools'))]
+    if ends:
+        time.sleep(max(max(ends) + 1 - time.time(), 0))
+
+
+def bench_size(size, args, logger):
+    ''' Results of one number of open PRs '''
+    scratch = tempfile.mkdtemp(prefix=f'bench_{size}_', dir=args.scratch)
+    deliveries, labels = make_prs(size, args.repos, args.int_every)
+    fake = FakeGitHub()
+    fake.start()
+    fake.load(deliveries)
+    result = {'prs': size, 'repos': args.repos, 'labels': labels,
+              'scratch': scratch}
+    try:
+        env = setup_scratch(scratch, fake.base_url, args.repos, args)
+        for name, use_graphql in [('graphql', True), ('rest', False)]:
+            poll = run_poll(scratch, env, use_graphql, args.polls)
+            logger.info(f'{size} PRs, {name} poll: {poll}')
+            for key, value in poll.items():
+                result[f'poll_{name}_{key}'] = value
+
+        served = fake.requests_served
+        seconds, rss_mb, status = run_script('ci_auto.py', scratch, env,
+                                             args.timeout)
+        spans = span_events(scratch, 'ci_auto')
+        jobs = spans.get('job', [])
+        result.update({
+            'ci_auto_status': status,
+            'ci_auto_seconds': seconds,
+            'ci_auto_rss_mb': rss_mb,
+            'ci_auto_requests': fake.requests_served - served,
+            'jobs': len(jobs),
+            'jobs_failed': sum(record['outcome'] != 'ok'
+                               for record in jobs),
+            'jobs_per_minute': 60 * len(jobs) / seconds,
+            'queue_wait_median_seconds':
+                median_seconds(spans.get('queue_wait', [])),
+            'job_median_seconds': median_seconds(jobs),
+            'checkout_median_seconds':
+                median_seconds(spans.get('checkout', [])),
+            'build_median_seconds': median_seconds(spans.get('build', []))})
+
+        store = StateStore(os.path.join(scratch, 'ci_state.db'))
+        tracked = len(store.experiments('running'))
+        wait_for_slurm(scratch)
+        served = fake.requests_served
+        seconds, rss_mb, status = run_script('ci_long.py', scratch, env,
+                                             args.timeout)
+        result.update({
+            'experiments': tracked,
+            'experiments_left': len(store.experiments('running')),
+            'ci_long_status': status,
+            'ci_long_seconds': seconds,
+            'ci_long_rss_mb': rss_mb,
+            'ci_long_requests': fake.requests_served - served})
+    finally:
+        fake.stop()
+        if not args.keep:
+            shutil.rmtree(scratch, ignore_errors=True)
+    logger.info(f'{size} PRs: {result}')
+    return result
+
+
+def report(results):
+    ''' Table of the results, one row per number of PRs '''
+    columns = [('prs', 'PRs', '{:d}'), ('labels', 'labels', '{:d}'),
+               ('poll_graphql_seconds', 'poll GQL s', '{:.3f}'),
+               ('poll_graphql_requests', 'req/poll GQL', '{:.0f}'),
+               ('poll_rest_seconds', 'poll REST s', '{:.3f}'),
+               ('poll_rest_requests', 'req/poll REST', '{:.0f}'),
+               ('poll_graphql_heap_mb', 'poll heap MB', '{:.1f}'),
+               ('ci_auto_seconds', 'ci_auto s', '{:.1f}'),
+               ('ci_auto_rss_mb', 'ci_auto MB', '{:.0f}'),
+               ('ci_auto_requests', 'ci_auto req', '{:d}'),
+               ('jobs', 'jobs', '{:d}'),
+               ('jobs_per_minute', 'jobs/min', '{:.1f}'),
+               ('experiments', 'expts', '{:d}'),
+               ('ci_long_seconds', 'ci_long s', '{:.1f}'),
+               ('ci_long_rss_mb', 'ci_long MB', '{:.0f}'),
+               ('ci_long_requests', 'ci_long req', '{:d}')]
+    rows = [[header for _, header, _ in columns]]
+    for result in results:
+        rows.append([form.format(result[key]) for key, _, form in columns])
+    widths = [max(len(row[index]) for row in rows)
+              for index in range(len(columns))]
+    return '\n'.join('  '.join(cell.rjust(width)
+                               for cell, width in zip(row, widths))
+                     for row in rows)
+
+
+def compare(results, baseline, tolerance):
+    ''' The numbers that got worse than in the baseline results '''
+    old_results = {result['prs']: result for result in baseline['results']}
+    worse = []
+    for result in results:
+        old = old_results.get(result['prs'])
+        if old is None:
+            continue
+        for key, (unit, exact) in COMPARED.items():
+            if key not in old or key not in result:
+                continue
+            limit = old[key] if exact else old[key] * (1 + tolerance)
+            if result[key] > limit:
+                worse.append(f'{result["prs"]} PRs: {key} {old[key]:.3g}'
+                             f'{unit} -> {result[key]:.3g}{unit}')
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark ci_auto.py and ci_long.py offline against '
+                    'fake GitHub, git and Slurm')
+    parser.add_argument('--sizes', default='1,10,100,500',
+                        help='comma separated numbers of open PRs')
+    parser.add_argument('--repos', type=int, default=1,
+                        help='repos the PRs are spread over')
+    parser.add_argument('--int-every', type=int, default=10,
+                        help='every N-th PR also gets an int label, '
+                             '0 for none')
+    parser.add_argument('--tests', type=int, default=4,
+                        help='integration tests of each int job')
+    parser.add_argument('--expt-seconds', type=float, default=20,
+                        help='fake Slurm run time of each test')
+    parser.add_argument('--fail-every', type=int, default=5,
+                        help='every N-th test of a job fails, 0 for none')
+    parser.add_argument('--build-seconds', type=float, default=0,
+                        help='time each fake build takes')
+    parser.add_argument('--max-jobs', type=int, default=8,
+                        help='max_jobs and max_jobs_per_compiler')
+    parser.add_argument('--write-interval', type=float, default=0,
+                        help='gh_write_interval; GitHub asks for 1 s, '
+                             'which would make the writes the benchmark')
+    parser.add_argument('--polls', type=int, default=3,
+                        help='timed polls per size and API')
+    parser.add_argument('--timeout', type=int, default=3600,
+                        help='seconds a ci_auto or ci_long run may take')
+    parser.add_argument('--scratch', default=None,
+                        help='directory for the scratch directories')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the scratch directories')
+    parser.add_argument('--output', default=None,
+                        help='save the results as JSON')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of an earlier run to compare '
+                             'with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown or growth reported as a '
+                             'regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename=f'bench_'
+                 f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.log',
+        filemode='w', level=logging.INFO)
+    logger = logging.getLogger('BENCH')
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        print(f'Benchmarking {size} PRs', flush=True)
+        results.append(bench_size(size, args, logger))
+    print(report(results))
+    failed = [f'{result["prs"]} PRs: {script} exited with '
+              f'{result[f"{script}_status"]}' for result in results
+              for script in ['ci_auto', 'ci_long']
+              if result[f'{script}_status'] != 0]
+    for line in failed:
+        print(line)
+    if args.output:
+        with open(args.output, 'w') as fname:
+            json.dump({'time': datetime.datetime.now().isoformat(),
+                       'args': vars(args), 'results': results}, fname,
+                      indent=1)
+    if args.compare:
+        with open(args.compare) as fname:
+            worse = compare(results, json.load(fname), args.tolerance)
+        print('Regressions:' if worse else 'No regressions')
+        for line in worse:
+            print(f'  {line}')
+        if worse:
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
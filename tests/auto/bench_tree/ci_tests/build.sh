@@ -0,0 +1,12 @@
+#!/bin/bash
+# Stand-in for GeoFLOW's ci_tests/build.sh in the trees the fake git of
+# bench.py clones: "builds" geoflow_cdg in FAKE_BUILD_SECONDS seconds.
+BUILD_DIR=${CI_BUILD_DIR:-$( pwd )/../build}
+mkdir -p ${BUILD_DIR}/bin || exit 1
+sleep ${FAKE_BUILD_SECONDS:-0}
+if [[ -n "${CCACHE_STATSLOG:-}" ]]; then
+  printf 'cache_miss\ndirect_cache_hit\n' >> ${CCACHE_STATSLOG}
+fi
+printf '#!/bin/sh\necho "geoflow: do shutdown..."\n' > ${BUILD_DIR}/bin/geoflow_cdg
+chmod +x ${BUILD_DIR}/bin/geoflow_cdg
+echo "[100%] Built target geoflow_cdg"
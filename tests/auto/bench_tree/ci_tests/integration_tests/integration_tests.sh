@@ -0,0 +1,20 @@
+#!/usr/bin/env bash
+# Stand-in for GeoFLOW's integration_tests.sh in the trees the fake git
+# of bench.py clones. Same arguments and one sbatch call like the real
+# script, but the job only writes a synthetic slurm.out.
+
+if [ "$1" == "--array" ]; then
+  NUM_TESTS=$(grep -c . "$4")
+  SBATCH_ARGS="--array=0-$((NUM_TESTS - 1))"
+  TEST_CONFIG="TEST_LINE=\$(sed -n \"\$((SLURM_ARRAY_TASK_ID + 1))p\" \"$4\")
+RUN_DIR=\"$2/\${TEST_LINE%% *}\""
+else
+  SBATCH_ARGS=""
+  TEST_CONFIG="RUN_DIR=\"$1\""
+fi
+
+sbatch ${SBATCH_ARGS} <<EOT
+#!/bin/bash
+${TEST_CONFIG}
+"\${FAKE_TOOLS_PYTHON}" "\${FAKE_TOOLS}" slurm-out "\${RUN_DIR}/slurm.out"
+EOT
@@ -5,55 +5,40 @@ Automation of UFS Regression Testing for ufs-weather-model
 This script should be started through start_ci_py_pro.sh so that
 env vars and Python paths are set up prior to start.
 """
-from github import Github as gh
-
+import argparse
+import collections
 import datetime
-import subprocess
 import re
 import os
 import logging
 from configparser import ConfigParser as config_parser
 import importlib
-
-
-class GHInterface:
-    '''
-    This class stores information for communicating with GitHub
-    ...
-
-    Attributes
-    ----------
-    GHACCESSTOKEN : str
-      API token to authenticate with GitHub
-    client : pyGitHub communication object
-      The connection to GitHub to make API requests
-    '''
-
-    def __init__(self):
-        self.logger = logging.getLogger('GHINTERFACE')
-
-        filename = 'accesstoken'
-
-        if os.path.exists(filename):
-            if oct(os.stat(filename).st_mode)[-3:] != 600:
-                with open(filename) as f:
-                    os.environ['ghapitoken'] = f.readline().strip('\n')
-            else:
-                raise Exception('File permission needs to be "600" ')
-        else:
-            raise FileNotFoundError('Cannot find file "accesstoken"')
-
-        try:
-            self.client = gh(os.getenv('ghapitoken'))
-        except Exception as e:
-            self.logger.critical(f'Exception is {e}')
-            raise(e)
+import json
+import shutil
+import threading
+
+from github import UnknownObjectException
+
+import ci_long
+from daemon import Daemon
+from ghclient import GHInterface
+from graphql_pulls import GraphQLLabel, GraphQLPullRequest, get_open_pulls
+from jobs.checkout import gc_checkouts
+from metrics import count, event, get_metrics, observe, phase, span
+from runner import CommandFailed, CommandTimeout, JobCancelled, \
+    run_command
+from scheduler import SUPERSEDED, JobScheduler
+from slurm import cancel_jobs
+from statestore import open_store
+from webhook import WebhookReceiver, read_secret
+from workspace_gc import WorkspaceGC
 
 
 def set_action_from_label(machine, actions, label):
     ''' Match the label that initiates a job with an action in the dict
         Labels have a ci- prefix'''
-    # ci-<machine>-<compiler>-<test> i.e. ci-hera-intel-build, ci-hera-gnu-int
+    # ci-<machine>-<compiler>-<test> i.e. ci-hera-intel-build, ci-hera-gnu-int,
+    # ci-hera-gnu-scale
     logger = logging.getLogger('MATCH_LABEL_WITH_ACTIONS')
     # split the label apart and remove its prefix
     split_label = label.name.split('-')[1:]
@@ -75,6 +60,22 @@ def set_action_from_label(machine, actions, label):
     return label_compiler, action_match
 
 
+def get_repo_preqs(repo, machine_dict, ghinterface_obj):
+    ''' List the open pull requests of a repo. One batched GraphQL query
+        returns the labels and head data with them; the REST API, which
+        needs one more request per PR for labels, is the fallback '''
+    logger = logging.getLogger('GET_REPO_PREQS')
+    if machine_dict['use_graphql']:
+        try:
+            return get_open_pulls(ghinterface_obj, repo)
+        except Exception as e:
+            logger.critical(f'GraphQL query failed, using REST. '
+                            f'Exception:{e}')
+    return ghinterface_obj.client.get_repo(repo['address']) \
+                                 .get_pulls(state='open', sort='created',
+                                            base=repo['base'])
+
+
 def get_preqs_with_actions(repos, machine_dict, ghinterface_obj, actions):
     ''' Create list of dictionaries of a pull request
         and its machine label and action '''
@@ -82,11 +83,7 @@ def get_preqs_with_actions(repos, machine_dict, ghinterface_obj, actions):
     logger.info('Getting Pull Requests with Actions')
     jobs = []
     for repo in repos:
-        gh_preqs = [ghinterface_obj.client.get_repo(repo['address'])
-                                   .get_pulls(state='open', sort='created',
-                                              base=repo['base'])]
-
-        each_pr = [preq for gh_preq in gh_preqs for preq in gh_preq]
+        each_pr = get_repo_preqs(repo, machine_dict, ghinterface_obj)
         preq_labels = [{'preq': pr, 'label': label} for pr in each_pr
                        for label in pr.get_labels()]
 
@@ -98,9 +95,59 @@ def get_preqs_with_actions(repos, machine_dict, ghinterface_obj, actions):
                 jobs.append(Job(pr_label.copy(), ghinterface_obj,
                                 machine_dict, compiler, repo))
 
+    return group_jobs(jobs)
+
+
+def group_jobs(jobs):
+    ''' Group the jobs of one PR commit and action that differ only by
+        compiler. They share the PR's tree, build at the same time and
+        report in one PR comment. Returns the jobs. '''
+    groups = collections.defaultdict(list)
+    for job in jobs:
+        preq = job.preq_dict['preq']
+        groups[(preq.id, preq.head.sha, job.preq_dict['action'])] \
+            .append(job)
+    for members in groups.values():
+        if len(members) > 1:
+            JobGroup(members)
     return jobs
 
 
+class JobGroup:
+    '''
+    This class collects the reports of the jobs of one PR commit and
+    action, one job per compiler, in one PR comment
+    ...
+
+    Attributes
+    ----------
+    jobs : list
+        The jobs of the group
+    comment : IssueComment
+        The PR comment, created by the first job that reports; the
+        others add their report to it
+    '''
+
+    def __init__(self, jobs):
+        self.logger = logging.getLogger('JOB_GROUP')
+        self.jobs = jobs
+        self.comment = None
+        self.lock = threading.Lock()
+        for job in jobs:
+            job.group = self
+        self.logger.info(f'Grouped {[job.key for job in jobs]}')
+
+    def post(self, job, text):
+        ''' Add a job's report to the comment of the group '''
+        with self.lock:
+            if self.comment is None:
+                self.comment = \
+                    job.preq_dict['preq'].create_issue_comment(text)
+            else:
+                self.comment.edit(f'{self.comment.body}\n{text}')
+            return self.comment
+
+
 class Job:
     '''
     This class stores all information needed to run jobs on this machine.
@@ -133,8 +180,34 @@ class Job:
         self.repo = repo
         self.hpc_acc = machine_dict['hpc_acc']
         self.workdir = machine_dict['workdir']
+        self.build_cache_mb = machine_dict['build_cache_mb']
+        self.build_jobs = machine_dict['build_jobs']
+        self.ccache_dir = machine_dict['ccache_dir']
+        self.ccache_max_gb = machine_dict['ccache_max_gb']
+        self.command_timeout = machine_dict['command_timeout']
+        self.clone_timeout = machine_dict['clone_timeout']
+        self.build_timeout = machine_dict['build_timeout']
+        self.label_poll = machine_dict['label_poll']
+        self.store = open_store(machine_dict['state_db'])
+        self.job_id = None
         self.comment_text = ''
         self.failed_tests = []
+        self.log_dir = None
+        self.command_results = []
+        self.cancel_event = threading.Event()
+        self.cancel_reason = ''
+        self.done = threading.Event()
+        # Slurm jobs and test run directories of this job, cancelled and
+        # removed if a newer commit supersedes it
+        self.slurm_ids = []
+        self.run_locs = []
+        # JobGroup of the jobs of other compilers for the same commit
+        self.group = None
+
+    @property
+    def key(self):
+        ''' Identifies the PR/label this job handles '''
+        return f'{self.preq_dict["preq"].id}_{self.preq_dict["label"].name}'
 
     def comment_append(self, newtext):
         self.comment_text += f'{newtext}\n'
@@ -142,7 +215,44 @@ class Job:
     def remove_pr_label(self):
         ''' Removes the PR label that initiated the job run from PR '''
         self.logger.info(f'Removing Label: {self.preq_dict["label"]}')
-        self.preq_dict['preq'].remove_from_labels(self.preq_dict['label'])
+        try:
+            # Server errors are retried by ghclient, so a passing GitHub
+            # hiccup does not leave the label to run the job again
+            self.preq_dict['preq'].remove_from_labels(
+                self.preq_dict['label'])
+        except UnknownObjectException:
+            # Removed by a retry whose first attempt went through, or
+            # by hand
+            self.logger.info(f'Label {self.preq_dict["label"]} already '
+                             'removed')
+
+    def cancel(self, reason):
+        ''' Stop the running command and the rest of the job '''
+        self.logger.info(f'Cancelling {self.key}: {reason}')
+        self.cancel_reason = reason
+        self.cancel_event.set()
+
+    def sleep(self, seconds):
+        ''' Wait, unless the job is cancelled in the meantime '''
+        if self.cancel_event.wait(seconds):
+            raise JobCancelled(self.cancel_reason)
+
+    def watch_label(self):
+        ''' Cancel the job if its label is removed from the PR while
+            it runs. Runs on its own thread until the job is done. '''
+        logger = logging.getLogger('JOB/WATCH_LABEL')
+        preq = self.preq_dict['preq']
+        # GraphQL PR objects hold a snapshot of the labels
+        get_labels = getattr(preq, 'refresh_labels', preq.get_labels)
+        while not self.done.wait(self.label_poll):
+            try:
+                labels = [label.name for label in get_labels()]
+            except Exception as e:
+                logger.info(f'Could not check labels. Exception:{e}')
+                continue
+            if self.preq_dict['label'].name not in labels:
+                self.cancel('label removed')
+                return
 
     def check_label_before_job_start(self):
         # LETS Check the label still exists before the start of the job in the
@@ -150,53 +260,180 @@ class Job:
         label_to_check = f'ci-{self.machine}'            \
                          f'-{self.compiler}'             \
                          f'-{self.preq_dict["action"]}'
-        labels = self.preq_dict['preq'].get_labels()
+        preq = self.preq_dict['preq']
+        # GraphQL PR objects hold the labels of the poll; a job that
+        # waited for a slot needs the current ones
+        labels = getattr(preq, 'refresh_labels', preq.get_labels)()
         label_match = next((label for label in labels
                             if re.match(label.name, label_to_check)), False)
 
         return label_match
 
-    def run_commands(self, logger, commands_with_cwd):
-        for command, in_cwd in commands_with_cwd:
+    def command_log(self, command):
+        ''' Log file for the output of the next command of this job '''
+        if self.log_dir is None:
+            self.log_dir = os.path.join(
+                self.workdir, 'logs',
+                f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}_'
+                f'{self.key}')
+            os.makedirs(self.log_dir, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', command).strip('_')[:40]
+        return os.path.join(self.log_dir,
+                            f'{len(self.command_results) + 1:02d}_{slug}.log')
+
+    def run_commands(self, logger, commands_with_cwd, check=True):
+        ''' Run shell commands in order, streaming their output to a log
+            file per command. Each entry is [command, cwd] or
+            [command, cwd, timeout in seconds].
+            Returns a runner.CommandResult for each command. Raises
+            CommandTimeout or JobCancelled if a command had to be killed,
+            and CommandFailed on a non-zero exit code if check is True. '''
+        results = []
+        for step in commands_with_cwd:
+            command, in_cwd = step[:2]
+            timeout = step[2] if len(step) > 2 else self.command_timeout
+            if self.cancel_event.is_set():
+                raise JobCancelled(self.cancel_reason)
             logger.info(f'Running `{command}`')
             logger.info(f'in location "{in_cwd}"')
-            try:
-                output = subprocess.Popen(command, shell=True, cwd=in_cwd,
-                                          stdout=subprocess.PIPE,
-                                          stderr=subprocess.STDOUT)
-            except Exception as e:
-                self.job_failed(logger, 'subprocess.Popen', exception=e)
-            else:
-                try:
-                    out, err = output.communicate()
-                    out = [] if not out else out.decode('utf8').split('\n')
-                    logger.info(out)
-                except Exception as e:
-                    err = [] if not err else err.decode('utf8').split('\n')
-                    self.job_failed(logger, f'Command {command}', exception=e,
-                                    STDOUT=True, out=out, err=err)
-                else:
-                    logger.info(f'Finished running: {command}')
+            log_file = self.command_log(command)
+            result = run_command(command, in_cwd, log_file, timeout=timeout,
+                                 cancel_event=self.cancel_event)
+            self.command_results.append(result)
+            results.append(result)
+            self.record_command(result)
+            logger.info(f'Finished running: {command} '
+                        f'(exit {result.returncode}, '
+                        f'{result.wall_time:.1f} s, '
+                        f'peak RSS {result.max_rss_kb} kB, '
+                        f'output in {log_file})')
+            if result.killed_by == 'cancel':
+                raise JobCancelled(self.cancel_reason)
+            if result.killed_by == 'timeout':
+                raise CommandTimeout(result, timeout)
+            if result.returncode != 0:
+                self.job_failed(logger, f'Command {command}',
+                                exception=f'exit {result.returncode}',
+                                STDOUT=True, out=result.tail, err=[])
+                if check:
+                    raise CommandFailed(result)
+        return results
+
+    @staticmethod
+    def record_command(result):
+        ''' Count a command under the phase it ran in '''
+        outcome = result.killed_by or \
+            ('ok' if result.returncode == 0 else 'failed')
+        observe('ci_command_seconds', result.wall_time, phase=phase())
+        count('ci_commands_total', phase=phase(), outcome=outcome)
+        event('command', phase=phase(), command=result.command,
+              cwd=result.cwd, returncode=result.returncode,
+              seconds=round(result.wall_time, 3),
+              max_rss_kb=result.max_rss_kb, outcome=outcome,
+              log_file=result.log_file)
+
+    def write_step_record(self):
+        ''' Save the timing and outcome of every command of the job '''
+        if self.log_dir is None:
+            return
+        steps = [{'command': result.command,
+                  'cwd': result.cwd,
+                  'returncode': result.returncode,
+                  'wall_time': round(result.wall_time, 3),
+                  'max_rss_kb': result.max_rss_kb,
+                  'killed_by': result.killed_by,
+                  'log_file': result.log_file}
+                 for result in self.command_results]
+        with open(os.path.join(self.log_dir, 'steps.json'), 'w') as fname:
+            json.dump(steps, fname, indent=2)
 
     def run(self):
         logger = logging.getLogger('JOB/RUN')
+        if self.cancel_event.is_set():
+            # e.g. the PR was closed while the job waited for a slot
+            logger.info(f'Job cancelled before it started: '
+                        f'{self.cancel_reason}')
+            return
         logger.info(f'Starting Job: {self.preq_dict["label"]}')
         self.comment_append(newtext=f'Machine: {self.machine}')
         self.comment_append(f'Compiler: {self.compiler}')
         self.comment_append(f'Job: {self.preq_dict["action"]}')
-        if self.check_label_before_job_start():
+        if not self.check_label_before_job_start():
+            logger.info(f'Cannot find label {self.preq_dict["label"]}')
+            return
+
+        # The label stays on the PR while the job runs; removing it
+        # cancels the job
+        watcher = threading.Thread(target=self.watch_label,
+                                   name=f'{self.key}/watch_label',
+                                   daemon=True)
+        watcher.start()
+        self.job_id = self.store.start_job(self)
+        state = 'finished'
+        try:
+            state = self.run_job(logger)
+        finally:
+            self.done.set()
+            self.write_step_record()
+            self.store.finish_job(self.job_id, state)
+            count('ci_jobs_total', action=self.preq_dict['action'],
+                  compiler=self.compiler, state=state)
+
+        # A cancelled job keeps its label, so it is started again
+        # unless the label was removed
+        if not self.cancel_event.is_set():
             try:
                 logger.info('Calling remove_pr_label')
                 self.remove_pr_label()
-                logger.info('Calling Job to Run')
-                self.job_mod.run(self)
-            except Exception:
-                self.job_failed(logger, 'run()')
-                logger.info('Sending comment text')
-                issue_id = self.send_comment_text()
-                logger.debug(f'Issue comment id is {issue_id}')
-        else:
-            logger.info(f'Cannot find label {self.preq_dict["label"]}')
+            except Exception as e:
+                self.job_failed(logger, 'remove_pr_label()', exception=e)
+
+    def run_job(self, logger):
+        ''' Run the job module and report how it failed. Returns the state
+            the job ended in. '''
+        try:
+            logger.info('Calling Job to Run')
+            self.job_mod.run(self)
+        except JobCancelled:
+            return self.job_cancelled(logger)
+        except CommandFailed as e:
+            self.job_failed(logger, 'run()', exception=e)
+            self.comment_append(f'Failed: {e}')
+            for line in e.result.tail[-20:]:
+                self.comment_append(line)
+            logger.info('Sending comment text')
+            issue_id = self.send_comment_text()
+            logger.debug(f'Issue comment id is {issue_id}')
+            return 'failed'
+        except Exception:
+            self.job_failed(logger, 'run()')
+            logger.info('Sending comment text')
+            issue_id = self.send_comment_text()
+            logger.debug(f'Issue comment id is {issue_id}')
+            return 'failed'
+        return 'finished'
+
+    def job_cancelled(self, logger):
+        ''' Clean up after a cancelled job and say why on the PR, unless
+            it is stopping for good. Returns its state. '''
+        state = 'cancelled'
+        logger.info(f'Job cancelled: {self.cancel_reason}')
+        if self.cancel_reason.startswith(SUPERSEDED):
+            state = 'superseded'
+            self.clean_up_superseded()
+        if self.cancel_reason == 'label removed' or state == 'superseded':
+            self.comment_append(f'Job cancelled: {self.cancel_reason}')
+            self.send_comment_text()
+        return state
+
+    def clean_up_superseded(self):
+        ''' Free what the job took that the newer commit's job does not
+            need: its Slurm jobs and test run directories '''
+        logger = logging.getLogger('JOB/CLEAN_UP_SUPERSEDED')
+        cancel_jobs(self.slurm_ids)
+        for run_loc in self.run_locs:
+            logger.info(f'Removing {run_loc}')
+            shutil.rmtree(run_loc, ignore_errors=True)
 
     def send_comment_text(self):
         logger = logging.getLogger('JOB/SEND_COMMENT_TEXT')
@@ -207,6 +444,8 @@ class Job:
                             f'-{self.compiler}'
                             f'-{self.preq_dict["action"]}')
 
+        if self.group:
+            return self.group.post(self, self.comment_text)
         issue_id = \
             self.preq_dict['preq'].create_issue_comment(self.comment_text)
         return(issue_id)
@@ -239,6 +478,69 @@ def setup_env():
         machine_dict['machine'] = config['DEFAULT']['machine']
         machine_dict['hpc_acc'] = config['DEFAULT']['hpc_acc']
         machine_dict['workdir'] = config['DEFAULT']['workdir']
+        # Concurrency limits for running jobs, optional in the config file
+        machine_dict['max_jobs'] = \
+            config['DEFAULT'].getint('max_jobs', fallback=2)
+        machine_dict['max_jobs_per_compiler'] = \
+            config['DEFAULT'].getint('max_jobs_per_compiler', fallback=1)
+        # Daemon mode cadence and shutdown grace period, in seconds
+        machine_dict['poll_interval'] = \
+            config['DEFAULT'].getint('poll_interval', fallback=60)
+        machine_dict['long_poll_interval'] = \
+            config['DEFAULT'].getint('long_poll_interval', fallback=300)
+        machine_dict['shutdown_grace'] = \
+            config['DEFAULT'].getint('shutdown_grace', fallback=60)
+        # Timeouts of job commands, in seconds, and how often a running
+        # job checks that its label is still on the PR
+        machine_dict['command_timeout'] = \
+            config['DEFAULT'].getint('command_timeout', fallback=3600)
+        machine_dict['clone_timeout'] = \
+            config['DEFAULT'].getint('clone_timeout', fallback=1800)
+        machine_dict['build_timeout'] = \
+            config['DEFAULT'].getint('build_timeout', fallback=10800)
+        machine_dict['label_poll'] = \
+            config['DEFAULT'].getint('label_poll', fallback=120)
+        # Batched GraphQL listing of pull requests, REST when false
+        machine_dict['use_graphql'] = \
+            config['DEFAULT'].getboolean('use_graphql', fallback=True)
+        # Size cap of the cache of earlier builds
+        machine_dict['build_cache_mb'] = \
+            config['DEFAULT'].getint('build_cache_mb', fallback=4096)
+        # Parallel make jobs and compiler cache for build.sh;
+        # an empty ccache_dir turns the compiler cache off
+        machine_dict['build_jobs'] = \
+            config['DEFAULT'].getint('build_jobs', fallback=4)
+        machine_dict['ccache_dir'] = config['DEFAULT'].get(
+            'ccache_dir',
+            fallback=os.path.join(machine_dict['workdir'], 'ccache'))
+        machine_dict['ccache_max_gb'] = \
+            config['DEFAULT'].getint('ccache_max_gb', fallback=20)
+        # SQLite database of jobs and long running experiments
+        machine_dict['state_db'] = \
+            config['DEFAULT'].get('state_db', fallback='ci_state.db')
+        # How often the trees of closed and merged PRs are removed
+        machine_dict['checkout_gc_interval'] = \
+            config['DEFAULT'].getint('checkout_gc_interval', fallback=3600)
+        # Webhook listener, off when webhook_port is 0. Polling then
+        # runs every reconcile_interval seconds instead
+        machine_dict['webhook_port'] = \
+            config['DEFAULT'].getint('webhook_port', fallback=0)
+        machine_dict['webhook_host'] = \
+            config['DEFAULT'].get('webhook_host', fallback='127.0.0.1')
+        machine_dict['webhook_secret_file'] = config['DEFAULT'].get(
+            'webhook_secret_file', fallback='webhook_secret')
+        machine_dict['webhook_record_dir'] = \
+            config['DEFAULT'].get('webhook_record_dir', fallback='')
+        machine_dict['webhook_interval'] = \
+            config['DEFAULT'].getint('webhook_interval', fallback=30)
+        machine_dict['reconcile_interval'] = \
+            config['DEFAULT'].getint('reconcile_interval', fallback=1800)
+        # How often the workdir is brought under its disk budget
+        machine_dict['gc_interval'] = \
+            config['DEFAULT'].getint('gc_interval', fallback=3600)
+        # How often the Prometheus textfile of the metrics is rewritten
+        machine_dict['metrics_interval'] = \
+            config['DEFAULT'].getint('metrics_interval', fallback=60)
 
     if not os.path.exists(machine_dict['workdir']):
         raise KeyError(f'Work directory from config file '
@@ -263,12 +565,112 @@ def setup_env():
             repo_dict.append(one_repo)
 
     # Approved Actions
-    action_list = ['build', 'int', 'rt']
+    action_list = ['build', 'int', 'rt', 'scale']
 
     return machine_dict, repo_dict, action_list
 
 
+def poll(repos, machine_dict, ghinterface_obj, actions, scheduler):
+    ''' Hand the jobs of all labeled pull requests to the scheduler '''
+    logger = logging.getLogger('POLL')
+    # get all pull requests from the GitHub object
+    # and turn them into Job objects
+    logger.info('Getting all pull requests, '
+                'labels and actions applicable to this machine.')
+    with span('poll') as fields:
+        jobs = get_preqs_with_actions(repos, machine_dict,
+                                      ghinterface_obj, actions)
+        fields['jobs'] = len(jobs)
+    ghinterface_obj.log_stats()
+    for job in jobs:
+        scheduler.submit(job)
+
+
+def handle_webhook_events(repos, machine_dict, ghinterface_obj, actions,
+                          scheduler, store):
+    ''' Turn the queued webhook events into jobs, oldest first '''
+    logger = logging.getLogger('HANDLE_WEBHOOK_EVENTS')
+    for webhook_event in store.webhook_events('queued'):
+        try:
+            handle_webhook_event(json.loads(webhook_event['payload']),
+                                 repos, machine_dict, ghinterface_obj,
+                                 actions, scheduler)
+            state = 'done'
+        except Exception as e:
+            logger.critical(f'Webhook event {webhook_event["id"]} '
+                            f'({webhook_event["delivery"]}) FAILED. '
+                            f'Exception:{e}')
+            state = 'failed'
+        store.finish_webhook_event(webhook_event['id'], state)
+
+
+def handle_webhook_event(payload, repos, machine_dict, ghinterface_obj,
+                         actions, scheduler):
+    ''' Submit the jobs of a labeled or updated PR, or cancel those of a
+        closed one. The PR is built from the payload, without any API
+        request. '''
+    logger = logging.getLogger('HANDLE_WEBHOOK_EVENT')
+    pull = payload['pull_request']
+    address = payload['repository']['full_name']
+    repo = next((repo for repo in repos
+                 if repo['address'].strip('/') == address and
+                 repo['base'] == pull['base']['ref']), None)
+    if repo is None:
+        logger.info(f'Ignoring {address}#{pull["number"]} into '
+                    f'{pull["base"]["ref"]}: not in CIrepos.cfg')
+        return
+    preq = GraphQLPullRequest.from_webhook(ghinterface_obj, repo['address'],
+                                           pull)
+    action = payload['action']
+    logger.info(f'{address}#{preq.number} {action}')
+    if action == 'closed':
+        # Its directories are removed by the next checkout_gc
+        for job in scheduler.cancel_pr(preq.id, 'PR closed'):
+            logger.info(f'Cancelled {job.key}')
+        return
+    # A new label starts its job; new commits start the jobs of every
+    # label still on the PR
+    labels = [payload['label']] if action == 'labeled' else pull['labels']
+    jobs = []
+    for label in labels:
+        label = GraphQLLabel(label['name'])
+        compiler, match = set_action_from_label(machine_dict['machine'],
+                                                actions, label)
+        if match:
+            jobs.append(Job({'preq': preq, 'label': label, 'action': match},
+                            ghinterface_obj, machine_dict, compiler, repo))
+    for job in group_jobs(jobs):
+        scheduler.submit(job)
+
+
+def start_webhook_receiver(machine_dict, repos, ghinterface_obj, actions,
+                           scheduler, store, daemon):
+    ''' Listen for webhooks and handle their events from the daemon
+        loop, woken up by each new event '''
+    receiver = WebhookReceiver(
+        store, read_secret(machine_dict['webhook_secret_file']),
+        machine_dict['webhook_host'], machine_dict['webhook_port'],
+        machine_dict['webhook_record_dir'] or None,
+        on_queued=lambda: daemon.wake('webhook'))
+    daemon.add_task('webhook',
+                    lambda: handle_webhook_events(repos, machine_dict,
+                                                  ghinterface_obj, actions,
+                                                  scheduler, store),
+                    machine_dict['webhook_interval'])
+    receiver.start()
+    return receiver
+
+
 def main():
+    parser = argparse.ArgumentParser(
+        description='Run CI jobs requested by pull request labels')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, polling GitHub and checking '
+                             'long jobs, instead of polling once')
+    parser.add_argument('--interval', type=int,
+                        help='seconds between polls in daemon mode, '
+                             'overrides poll_interval in CImachine.cfg')
+    args = parser.parse_args()
 
     # handle logging
     log_filename = f'ci_auto_'\
@@ -281,18 +683,63 @@ def main():
     # setup environment
     logger.info('Getting the environment setup')
     machine_dict, repos, actions = setup_env()
+    metrics = get_metrics('ci_auto')
 
     # setup interface with GitHub
     logger.info('Setting up GitHub interface.')
     ghinterface_obj = GHInterface()
 
-    # get all pull requests from the GitHub object
-    # and turn them into Job objects
-    logger.info('Getting all pull requests, '
-                'labels and actions applicable to this machine.')
-    jobs = get_preqs_with_actions(repos, machine_dict,
-                                  ghinterface_obj, actions)
-    [job.run() for job in jobs]
+    # Experiments still tracked in a Longjob.cfg move to the database
+    store = open_store(machine_dict['state_db'])
+    store.import_longjob_cfg()
+
+    # Run the jobs concurrently, each PR/label at most once at a time
+    scheduler = JobScheduler(machine_dict['max_jobs'],
+                             machine_dict['max_jobs_per_compiler'],
+                             os.path.join(machine_dict['workdir'], 'locks'))
+
+    if args.daemon:
+        # One GitHub session and one loop for both polling and long jobs
+        daemon = Daemon()
+        receiver = None
+        poll_interval = args.interval or machine_dict['poll_interval']
+        if machine_dict['webhook_port']:
+            receiver = start_webhook_receiver(machine_dict, repos,
+                                              ghinterface_obj, actions,
+                                              scheduler, store, daemon)
+            # Polling only catches what the webhooks missed
+            poll_interval = args.interval or \
+                machine_dict['reconcile_interval']
+        daemon.add_task('ci_auto',
+                        lambda: poll(repos, machine_dict, ghinterface_obj,
+                                     actions, scheduler),
+                        poll_interval)
+        daemon.add_task('ci_long',
+                        lambda: ci_long.check_long_jobs(ghinterface_obj,
+                                                        store),
+                        machine_dict['long_poll_interval'])
+        daemon.add_task('checkout_gc',
+                        lambda: gc_checkouts(ghinterface_obj,
+                                             machine_dict['workdir'], store),
+                        machine_dict['checkout_gc_interval'])
+        workspace_gc = WorkspaceGC.from_config()
+        daemon.add_task('workspace_gc',
+                        lambda: workspace_gc.collect(store),
+                        machine_dict['gc_interval'])
+        daemon.add_task('metrics', metrics.write_textfile,
+                        machine_dict['metrics_interval'])
+        daemon.run()
+        if receiver:
+            receiver.stop()
+        # Jobs that cannot finish in time are cancelled and keep their
+        # label, so the next start picks them up again
+        scheduler.shutdown(machine_dict['shutdown_grace'])
+    else:
+        poll(repos, machine_dict, ghinterface_obj, actions, scheduler)
+        scheduler.wait()
+        gc_checkouts(ghinterface_obj, machine_dict['workdir'], store)
+        WorkspaceGC.from_config().collect(store)
+    metrics.write_textfile()
 
     logger.info('Script Finished')
 
@@ -1,54 +1,224 @@
 """
 Name: ci_long.py
-This Python program reads a config file that has information
-on Integration tests that were not completed, and returns status information.
+This Python program reads the state store for information on
+Integration tests that were not completed, and returns status information.
 
 This script should be started through start_ci_py_pro.sh so that
 env vars and Python paths are set up prior to start.
 """
 
-from github import Github as gh
-
+import argparse
+import collections
 import datetime
 import os
 import logging
-from configparser import ConfigParser as config_parser
-
-
-class GHInterface:
-    '''
-    This class stores information for communicating with GitHub
-    ...
-    Attributes
-    ----------
-    GHACCESSTOKEN : str
-      API token to authenticate with GitHub
-    client : pyGitHub communication object
-      The connection to GitHub to make API requests
-    '''
-
-    def __init__(self):
-        self.logger = logging.getLogger('GHINTERFACE')
-
-        filename = 'accesstoken'
-
-        if os.path.exists(filename):
-            if oct(os.stat(filename).st_mode)[-3:] != 600:
-                with open(filename) as f:
-                    os.environ['ghapitoken'] = f.readline().strip('\n')
-            else:
-                raise Exception('File permission needs to be "600" ')
-        else:
-            raise FileNotFoundError('Cannot find file "accesstoken"')
 
+from baseline import BaselineComparator
+from daemon import Daemon
+from ghclient import GHInterface
+from jobs.scale import ScalingSweep, parse_run_name
+from logwatch import LogWatcher
+from metrics import experiment, get_metrics, set_context
+from perf import PerfTracker
+from slurm import elapsed_seconds, format_job, is_terminal, query_jobs
+from statestore import StateStore
+
+
+def check_long_jobs(ghinterface_obj, store):
+    ''' Check the experiments still running in the state store and report
+        the finished ones on their PR '''
+    logger = logging.getLogger('CHECK_LONG_JOBS')
+    _check_long_jobs(ghinterface_obj, store, logger)
+    ghinterface_obj.log_stats()
+
+
+def _check_long_jobs(ghinterface_obj, store, logger):
+    # Info on uncompleted tests
+    running = store.experiments('running')
+    if not running:
+        logger.info('No running experiments. Nothing to check.')
+        return
+    logger.info(f'Experiments running: {len(running)}')
+
+    # Words to search for in log to signal success or failure
+    complete_string = "geoflow: do shutdown..."
+    failed_string = "Force Terminated"
+    watcher = LogWatcher({'Succeeded': complete_string,
+                          'Failed': failed_string})
+    comparator = BaselineComparator.from_config()
+    tracker = PerfTracker.from_config(store)
+
+    # One Slurm query for all tracked experiments
+    slurm_jobs = query_jobs([row['slurm_id'] for row in running])
+    # PRs looked up in this pass only, a daemon would otherwise keep
+    # closed PRs and old data for its whole life
+    pulls = {}
+
+    # Experiments reported in the same PR comment are handled together,
+    # with one edit of the comment
+    groups = collections.defaultdict(list)
+    for row in running:
+        groups[(row['pr_repo'], row['pr_num'], row['comment_id'])] \
+            .append(row)
+
+    expt_done_count = 0
+    for (pr_repo, pr_num, comment_id), rows in groups.items():
         try:
-            self.client = gh(os.getenv('ghapitoken'))
+            expt_done_count += check_comment_group(
+                ghinterface_obj, store, watcher, comparator, tracker,
+                slurm_jobs, pulls, pr_repo, pr_num, comment_id, rows)
         except Exception as e:
-            self.logger.critical(f'Exception is {e}')
-            raise(e)
+            # The experiments stay running and are reported next time
+            logger.critical(f'Updating {pr_repo}#{pr_num} comment '
+                            f'{comment_id} FAILED. Exception:{e}')
+    logger.info(f'Experiments Completed: {str(expt_done_count)}')
+
+
+def check_comment_group(ghinterface_obj, store, watcher, comparator,
+                        tracker, slurm_jobs, pulls, pr_repo, pr_num,
+                        comment_id, rows):
+    ''' Check the experiments of one PR comment and add the finished ones
+        to the comment. Returns the number of finished experiments. '''
+    logger = logging.getLogger('CHECK_LONG_JOBS/COMMENT')
+    pr_comment = ''
+    finished = []
+    for row in rows:
+        logger.info(f'{row["log_path"]}: {pr_repo}#{pr_num}')
+        slurm_job = slurm_jobs.get(row['slurm_id'])
+        if slurm_job:
+            logger.info(format_job(slurm_job))
+        result = expt_result(store, watcher, row, slurm_job)
+        if not result:
+            continue
+        expt_string, text = expt_comment(store, comparator, tracker, row,
+                                         result, slurm_job)
+        pr_comment += text
+        logger.info(f'Experiment {expt_string}: {row["expt"]}')
+        finished.append((row['log_path'], expt_string.lower(), slurm_job))
+
+    if not finished:
+        return 0
+    if len(finished) == len(rows):
+        pr_comment += 'All experiments completed\n'
+        if any(parse_run_name(row['expt']) for row in rows):
+            pr_comment += scaling_report(store, comment_id, finished)
+    issue_comm = get_pull(ghinterface_obj, pulls, pr_repo, pr_num) \
+        .get_issue_comment(id=comment_id)
+    issue_comm.edit(issue_comm.body + pr_comment)
+    # Only marked finished once reported, so a failed edit is retried
+    set_context(repo=pr_repo, pr=pr_num)
+    expts = {row['log_path']: row['expt'] for row in rows}
+    for ci_log, state, slurm_job in finished:
+        store.finish_experiment(ci_log, state, slurm_job)
+        experiment(expts[ci_log], state, slurm_job)
+    return len(finished)
+
+
+def expt_result(store, watcher, row, slurm_job):
+    ''' (result, line) of an experiment that ended, from its log or the
+        Slurm state of its job, or None while it runs '''
+    ci_log = row['log_path']
+    # Continue reading the log where the last check stopped
+    watcher.set_state(ci_log, store.log_state(row))
+    results = watcher.scan(ci_log)
+    if not results and slurm_job and is_terminal(slurm_job.state):
+        # Ended without writing either string, e.g. killed for
+        # running out of memory or time. A completed run's log may
+        # not be flushed yet, it is read once more on the next pass.
+        if slurm_job.state != 'COMPLETED':
+            results = [('Failed', 'No result in log, Slurm job ended')]
+        elif row['slurm_state'] == 'COMPLETED':
+            results = [('Failed', 'No result in log, Slurm job '
+                                  'completed')]
+    if not results:
+        # Save the log offset reached
+        store.update_experiment(ci_log, watcher.get_state(ci_log),
+                                slurm_job)
+        return None
+    return results[0]
+
+
+def expt_comment(store, comparator, tracker, row, result, slurm_job):
+    ''' Final result of an experiment that ended and its lines of the PR
+        comment. A finished run must also match its baseline; its
+        timers are compared with those of the base branch. '''
+    expt_string, line = result
+    run_dir = os.path.dirname(row['log_path'])
+    tables = []
+    if expt_string == 'Succeeded':
+        passed, table = comparator.check(run_dir)
+        tables.append(table)
+        if passed is False:
+            expt_string = 'Failed'
+            line = 'Outputs differ from baseline'
+        else:
+            tables.append(tracker.check(run_dir, row['expt'],
+                                        store.job(row['job_id']),
+                                        slurm_job))
+    text = f'Experiment {expt_string} on {row["machine"]}: {row["expt"]}\n'
+    if expt_string == "Failed":
+        text += f'{line.rstrip()}\n'
+    if slurm_job:
+        text += f'{format_job(slurm_job)}\n'
+    for table in tables:
+        if table:
+            text += f'{table}\n'
+    return expt_string, text
+
+
+def scaling_report(store, comment_id, finished):
+    ''' Scaling tables of the sweeps whose runs are all done, one per
+        sweep directory: the jobs of each compiler share the comment '''
+    finished_jobs = {ci_log: slurm_job for ci_log, _, slurm_job in finished}
+    sweeps = {}
+    for expt_row in store.comment_experiments(comment_id):
+        if not parse_run_name(expt_row['expt']) or \
+                expt_row['state'] == 'superseded':
+            continue
+        scale_base_dir = os.path.dirname(
+            os.path.dirname(expt_row['log_path']))
+        sweep = sweeps.setdefault(scale_base_dir,
+                                  {'job_id': expt_row['job_id'],
+                                   'elapsed': {}})
+        slurm_job = finished_jobs.get(expt_row['log_path'])
+        seconds = elapsed_seconds(slurm_job.elapsed if slurm_job
+                                  else expt_row['elapsed'])
+        if seconds is not None:
+            sweep['elapsed'][expt_row['expt']] = seconds
+    try:
+        scaling_sweep = ScalingSweep.from_config()
+    except ValueError as e:
+        # The config changed since the sweep was submitted; the runs
+        # are still reported and finished
+        return f'No scaling report: {e}\n'
+    report = ''
+    for scale_base_dir, sweep in sorted(sweeps.items()):
+        job_row = store.job(sweep['job_id'])
+        if job_row:
+            report += f'{job_row["compiler"]}: '
+        report += scaling_sweep.report(scale_base_dir,
+                                       sweep['elapsed']) + '\n'
+    return report
+
+
+def get_pull(ghinterface_obj, pulls, pr_repo, pr_num):
+    ''' PyGithub PR object, looked up once per pass and kept in pulls '''
+    if (pr_repo, pr_num) not in pulls:
+        # A lazy repo costs no request
+        pulls[(pr_repo, pr_num)] = ghinterface_obj.client \
+            .get_repo(pr_repo, lazy=True).get_pull(pr_num)
+    return pulls[(pr_repo, pr_num)]
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description='Report on integration tests that were not completed')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and check every --interval '
+                             'seconds instead of checking once')
+    parser.add_argument('--interval', type=int, default=900,
+                        help='seconds between checks in daemon mode')
+    args = parser.parse_args()
 
     # handle logging
     log_filename = f'ci_long_'\
@@ -57,74 +227,26 @@ def main():
                         level=logging.INFO)
     logger = logging.getLogger('MAIN')
     logger.info('Starting Script')
+    metrics = get_metrics('ci_long')
 
     # setup interface with GitHub
     logger.info('Setting up GitHub interface.')
     ghinterface_obj = GHInterface()
 
-    config = config_parser()
-
-    # Read file that has info on uncompleted tests
-
-    file_name = 'Longjob.cfg'
-    if not os.path.exists(file_name):
-        logger.info(f'Could not find {file_name}. Exiting.')
-        quit()
-
-    config.read(file_name)
-    num_sections = len(config.sections())
-    logger.info(f'Experiments running: {num_sections}')
-
-    # Words to search for in log to signal success or failure
-    complete_string = "geoflow: do shutdown..."
-    failed_string = "Force Terminated"
-    expt_done_count = 0
-
-    pr_comment = ''
-    for ci_log in config.sections():
-        logger.info(f'{ci_log}: {config[ci_log]["pr_repo"]}')
-        if os.path.exists(ci_log):
-            expt_done = False
-            expt = config[ci_log]["expt"]
-            machine = config[ci_log]["machine"]
-            pr_num = int(config[ci_log]["pr_num"])
-            issue_id = int(config[ci_log]["issue_id"])
-            repo = ghinterface_obj.client.get_repo(config[ci_log]["pr_repo"])
-            pr = repo.get_pull(pr_num)
-            with open(ci_log) as fname:
-                for line in fname:
-                    expt_string = ''
-                    if complete_string in line:
-                        expt_string = "Succeeded"
-                    else:
-                        if failed_string in line:
-                            expt_string = "Failed"
-                    if expt_string:
-                        expt_done = True
-                        newtext = f'Experiment {expt_string} '
-                        pr_comment += f'{newtext}'
-                        newtext = f'on {machine}: {expt}'
-                        pr_comment += f'{newtext}\n'
-                        if expt_string == "Failed":
-                            newtext = f'{line.rstrip()}'
-                            pr_comment += f'{newtext}\n'
-                        logger.info(f'Experiment {expt_string}: {expt}')
-            if expt_done:
-                expt_done_count = expt_done_count + 1
-                config.remove_section(ci_log)
-    logger.info(f'Experiments Completed: {str(expt_done_count)}')
-
-    if expt_done_count:
-        issue_comm = pr.get_issue_comment(id=issue_id)
-        issue_text = issue_comm.body
-        if expt_done_count == num_sections:
-            os.remove(file_name)
-            pr_comment += 'All experiments completed\n'
-        else:
-            # Write out the file with completed experiments removed
-            with open(file_name, 'w') as fname:
-                config.write(fname)
-        issue_comm.edit(issue_text + pr_comment)
+    # Experiments still tracked in a Longjob.cfg move to the database
+    store = StateStore.from_config()
+    store.import_longjob_cfg()
+
+    if args.daemon:
+        daemon = Daemon()
+        daemon.add_task('ci_long',
+                        lambda: (check_long_jobs(ghinterface_obj, store),
+                                 metrics.write_textfile()),
+                        args.interval)
+        daemon.run()
+    else:
+        check_long_jobs(ghinterface_obj, store)
+        metrics.write_textfile()
 
 
 if __name__ == '__main__':
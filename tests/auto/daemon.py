@@ -0,0 +1,74 @@
+"""
+Name: daemon.py
+Long-running event loop shared by ci_auto.py and ci_long.py.
+Replaces one-shot cron invocations: each registered task is called on
+its own cadence and the loop stops cleanly on SIGTERM or SIGINT.
+"""
+
+# Imports
+import logging
+import signal
+import threading
+import time
+
+
+class Daemon:
+    '''
+    This class runs periodic tasks until it is asked to stop
+    ...
+
+    Attributes
+    ----------
+    tasks : list
+        [name, function, interval in seconds, next run time] for each task
+    stop_event : threading.Event
+        Set by the signal handlers, or stop(), to end the loop
+    wake_event : threading.Event
+        Set by wake() or stop() to end the wait for the next task
+    '''
+
+    def __init__(self):
+        self.logger = logging.getLogger('DAEMON')
+        self.tasks = []
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+
+    def add_task(self, name, function, interval):
+        ''' Register function to be called every interval seconds '''
+        self.tasks.append([name, function, interval, 0.0])
+
+    def wake(self, name):
+        ''' Run a task now instead of at its next time, from any thread '''
+        for task in self.tasks:
+            if task[0] == name:
+                task[3] = 0.0
+        self.wake_event.set()
+
+    def stop(self, signum=None, frame=None):
+        if signum is not None:
+            self.logger.info(f'Received signal {signum}, stopping')
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def run(self):
+        ''' Call each task when it is due until stopped '''
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.logger.info('Daemon started')
+        while not self.stop_event.is_set():
+            for task in self.tasks:
+                name, function, interval, next_run = task
+                if self.stop_event.is_set() or time.time() < next_run:
+                    continue
+                task[3] = time.time() + interval
+                self.logger.info(f'Running task {name}')
+                try:
+                    function()
+                except Exception as e:
+                    # Keep the daemon alive, the next poll can recover
+                    self.logger.critical(f'Task {name} FAILED. '
+                                         f'Exception:{e}')
+            wake = min(task[3] for task in self.tasks)
+            self.wake_event.wait(max(wake - time.time(), 1))
+            self.wake_event.clear()
+        self.logger.info('Daemon stopped')
@@ -0,0 +1,364 @@
+"""
+Name: fake_github.py
+Local stand-in for the part of the GitHub API the CI uses, to run
+ci_auto.py, ci_long.py and the webhook receiver offline. Its pull
+requests come from recorded webhook deliveries (the files the receiver
+saves in webhook_record_dir, or those in webhook_payloads/); each
+delivery also updates the PR, e.g. adds its label. It answers:
+- the GraphQL open PR and PR state queries
+- GET of a repo, its open PRs and a PR
+- the labels of a PR, and their removal
+- PR comments: creation, GET and edit
+with X-RateLimit headers. With --replay it also sends the deliveries,
+signed with the webhook secret, to the receiver at --to.
+
+Point the CI at it with gh_base_url=http://127.0.0.1:<port> in
+CImachine.cfg, e.g.
+    python fake_github.py --port 8081 --replay webhook_payloads \
+        --to http://127.0.0.1:8080/
+"""
+
+# Imports
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+
+import requests
+
+from webhook import _Server, read_secret, signature
+
+RATE_LIMIT = 5000
+
+
+def load_deliveries(path):
+    ''' Recorded deliveries, {'event', 'delivery', 'payload'}, of a file
+        or of the *.json files of a directory in name order '''
+    files = sorted(glob.glob(os.path.join(path, '*.json'))) \
+        if os.path.isdir(path) else [path]
+    deliveries = []
+    for file_name in files:
+        with open(file_name) as fname:
+            deliveries.append(json.load(fname))
+    return deliveries
+
+
+def replay(deliveries, url, secret, delay=0.0, fake=None):
+    ''' POST the deliveries to a webhook receiver as GitHub would, each
+        applied to the fake API first if given. Returns the status of
+        each reply. '''
+    logger = logging.getLogger('FAKE_GITHUB/REPLAY')
+    statuses = []
+    for delivery in deliveries:
+        if fake:
+            fake.apply(delivery)
+        body = json.dumps(delivery['payload']).encode('utf8')
+        response = requests.post(url, data=body, timeout=30, headers={
+            'Content-Type': 'application/json',
+            'X-GitHub-Event': delivery['event'],
+            'X-GitHub-Delivery': delivery['delivery'],
+            'X-Hub-Signature-256': signature(secret, body)})
+        logger.info(f'{delivery["event"]} {delivery["delivery"]}: '
+                    f'{response.status_code} {response.text.strip()}')
+        statuses.append(response.status_code)
+        time.sleep(delay)
+    return statuses
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    ''' Routes one request to the server's FakeGitHub '''
+
+    def log_message(self, format, *args):
+        self.server.fake.logger.info(format % args)
+
+    def reply(self, status, data=None):
+        body = b'' if data is None else json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        fake = self.server.fake
+        for name, value in fake.rate_limit_headers(self.path).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def handle_method(self):
+        try:
+            status, data = self.server.fake.route(
+                self.command, urlparse(self.path), self.body())
+        except Exception as e:
+            self.server.fake.logger.critical(f'{self.command} {self.path} '
+                                             f'FAILED. Exception:{e}')
+            status, data = 500, {'message': str(e)}
+        self.reply(status, data)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = handle_method
+
+
+class FakeGitHub:
+    '''
+    This class keeps the fake repos and serves them over HTTP
+    ...
+
+    Attributes
+    ----------
+    host : str
+        Address to listen on
+    port : int
+        Port to listen on, 0 for any free port
+    base_url : str
+        Address of the running server, the gh_base_url of the CI
+    pulls : dict
+        Pull request objects of the payloads, by (repo, number)
+    comments : dict
+        Issue comments, by id
+    requests_served : int
+        Requests answered, each counted against the fake rate limit
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.logger = logging.getLogger('FAKE_GITHUB')
+        self.host = host
+        self.port = port
+        self.base_url = None
+        self.server = None
+        self.lock = threading.Lock()
+        self.repos = {}
+        self.pulls = {}
+        self.comments = {}
+        self.next_comment_id = 1
+        self.requests_served = 0
+        self.reset = int(time.time()) + 3600
+
+    def rate_limit_headers(self, path):
+        with self.lock:
+            self.requests_served += 1
+            used = self.requests_served
+        return {'X-RateLimit-Limit': str(RATE_LIMIT),
+                'X-RateLimit-Remaining': str(max(RATE_LIMIT - used, 0)),
+                'X-RateLimit-Used': str(used),
+                'X-RateLimit-Reset': str(self.reset),
+                'X-RateLimit-Resource':
+                    'graphql' if path == '/graphql' else 'core'}
+
+    def apply(self, delivery):
+        ''' Update the repos and PRs as the delivery says '''
+        payload = delivery['payload']
+        if delivery['event'] != 'pull_request':
+            return
+        # Copies, with the API URLs pointing at the fake once it runs
+        repo = json.loads(json.dumps(payload['repository']))
+        pull = json.loads(json.dumps(payload['pull_request']))
+        if self.base_url:
+            rewrite_urls(repo, self.base_url)
+            rewrite_urls(pull, self.base_url)
+        key = (repo['full_name'], pull['number'])
+        with self.lock:
+            self.repos[repo['full_name']] = repo
+            # The payload has the labels of the PR at the time, the
+            # new one included
+            if payload['action'] == 'labeled' and payload['label']['name'] \
+                    not in [label['name'] for label in pull['labels']]:
+                pull['labels'].append(payload['label'])
+            if payload['action'] == 'closed':
+                pull['state'] = 'closed'
+            self.pulls[key] = pull
+
+    def load(self, deliveries):
+        for delivery in deliveries:
+            self.apply(delivery)
+
+    def route(self, method, url, body):
+        ''' (status, JSON data) of a request '''
+        path = unquote(url.path).rstrip('/')
+        if method == 'POST' and path == '/graphql':
+            return 200, self.graphql(body.get('query', ''),
+                                     body.get('variables') or {})
+        match = re.match(r'/repos/([^/]+/[^/]+)(/.*)?$', path)
+        if not match:
+            return 404, {'message': 'Not Found'}
+        full_name, rest = match.group(1), match.group(2) or ''
+        with self.lock:
+            if full_name not in self.repos:
+                return 404, {'message': 'Not Found'}
+            if method == 'GET' and rest == '':
+                return 200, self.repos[full_name]
+            if method == 'GET' and rest == '/pulls':
+                query = parse_qs(url.query)
+                state = query.get('state', ['open'])[0]
+                base = query.get('base', [None])[0]
+                return 200, [pull for (name, _), pull in
+                             sorted(self.pulls.items(), reverse=True)
+                             if name == full_name and
+                             state in ['all', pull['state']] and
+                             base in [None, pull['base']['ref']]]
+            match = re.match(r'/(pulls|issues)/(\d+)(/.*)?$', rest)
+            if match and (full_name, int(match.group(2))) in self.pulls:
+                return self.route_pull(
+                    method, self.pulls[(full_name, int(match.group(2)))],
+                    match.group(3) or '', body)
+            match = re.match(r'/issues/comments/(\d+)$', rest)
+            if match and int(match.group(1)) in self.comments:
+                comment = self.comments[int(match.group(1))]
+                if method == 'PATCH':
+                    comment['body'] = body['body']
+                    comment['updated_at'] = now()
+                return 200, comment
+        return 404, {'message': 'Not Found'}
+
+    def route_pull(self, method, pull, rest, body):
+        if method == 'GET' and rest == '':
+            return 200, pull
+        if method == 'GET' and rest == '/labels':
+            return 200, pull['labels']
+        if method == 'DELETE' and rest.startswith('/labels/'):
+            name = rest[len('/labels/'):]
+            if name not in [label['name'] for label in pull['labels']]:
+                return 404, {'message': 'Label does not exist'}
+            pull['labels'] = [label for label in pull['labels']
+                              if label['name'] != name]
+            return 200, pull['labels']
+        if method == 'POST' and rest == '/comments':
+            comment_id = self.next_comment_id
+            self.next_comment_id += 1
+            url = f'{pull["url"].replace("/pulls/", "/issues/")}'
+            comment = {'id': comment_id, 'body': body['body'],
+                       'url': f'{url.rsplit("/", 1)[0]}/comments/'
+                              f'{comment_id}',
+                       'issue_url': url, 'html_url': url,
+                       'user': {'login': 'ci'},
+                       'created_at': now(), 'updated_at': now()}
+            self.comments[comment_id] = comment
+            self.logger.info(f'Comment {comment_id} on '
+                             f'#{pull["number"]}: {body["body"][:80]}')
+            return 201, comment
+        return 404, {'message': 'Not Found'}
+
+    def graphql(self, query, variables):
+        ''' Answer the open PR query and the PR state query of
+            graphql_pulls.py '''
+        with self.lock:
+            if 'pullRequests' in query:
+                full_name = f'{variables["owner"]}/{variables["name"]}'
+                nodes = [graphql_node(pull) for (name, _), pull in
+                         sorted(self.pulls.items(), reverse=True)
+                         if name == full_name and pull['state'] == 'open'
+                         and pull['base']['ref'] == variables['base']]
+                return {'data': {'repository': {'pullRequests': {
+                    'pageInfo': {'hasNextPage': False, 'endCursor': None},
+                    'nodes': nodes}}}}
+            data = {}
+            for alias, owner, name, prs in re.findall(
+                    r'(\w+): repository\(owner: "([^"]*)", name: "([^"]*)"\)'
+                    r' \{ ([^{}]*(?:\{[^{}]*\}[^{}]*)*) \}', query):
+                data[alias] = {}
+                for pr_alias, number in re.findall(
+                        r'(\w+): pullRequest\(number: (\d+)\)', prs):
+                    pull = self.pulls.get((f'{owner}/{name}', int(number)))
+                    data[alias][pr_alias] = {
+                        'state': 'MERGED' if pull.get('merged')
+                        else pull['state'].upper()} if pull else None
+            return {'data': data}
+
+    def start(self):
+        self.server = _Server((self.host, self.port), FakeGitHubHandler)
+        self.server.fake = self
+        self.port = self.server.server_address[1]
+        self.base_url = f'http://{self.host}:{self.port}'
+        # The API URLs of the payloads point at the fake
+        with self.lock:
+            for pull in self.pulls.values():
+                rewrite_urls(pull, self.base_url)
+            for repo in self.repos.values():
+                rewrite_urls(repo, self.base_url)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='fake_github', daemon=True)
+        thread.start()
+        self.logger.info(f'Fake GitHub API on {self.base_url}')
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def rewrite_urls(data, base_url):
+    ''' Point the api.github.com URLs of a payload object at base_url '''
+    items = data.items() if isinstance(data, dict) else enumerate(data)
+    for key, value in items:
+        if isinstance(value, (dict, list)):
+            rewrite_urls(value, base_url)
+        elif isinstance(value, str) and \
+                value.startswith('https://api.github.com'):
+            data[key] = base_url + value[len('https://api.github.com'):]
+
+
+def graphql_node(pull):
+    ''' The GraphQL node of graphql_pulls.PULLS_QUERY for a REST PR '''
+    head_repo = pull['head']['repo']
+    return {'databaseId': pull['id'],
+            'number': pull['number'],
+            'maintainerCanModify': pull.get('maintainer_can_modify', False),
+            'headRefName': pull['head']['ref'],
+            'headRefOid': pull['head']['sha'],
+            'headRepository': {'name': head_repo['name'],
+                               'nameWithOwner': head_repo['full_name'],
+                               'url': head_repo['html_url']}
+            if head_repo else None,
+            'labels': {'nodes': [{'name': label['name']}
+                                 for label in pull['labels']]}}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a fake GitHub API built from recorded webhook '
+                    'deliveries, and replay them to a webhook receiver')
+    parser.add_argument('--port', type=int, default=8081,
+                        help='port of the fake API')
+    parser.add_argument('--replay', default='webhook_payloads',
+                        help='recorded delivery file or directory')
+    parser.add_argument('--to', default=None,
+                        help='webhook receiver URL to send the deliveries '
+                             'to, e.g. http://127.0.0.1:8080/')
+    parser.add_argument('--secret-file', default='webhook_secret',
+                        help='file with the webhook secret')
+    parser.add_argument('--delay', type=float, default=1.0,
+                        help='seconds between two deliveries')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    deliveries = load_deliveries(args.replay)
+    fake = FakeGitHub(port=args.port)
+    if args.to:
+        # The PRs change as their deliveries are sent
+        fake.start()
+        replay(deliveries, args.to, read_secret(args.secret_file),
+               args.delay, fake)
+    else:
+        fake.load(deliveries)
+        fake.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
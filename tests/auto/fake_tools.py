@@ -0,0 +1,396 @@
+"""
+Name: fake_tools.py
+Stand-ins for git and the Slurm commands (sbatch, sacct, squeue and
+scancel), so that bench.py can run ci_auto.py and ci_long.py end to end
+without network, compilers or a cluster. install() writes a wrapper for
+each command into a directory that goes first on PATH; the wrappers run
+    python fake_tools.py <command> <arguments>
+with their state in FAKE_TOOLS_DIR.
+
+git does what the CI asks of it and no more: a clone copies the tree in
+FAKE_GIT_TEMPLATE, fetches only print their progress, every commit
+exists and checking one out only records its SHA.
+sbatch saves the job script it reads. A job runs for FAKE_SLURM_SECONDS
+after its submission and then ends COMPLETED, or FAILED for every
+FAKE_SLURM_FAIL_EVERY-th array element. The first sacct or squeue call
+that sees an element ended runs its script, which writes the element's
+slurm.out with `fake_tools.py slurm-out`.
+"""
+
+# Imports
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+COMMANDS = ['git', 'sbatch', 'sacct', 'squeue', 'scancel']
+
+# The strings ci_auto.py and ci_long.py look for in slurm.out
+COMPLETE_STRING = 'geoflow: do shutdown...'
+FAILED_STRING = 'Force Terminated'
+
+# Options of git clone that take a value
+CLONE_VALUE_OPTIONS = ['-b', '--branch', '--reference',
+                       '--reference-if-able', '--depth', '--origin']
+
+
+def install(bin_dir, state_dir, template, slurm_seconds=30,
+            fail_every=0):
+    ''' Write the wrapper scripts into bin_dir. Returns the environment
+        the CI has to run with. '''
+    os.makedirs(bin_dir, exist_ok=True)
+    os.makedirs(os.path.join(state_dir, 'slurm'), exist_ok=True)
+    for command in COMMANDS:
+        path = os.path.join(bin_dir, command)
+        with open(path, 'w') as fname:
+            fname.write(f'#!/bin/sh\nexec "{sys.executable}" '
+                        f'"{os.path.abspath(__file__)}" {command} "$@"\n')
+        os.chmod(path, 0o755)
+    env = dict(os.environ)
+    env.update({'PATH': f'{bin_dir}{os.pathsep}{env.get("PATH", "")}',
+                'FAKE_TOOLS_DIR': state_dir,
+                'FAKE_TOOLS': os.path.abspath(__file__),
+                'FAKE_TOOLS_PYTHON': sys.executable,
+                'FAKE_GIT_TEMPLATE': template,
+                'FAKE_SLURM_SECONDS': str(slurm_seconds),
+                'FAKE_SLURM_FAIL_EVERY': str(fail_every)})
+    return env
+
+
+def progress(objects):
+    ''' The transfer summary git prints, read by gitmirror.py '''
+    print(f'Receiving objects: 100% ({objects}/{objects}), '
+          f'{objects * 0.5:.2f} KiB | 1.00 MiB/s, done.', file=sys.stderr)
+
+
+def find_git_dir(start):
+    path = os.path.abspath(start)
+    while True:
+        if os.path.isdir(os.path.join(path, '.git')):
+            return os.path.join(path, '.git')
+        if os.path.dirname(path) == path:
+            return None
+        path = os.path.dirname(path)
+
+
+def set_head(git_dir, sha):
+    with open(os.path.join(git_dir, 'FAKE_HEAD'), 'w') as fname:
+        fname.write(f'{sha}\n')
+
+
+def branch_sha(branch):
+    return hashlib.sha1(branch.encode('utf8')).hexdigest()
+
+
+def git(args):
+    git_dir = None
+    while args and args[0].startswith('--git-dir='):
+        git_dir = args.pop(0).split('=', 1)[1]
+    if not args:
+        return 1
+    command, args = args[0], args[1:]
+    if command in GIT_COMMANDS:
+        return GIT_COMMANDS[command](args)
+    git_dir = git_dir or find_git_dir(os.getcwd())
+    if git_dir is None:
+        print('fatal: not a git repository', file=sys.stderr)
+        return 128
+    if command in GIT_REPO_COMMANDS:
+        return GIT_REPO_COMMANDS[command](git_dir, args)
+    print(f'fake git: {command} is not supported', file=sys.stderr)
+    return 1
+
+
+def git_fetch(args):
+    progress(12)
+    return 0
+
+
+def git_merge_base(args):
+    # No commit of a PR is on the base branch
+    return 1
+
+
+def git_log(args):
+    # The base branch has no commits whose trees a PR commit could match
+    return 0
+
+
+def git_reset(git_dir, args):
+    sha = [arg for arg in args if not arg.startswith('-')][0]
+    set_head(git_dir, sha)
+    print(f'HEAD is now at {sha[:7]}')
+    return 0
+
+
+def git_rev_parse(git_dir, args):
+    if any(arg.endswith('^{tree}') for arg in args):
+        # Commits have no trees
+        return 1
+    with open(os.path.join(git_dir, 'FAKE_HEAD')) as fname:
+        print(fname.read().strip())
+    return 0
+
+
+def git_diff(git_dir, args):
+    # A few sources change from one commit to the next
+    for index in range(3):
+        print(f'src/file_{index}.cpp')
+    return 0
+
+
+def git_clone(args):
+    options = {}
+    positional = []
+    while args:
+        arg = args.pop(0)
+        if arg in CLONE_VALUE_OPTIONS:
+            options[arg] = args.pop(0)
+        elif arg.startswith('-'):
+            options[arg] = True
+        else:
+            positional.append(arg)
+    url = positional[0]
+    dest = positional[1] if len(positional) > 1 else \
+        re.sub(r'\.git$', '', url.rstrip('/').rsplit('/', 1)[-1])
+    if '--mirror' in options:
+        os.makedirs(dest, exist_ok=True)
+        with open(os.path.join(dest, 'HEAD'), 'w') as fname:
+            fname.write('ref: refs/heads/master\n')
+        progress(1000)
+        return 0
+    shutil.copytree(os.environ['FAKE_GIT_TEMPLATE'], dest)
+    os.makedirs(os.path.join(dest, '.git'))
+    branch = options.get('-b', options.get('--branch', 'master'))
+    set_head(os.path.join(dest, '.git'), branch_sha(branch))
+    progress(100)
+    return 0
+
+
+# Commands that need no work tree, and those that do
+GIT_COMMANDS = {'clone': git_clone, 'fetch': git_fetch,
+                'cat-file': lambda args: 0, 'clean': lambda args: 0,
+                'merge-base': git_merge_base, 'log': git_log}
+GIT_REPO_COMMANDS = {'reset': git_reset, 'rev-parse': git_rev_parse,
+                     'diff': git_diff}
+
+
+def slurm_dir():
+    return os.path.join(os.environ['FAKE_TOOLS_DIR'], 'slurm')
+
+
+@contextlib.contextmanager
+def locked(path):
+    ''' Hold the lock of a state file; the CI runs several Slurm commands
+        at the same time '''
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def load_job(job_id):
+    try:
+        with open(os.path.join(slurm_dir(), f'{job_id}.json')) as fname:
+            return json.load(fname)
+    except OSError:
+        return None
+
+
+def save_job(job):
+    path = os.path.join(slurm_dir(), f'{job["id"]}.json')
+    with open(f'{path}.tmp', 'w') as fname:
+        json.dump(job, fname)
+    os.replace(f'{path}.tmp', path)
+
+
+def jobs(state_dir):
+    ''' Every job submitted to the fake Slurm of state_dir '''
+    found = []
+    for path in glob.glob(os.path.join(state_dir, 'slurm', '*.json')):
+        with open(path) as fname:
+            found.append(json.load(fname))
+    return found
+
+
+def array_elements(spec):
+    ''' Element indexes of an --array value such as 0-3,5%2 '''
+    elements = []
+    for part in spec.split('%')[0].split(','):
+        first, _, last = part.partition('-')
+        elements += range(int(first), int(last or first) + 1)
+    return elements
+
+
+def sbatch(args):
+    elements = None
+    positional = []
+    for arg in args:
+        if arg.startswith('--array='):
+            elements = array_elements(arg.split('=', 1)[1])
+        elif not arg.startswith('-'):
+            positional.append(arg)
+    if positional:
+        with open(positional[0]) as fname:
+            script = fname.read()
+    else:
+        script = sys.stdin.read()
+    with locked(os.path.join(slurm_dir(), 'next_id')):
+        try:
+            with open(os.path.join(slurm_dir(), 'next_id')) as fname:
+                job_id = int(fname.read())
+        except (OSError, ValueError):
+            job_id = 1000
+        with open(os.path.join(slurm_dir(), 'next_id'), 'w') as fname:
+            fname.write(str(job_id + 1))
+    save_job({'id': str(job_id), 'submitted': time.time(),
+              'seconds': float(os.environ.get('FAKE_SLURM_SECONDS', 30)),
+              'fail_every': int(os.environ.get('FAKE_SLURM_FAIL_EVERY', 0)),
+              'elements': elements, 'script': script,
+              'args': positional[1:], 'cwd': os.getcwd(),
+              'env': dict(os.environ), 'cancelled': [], 'ran': []})
+    print(f'Submitted batch job {job_id}')
+    return 0
+
+
+def element_ids(job):
+    if job['elements'] is None:
+        return [(job['id'], None)]
+    return [(f'{job["id"]}_{index}', index) for index in job['elements']]
+
+
+def element_state(job, index, now):
+    ''' (state, elapsed seconds) of a job or array element '''
+    elapsed = min(now - job['submitted'], job['seconds'])
+    if index in job['cancelled'] or 'all' in job['cancelled']:
+        return 'CANCELLED', elapsed
+    if elapsed < job['seconds']:
+        return 'RUNNING', elapsed
+    if job['fail_every'] and ((index or 0) + 1) % job['fail_every'] == 0:
+        return 'FAILED', elapsed
+    return 'COMPLETED', elapsed
+
+
+def clock(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:' \
+           f'{seconds % 60:02d}'
+
+
+def finish(job, index, state):
+    ''' Run the script of an element that ended, once '''
+    if state not in ['COMPLETED', 'FAILED'] or index in job['ran']:
+        return
+    env = dict(job['env'])
+    env.update({'SLURM_JOB_ID': job['id'], 'FAKE_SLURM_STATE': state})
+    if index is not None:
+        env.update({'SLURM_ARRAY_JOB_ID': job['id'],
+                    'SLURM_ARRAY_TASK_ID': str(index)})
+    os.makedirs(os.path.join(slurm_dir(), 'scripts'), exist_ok=True)
+    script = os.path.join(slurm_dir(), 'scripts', f'{job["id"]}.sh')
+    with open(script, 'w') as fname:
+        fname.write(job['script'])
+    subprocess.run(['bash', script] + job['args'], cwd=job['cwd'], env=env,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    job['ran'].append(index)
+
+
+def query(job_ids, now):
+    ''' [(element id, state, elapsed seconds, submit time)] of the asked
+        jobs '''
+    found = []
+    for base_id in sorted(set(job_id.split('_')[0] for job_id in job_ids)):
+        path = os.path.join(slurm_dir(), f'{base_id}.json')
+        with locked(path):
+            job = load_job(base_id)
+            if job is None:
+                continue
+            for element_id, index in element_ids(job):
+                if element_id not in job_ids and base_id not in job_ids:
+                    continue
+                state, elapsed = element_state(job, index, now)
+                finish(job, index, state)
+                found.append((element_id, state, elapsed,
+                              job['submitted']))
+            save_job(job)
+    return found
+
+
+def job_ids_arg(args, flag):
+    return args[args.index(flag) + 1].split(',') if flag in args else []
+
+
+def sacct(args):
+    for element_id, state, elapsed, submitted in query(
+            job_ids_arg(args, '-j'), time.time()):
+        # Fake jobs start as soon as they are submitted
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S',
+                              time.localtime(submitted))
+        print(f'{element_id}|{state}|{clock(elapsed)}||{stamp}|{stamp}')
+        if state != 'RUNNING':
+            print(f'{element_id}.batch|{state}|{clock(elapsed)}|10240K|'
+                  f'{stamp}|{stamp}')
+    return 0
+
+
+def squeue(args):
+    # Only jobs still in the queue are listed
+    for element_id, state, elapsed, _ in query(job_ids_arg(args, '-j'),
+                                               time.time()):
+        if state == 'RUNNING':
+            print(f'{element_id}|{state}|{clock(elapsed)}')
+    return 0
+
+
+def scancel(args):
+    status = 0
+    for job_id in [arg for arg in args if not arg.startswith('-')]:
+        base_id, _, index = job_id.partition('_')
+        path = os.path.join(slurm_dir(), f'{base_id}.json')
+        with locked(path):
+            job = load_job(base_id)
+            if job is None:
+                print(f'scancel: error: Invalid job id {job_id}',
+                      file=sys.stderr)
+                status = 1
+                continue
+            job['cancelled'].append(int(index) if index else 'all')
+            save_job(job)
+    return status
+
+
+def slurm_out(args):
+    ''' Write the output of a fake experiment, ending as its Slurm state
+        says '''
+    path = args[0]
+    lines = int(os.environ.get('FAKE_SLURM_OUT_LINES', 200))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fname:
+        fname.write(f'geoflow: job {os.environ.get("SLURM_JOB_ID")} '
+                    'starting\n')
+        for step in range(lines):
+            fname.write(f'geoflow: step {step} t={step * 0.01:.2f} '
+                        f'dt=0.01\n')
+        if os.environ.get('FAKE_SLURM_STATE') == 'FAILED':
+            fname.write(f'{FAILED_STRING}\n')
+        else:
+            fname.write(f'{COMPLETE_STRING}\n')
+    return 0
+
+
+def main():
+    command, args = sys.argv[1], sys.argv[2:]
+    handlers = {'git': git, 'sbatch': sbatch, 'sacct': sacct,
+                'squeue': squeue, 'scancel': scancel,
+                'slurm-out': slurm_out}
+    sys.exit(handlers[command](args))
+
+
+if __name__ == '__main__':
+    main()
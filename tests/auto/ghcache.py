@@ -0,0 +1,234 @@
+"""
+Name: ghcache.py
+On-disk HTTP response cache for GitHub API GET requests.
+Responses are stored with their ETag / Last-Modified headers and later
+requests for the same URL are sent as conditional requests. A 304 reply
+is answered from the cache; GitHub does not count it against the rate
+limit. Entries are evicted by age (ttl) and by total size, oldest first.
+"""
+
+# Imports
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from configparser import ConfigParser as config_parser
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from metrics import count
+
+
+class ResponseCache:
+    '''
+    This class stores GitHub API responses on disk, one file per URL
+    ...
+
+    Attributes
+    ----------
+    cache_dir : str
+        Directory holding the cached responses
+    ttl : int
+        Seconds after its last use that an entry is evicted
+    max_bytes : int
+        Total size of the cache that eviction keeps below
+    stats : dict
+        hit/miss/store/evict counters since the last log_stats()
+    '''
+
+    def __init__(self, cache_dir, ttl=86400, max_bytes=100 * 1024 * 1024):
+        self.logger = logging.getLogger('GHCACHE')
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(['hit', 'miss', 'store', 'evict'], 0)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, file_name='CImachine.cfg'):
+        ''' Build the cache from the optional ghcache_* entries
+            of the machine config file '''
+        config = config_parser()
+        config.read(file_name)
+        return cls(config['DEFAULT'].get('ghcache_dir', fallback='ghcache'),
+                   config['DEFAULT'].getint('ghcache_ttl', fallback=86400),
+                   config['DEFAULT'].getint('ghcache_max_mb', fallback=100)
+                   * 1024 * 1024)
+
+    def _path(self, url, accept):
+        key = hashlib.sha256(f'{url} {accept}'.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+        count('ci_github_cache_total', result=name)
+
+    def get(self, url, accept):
+        ''' Return the cached entry for url, or None '''
+        path = self._path(url, accept)
+        try:
+            with open(path) as fname:
+                entry = json.load(fname)
+        except (OSError, ValueError):
+            return None
+        if time.time() - os.path.getmtime(path) > self.ttl:
+            return None
+        return entry
+
+    def touch(self, url, accept):
+        ''' Mark an entry as recently used for eviction '''
+        try:
+            os.utime(self._path(url, accept))
+        except OSError:
+            pass
+
+    def store(self, url, accept, response):
+        entry = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'headers': dict(response.headers),
+            'content': base64.b64encode(response.content).decode('ascii'),
+        }
+        path = self._path(url, accept)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp_path, 'w') as fname:
+            json.dump(entry, fname)
+        os.replace(tmp_path, path)
+        self.count('store')
+
+    def evict(self):
+        ''' Remove expired entries, then the least recently used ones
+            until the cache fits in max_bytes '''
+        now = time.time()
+        entries = []
+        with os.scandir(self.cache_dir) as scan:
+            for item in scan:
+                if not item.name.endswith('.json'):
+                    continue
+                stat = item.stat()
+                if now - stat.st_mtime > self.ttl:
+                    self._remove(item.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, item.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            self.count('evict')
+        except OSError:
+            pass
+
+    def log_stats(self):
+        ''' Evict, log the counters and start counting again '''
+        self.evict()
+        with self.lock:
+            stats, self.stats = self.stats, dict.fromkeys(self.stats, 0)
+        lookups = stats['hit'] + stats['miss']
+        rate = 100 * stats['hit'] / lookups if lookups else 0
+        self.logger.info(f'GitHub cache hits: {stats["hit"]} '
+                         f'misses: {stats["miss"]} ({rate:.0f}% hits) '
+                         f'stored: {stats["store"]} '
+                         f'evicted: {stats["evict"]}')
+
+
+class CachingAdapter(HTTPAdapter):
+    ''' requests transport adapter that revalidates GET requests
+        against a ResponseCache '''
+
+    def __init__(self, cache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super().send(request, **kwargs)
+
+        accept = request.headers.get('Accept', '')
+        entry = self.cache.get(request.url, accept)
+        if entry:
+            if entry['etag']:
+                request.headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                request.headers['If-Modified-Since'] = entry['last_modified']
+
+        response = super().send(request, **kwargs)
+
+        if response.status_code == 304 and entry:
+            # Read the empty body so the connection goes back to the pool
+            response.content
+            self.cache.count('hit')
+            self.cache.touch(request.url, accept)
+            return self._cached_response(request, response, entry)
+        self.cache.count('miss')
+        if response.status_code == 200 and \
+           (response.headers.get('ETag') or
+                response.headers.get('Last-Modified')):
+            self.cache.store(request.url, accept, response)
+        return response
+
+    @staticmethod
+    def _cached_response(request, not_modified, entry):
+        ''' Rebuild a 200 response from the cache entry, keeping the
+            fresh rate limit headers of the 304 reply '''
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        for header, value in not_modified.headers.items():
+            if header.lower().startswith('x-ratelimit'):
+                response.headers[header] = value
+        response._content = base64.b64decode(entry['content'])
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        return response
+
+
+_installed_cache = None
+
+
+def install_cache(cache, adapter=None):
+    ''' Route PyGithub's requests through one shared session that
+        uses the cache, through adapter if given (a CachingAdapter of
+        cache). Only the first call in a process has an effect. '''
+    global _installed_cache
+    if _installed_cache is not None:
+        return _installed_cache
+
+    from github.Requester import Requester, HTTPRequestsConnectionClass, \
+        HTTPSRequestsConnectionClass
+
+    session = requests.Session()
+    adapter = adapter or CachingAdapter(cache)
+    # http for a local fake_github.py
+    for prefix in ['https://', 'http://']:
+        session.mount(prefix, adapter)
+
+    class CachingHTTPSConnectionClass(HTTPSRequestsConnectionClass):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.session = session
+
+    class CachingHTTPConnectionClass(HTTPRequestsConnectionClass):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.session = session
+
+    Requester.injectConnectionClasses(CachingHTTPConnectionClass,
+                                      CachingHTTPSConnectionClass)
+    _installed_cache = cache
+    return cache
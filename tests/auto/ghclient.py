@@ -0,0 +1,382 @@
+"""
+Name: ghclient.py
+GitHub connection shared by ci_auto.py and ci_long.py. Every request,
+PyGithub's and the GraphQL queries, goes through a transport adapter
+that:
+- meters requests against the X-RateLimit-Remaining of their resource,
+  holding back all but label changes when it drops to gh_reserve and
+  everything when it is used up, until the limit resets
+- retries rate limited replies (403/429, primary or secondary limit)
+  after Retry-After or the reset time, and server errors and dropped
+  connections of reads and label removals, with jittered exponential
+  backoff
+- sends writes one at a time, gh_write_interval seconds apart as GitHub
+  asks, label changes first, then new comments, then comment edits
+- counts requests and rate limit points used, logged with log_stats()
+"""
+
+# Imports
+import contextlib
+import heapq
+import itertools
+import logging
+import os
+import random
+import stat
+import threading
+import time
+from configparser import ConfigParser as config_parser
+from urllib.parse import urlparse
+
+import requests
+from github import Github as gh
+from requests.adapters import HTTPAdapter
+
+from ghcache import CachingAdapter, ResponseCache, install_cache
+from metrics import count, observe
+
+# Priorities of writes, lowest first
+LABEL, COMMENT, EDIT = 0, 1, 2
+
+RETRY_STATUS = [500, 502, 503, 504]
+
+DEFAULT_BASE_URL = 'https://api.github.com'
+
+
+def write_priority(request):
+    ''' Priority of a request that changes something on GitHub, None
+        for reads (GraphQL queries included) '''
+    path = urlparse(request.url).path
+    if request.method in ['GET', 'HEAD'] or path == '/graphql':
+        return None
+    if '/labels' in path:
+        return LABEL
+    if request.method == 'POST' and path.endswith('/comments'):
+        return COMMENT
+    return EDIT
+
+
+def can_resend(request):
+    ''' Whether a request that may have been done can be sent again:
+        reads, and label removals, which leave the same labels when done
+        twice '''
+    return write_priority(request) is None or request.method == 'DELETE'
+
+
+def resource_of(request):
+    return 'graphql' if urlparse(request.url).path == '/graphql' \
+        else 'core'
+
+
+class PriorityGate:
+    ''' Lets one caller through at a time, lowest priority value first,
+        at least interval seconds apart '''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.tickets = itertools.count()
+        self.busy = False
+        self.last = 0.0
+
+    @contextlib.contextmanager
+    def turn(self, priority):
+        with self.cond:
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, ticket)
+            while self.busy or self.waiting[0] != ticket:
+                self.cond.wait()
+            heapq.heappop(self.waiting)
+            self.busy = True
+            wait = self.last + self.interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.busy = False
+                self.last = time.time()
+                self.cond.notify_all()
+
+
+class RateLimiter:
+    '''
+    This class keeps track of the GitHub rate limits and decides when
+    requests wait or are retried
+    ...
+
+    Attributes
+    ----------
+    reserve : int
+        Remaining requests kept for label changes
+    max_retries : int
+        Retries of a request before its reply is passed on
+    backoff : float
+        Seconds of the first backoff, doubled at every retry
+    backoff_max : float
+        Longest wait before a retry or for a rate limit reset
+    gate : PriorityGate
+        Orders the writes
+    limits : dict
+        Last seen (remaining, reset time, used) of each resource
+    stats : dict
+        Counters since the last log_stats()
+    '''
+
+    def __init__(self, reserve=100, max_retries=5, backoff=2.0,
+                 backoff_max=300.0, write_interval=1.0):
+        self.logger = logging.getLogger('GHCLIENT')
+        self.reserve = reserve
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.gate = PriorityGate(write_interval)
+        self.lock = threading.Lock()
+        self.limits = {}
+        self.stats = self._new_stats()
+
+    @staticmethod
+    def _new_stats():
+        return {'requests': 0, 'writes': 0, 'not_modified': 0,
+                'retries': 0, 'waited': 0.0, 'used': {}}
+
+    @classmethod
+    def from_config(cls, file_name='CImachine.cfg'):
+        ''' Build the limiter from the optional gh_* entries of the
+            machine config file '''
+        config = config_parser()
+        config.read(file_name)
+        return cls(config['DEFAULT'].getint('gh_reserve', fallback=100),
+                   config['DEFAULT'].getint('gh_max_retries', fallback=5),
+                   config['DEFAULT'].getfloat('gh_backoff', fallback=2.0),
+                   config['DEFAULT'].getfloat('gh_backoff_max',
+                                              fallback=300.0),
+                   config['DEFAULT'].getfloat('gh_write_interval',
+                                              fallback=1.0))
+
+    def sleep(self, seconds, why):
+        self.logger.info(f'Waiting {seconds:.1f} s: {why}')
+        with self.lock:
+            self.stats['waited'] += seconds
+        time.sleep(seconds)
+
+    def wait_for_budget(self, resource, priority):
+        ''' Hold the request back while its resource is used up, or down
+            to the reserve for anything but a label change '''
+        with self.lock:
+            remaining, reset, _ = self.limits.get(resource, (None, 0, 0))
+        if remaining is None or time.time() >= reset:
+            return
+        floor = 0 if priority == LABEL else self.reserve
+        if remaining <= floor:
+            self.sleep(min(reset - time.time() + 1, self.backoff_max),
+                       f'{remaining} {resource} requests left until reset')
+
+    def observe(self, request, response):
+        ''' Count a reply and read its rate limit headers '''
+        headers = response.headers
+        resource = headers.get('X-RateLimit-Resource',
+                               resource_of(request))
+        with self.lock:
+            self.stats['requests'] += 1
+            if response.status_code == 304:
+                self.stats['not_modified'] += 1
+            if write_priority(request) is not None:
+                self.stats['writes'] += 1
+            try:
+                remaining = int(headers['X-RateLimit-Remaining'])
+                reset = int(headers['X-RateLimit-Reset'])
+                used = int(headers.get('X-RateLimit-Used', 0))
+            except (KeyError, ValueError):
+                return
+            _, old_reset, old_used = self.limits.get(resource,
+                                                     (None, 0, 0))
+            # Points used by this token, by any process, since the last
+            # reply in the same rate limit window
+            if reset == old_reset and used > old_used:
+                self.stats['used'][resource] = \
+                    self.stats['used'].get(resource, 0) + used - old_used
+            self.limits[resource] = (remaining, reset, used)
+
+    def retry_delay(self, request, response, attempt):
+        ''' Seconds to wait before sending the request again, or None to
+            pass the reply on '''
+        if attempt >= self.max_retries:
+            return None
+        status = response.status_code
+        headers = response.headers
+        if status == 429 or (status == 403 and (
+                headers.get('X-RateLimit-Remaining') == '0' or
+                'Retry-After' in headers or
+                b'rate limit' in response.content.lower())):
+            # A rate limited request was not processed and can be resent
+            if 'Retry-After' in headers:
+                try:
+                    return min(float(headers['Retry-After']),
+                               self.backoff_max)
+                except ValueError:
+                    pass
+            if headers.get('X-RateLimit-Remaining') == '0':
+                try:
+                    return min(max(int(headers['X-RateLimit-Reset']) -
+                                   time.time() + 1, 1), self.backoff_max)
+                except (KeyError, ValueError):
+                    pass
+            return self.jitter(attempt)
+        if status in RETRY_STATUS and can_resend(request):
+            return self.jitter(attempt)
+        return None
+
+    def jitter(self, attempt):
+        delay = min(self.backoff * 2 ** attempt, self.backoff_max)
+        return delay * random.uniform(0.5, 1.5)
+
+    def log_stats(self):
+        ''' Log the API cost since the last call and start counting
+            again '''
+        with self.lock:
+            stats, self.stats = self.stats, self._new_stats()
+            limits = dict(self.limits)
+        used = ', '.join(f'{resource} {points}' for resource, points
+                         in sorted(stats['used'].items())) or 'none seen'
+        left = ', '.join(f'{resource} {remaining}' for resource,
+                         (remaining, _, _) in sorted(limits.items()))
+        self.logger.info(f'GitHub API requests: {stats["requests"]} '
+                         f'(writes: {stats["writes"]}, '
+                         f'not modified: {stats["not_modified"]}, '
+                         f'retries: {stats["retries"]}, '
+                         f'waited: {stats["waited"]:.1f} s), '
+                         f'rate limit points used: {used}, '
+                         f'remaining: {left}')
+        return stats
+
+
+class RateLimitAdapter(HTTPAdapter):
+    ''' requests transport adapter that sends through a RateLimiter '''
+
+    def __init__(self, limiter, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+
+    def send(self, request, **kwargs):
+        priority = write_priority(request)
+        if priority is None:
+            return self._send(request, priority, **kwargs)
+        with self.limiter.gate.turn(priority):
+            return self._send(request, priority, **kwargs)
+
+    def _send(self, request, priority, **kwargs):
+        limiter = self.limiter
+        attempt = 0
+        resource = resource_of(request)
+        while True:
+            limiter.wait_for_budget(resource, priority)
+            start = time.time()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                count('ci_github_requests_total', method=request.method,
+                      resource=resource, status='error')
+                # A write other than a label removal may have been done
+                if not can_resend(request) or \
+                        attempt >= limiter.max_retries:
+                    raise
+                delay = limiter.jitter(attempt)
+                why = f'{request.method} {request.url} failed: {e}'
+            else:
+                observe('ci_github_request_seconds', time.time() - start,
+                        method=request.method, resource=resource)
+                count('ci_github_requests_total', method=request.method,
+                      resource=resource, status=response.status_code)
+                limiter.observe(request, response)
+                delay = limiter.retry_delay(request, response, attempt)
+                if delay is None:
+                    return response
+                why = f'{request.method} {request.url} got ' \
+                      f'{response.status_code}'
+                # Read the body so the connection goes back to the pool
+                response.content
+            with limiter.lock:
+                limiter.stats['retries'] += 1
+            count('ci_github_retries_total', resource=resource)
+            attempt += 1
+            limiter.sleep(delay, f'{why}, retry {attempt}')
+
+
+class RateLimitCachingAdapter(CachingAdapter, RateLimitAdapter):
+    ''' Cache lookups first, requests that reach GitHub rate limited '''
+
+    def __init__(self, cache, limiter, **kwargs):
+        RateLimitAdapter.__init__(self, limiter, **kwargs)
+        self.cache = cache
+
+
+class GHInterface:
+    '''
+    This class stores information for communicating with GitHub
+    ...
+
+    Attributes
+    ----------
+    GHACCESSTOKEN : str
+      API token to authenticate with GitHub
+    client : pyGitHub communication object
+      The connection to GitHub to make API requests
+    cache : ResponseCache
+      On-disk cache that answers unchanged GET requests
+    limiter : RateLimiter
+      Rate limit accounting of all requests
+    session : requests.Session
+      Authenticated session for GitHub GraphQL queries
+    base_url : str
+      GitHub API address, gh_base_url in the machine config file, e.g.
+      the local fake_github.py server for offline testing
+    graphql_url : str
+      GraphQL endpoint of the API
+    '''
+
+    def __init__(self, file_name='CImachine.cfg'):
+        self.logger = logging.getLogger('GHINTERFACE')
+        config = config_parser()
+        config.read(file_name)
+        self.base_url = config['DEFAULT'].get(
+            'gh_base_url', fallback=DEFAULT_BASE_URL).rstrip('/')
+        self.graphql_url = f'{self.base_url}/graphql'
+
+        filename = 'accesstoken'
+
+        if not os.path.exists(filename):
+            raise FileNotFoundError('Cannot find file "accesstoken"')
+        # Only its owner may read the token
+        if stat.S_IMODE(os.stat(filename).st_mode) & 0o077:
+            raise Exception('File permission needs to be "600" ')
+        with open(filename) as f:
+            os.environ['ghapitoken'] = f.readline().strip('\n')
+
+        self.limiter = RateLimiter.from_config(file_name)
+        # Conditional requests for unchanged data do not use rate limit
+        cache = ResponseCache.from_config(file_name)
+        self.cache = install_cache(
+            cache, RateLimitCachingAdapter(cache, self.limiter))
+
+        try:
+            self.client = gh(os.getenv('ghapitoken'),
+                             base_url=self.base_url)
+        except Exception as e:
+            self.logger.critical(f'Exception is {e}')
+            raise(e)
+
+        self.session = requests.Session()
+        adapter = RateLimitAdapter(self.limiter)
+        # http for a local fake_github.py
+        for prefix in ['https://', 'http://']:
+            self.session.mount(prefix, adapter)
+        self.session.headers['Authorization'] = \
+            f'bearer {os.getenv("ghapitoken")}'
+
+    def log_stats(self):
+        ''' Log the cache and API cost counters since the last poll '''
+        self.cache.log_stats()
+        self.limiter.log_stats()
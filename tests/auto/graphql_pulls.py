@@ -0,0 +1,206 @@
+"""
+Name: graphql_pulls.py
+Fetches the open pull requests of a repository, with their labels and
+head information, through one GitHub GraphQL query per page of 100 PRs,
+and the states of a set of PRs, open or not, in one query.
+PRs can also be built from webhook payloads, without any query.
+The returned objects answer the attributes that Job and the job modules
+read from a PyGithub PullRequest without any further API calls.
+"""
+
+# Imports
+import json
+import logging
+
+PULLS_QUERY = '''
+query($owner: String!, $name: String!, $base: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, baseRefName: $base, first: 100,
+                 after: $cursor,
+                 orderBy: {field: CREATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        databaseId
+        number
+        maintainerCanModify
+        headRefName
+        headRefOid
+        headRepository { name nameWithOwner url }
+        labels(first: 100) { nodes { name } }
+      }
+    }
+  }
+}
+'''
+
+
+class GraphQLLabel:
+    ''' A PR label, as much of a PyGithub Label as the jobs use '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f'Label(name="{self.name}")'
+
+
+class GraphQLRepo:
+    ''' The head repository of a PR '''
+
+    def __init__(self, node):
+        self.name = node['name']
+        self.full_name = node['nameWithOwner']
+        self.html_url = node['url']
+
+
+class GraphQLHead:
+    ''' The head branch of a PR '''
+
+    def __init__(self, node):
+        self.ref = node['headRefName']
+        self.sha = node['headRefOid']
+        self.repo = GraphQLRepo(node['headRepository']) \
+            if node['headRepository'] else None
+
+
+class GraphQLPullRequest:
+    '''
+    This class stands in for a PyGithub PullRequest built from GraphQL data
+    ...
+
+    Attributes
+    ----------
+    id : int
+        REST id of the pull request
+    number : int
+        Pull request number within its repository
+    head : GraphQLHead
+        Head repository, branch and SHA
+    maintainer_can_modify : bool
+        Whether maintainers can push to the head branch
+    labels : list
+        GraphQLLabel objects, kept in step with label changes made here
+    '''
+
+    def __init__(self, ghinterface_obj, repo_address, node):
+        self.ghinterface_obj = ghinterface_obj
+        self.repo_address = repo_address
+        self.id = node['databaseId']
+        self.number = node['number']
+        self.head = GraphQLHead(node)
+        self.maintainer_can_modify = node['maintainerCanModify']
+        self.labels = [GraphQLLabel(label['name'])
+                       for label in node['labels']['nodes']]
+        self._gh_pull = None
+
+    @classmethod
+    def from_webhook(cls, ghinterface_obj, repo_address, pull):
+        ''' Build the PR from the pull_request object of a webhook
+            payload, which has the same data as the GraphQL node '''
+        head_repo = pull['head']['repo']
+        return cls(ghinterface_obj, repo_address, {
+            'databaseId': pull['id'],
+            'number': pull['number'],
+            'maintainerCanModify': pull.get('maintainer_can_modify', False),
+            'headRefName': pull['head']['ref'],
+            'headRefOid': pull['head']['sha'],
+            'headRepository': {'name': head_repo['name'],
+                               'nameWithOwner': head_repo['full_name'],
+                               'url': head_repo['html_url']}
+            if head_repo else None,
+            'labels': {'nodes': [{'name': label['name']}
+                                 for label in pull['labels']]}})
+
+    def _pull(self):
+        ''' PyGithub PullRequest, fetched only when something is written '''
+        if self._gh_pull is None:
+            repo = self.ghinterface_obj.client.get_repo(self.repo_address,
+                                                        lazy=True)
+            self._gh_pull = repo.get_pull(self.number)
+        return self._gh_pull
+
+    def get_labels(self):
+        return list(self.labels)
+
+    def refresh_labels(self):
+        ''' Fetch the current labels from GitHub '''
+        self.labels = [GraphQLLabel(label.name)
+                       for label in self._pull().get_labels()]
+        return list(self.labels)
+
+    def remove_from_labels(self, label):
+        self._pull().remove_from_labels(label.name)
+        self.labels = [old for old in self.labels if old.name != label.name]
+
+    def create_issue_comment(self, body):
+        return self._pull().create_issue_comment(body)
+
+    def get_issue_comment(self, id):
+        return self._pull().get_issue_comment(id)
+
+
+def get_open_pulls(ghinterface_obj, repo):
+    ''' Return GraphQLPullRequest objects for every open PR against
+        the repo's base branch '''
+    logger = logging.getLogger('GRAPHQL/GET_OPEN_PULLS')
+    owner, name = repo['address'].strip('/').split('/')[:2]
+    variables = {'owner': owner, 'name': name, 'base': repo['base'],
+                 'cursor': None}
+    pulls = []
+    while True:
+        response = ghinterface_obj.session.post(
+            ghinterface_obj.graphql_url,
+            json={'query': PULLS_QUERY, 'variables': variables}, timeout=60)
+        response.raise_for_status()
+        result = response.json()
+        if result.get('errors'):
+            raise Exception(f'GraphQL errors: {result["errors"]}')
+        pull_requests = result['data']['repository']['pullRequests']
+        pulls += [GraphQLPullRequest(ghinterface_obj, repo['address'], node)
+                  for node in pull_requests['nodes']]
+        if not pull_requests['pageInfo']['hasNextPage']:
+            break
+        variables['cursor'] = pull_requests['pageInfo']['endCursor']
+    logger.info(f'{repo["address"]}: {len(pulls)} open pull requests')
+    return pulls
+
+
+def get_pull_states(ghinterface_obj, pulls):
+    ''' Return {(repo address, number): state} for (repo address,
+        number) pairs, state being OPEN, CLOSED or MERGED, from one
+        GraphQL query per 100 PRs. PRs GitHub does not know are left
+        out. '''
+    logger = logging.getLogger('GRAPHQL/GET_PULL_STATES')
+    pulls = sorted(set(pulls))
+    states = {}
+    for start in range(0, len(pulls), 100):
+        by_repo = {}
+        for address, number in pulls[start:start + 100]:
+            by_repo.setdefault(address.strip('/'), []).append(number)
+        # Aliases r<i>/p<number> select each repo and PR in one query
+        fields = []
+        for index, (address, numbers) in enumerate(by_repo.items()):
+            owner, name = address.split('/')[:2]
+            prs = ' '.join(f'p{number}: pullRequest(number: {number}) '
+                           '{ state }' for number in numbers)
+            fields.append(f'r{index}: repository(owner: {json.dumps(owner)}, '
+                          f'name: {json.dumps(name)}) {{ {prs} }}')
+        response = ghinterface_obj.session.post(
+            ghinterface_obj.graphql_url,
+            json={'query': f'query {{ {" ".join(fields)} }}'}, timeout=60)
+        response.raise_for_status()
+        result = response.json()
+        # A PR that no longer exists is an error, but the others are
+        # still answered
+        data = result.get('data') or {}
+        if result.get('errors') and not data:
+            raise Exception(f'GraphQL errors: {result["errors"]}')
+        for index, (address, numbers) in enumerate(by_repo.items()):
+            repository = data.get(f'r{index}') or {}
+            for number in numbers:
+                pull = repository.get(f'p{number}')
+                if pull:
+                    states[(address, number)] = pull['state']
+    logger.info(f'States of {len(pulls)} pull requests: '
+                f'{len(states)} found')
+    return states
@@ -1,95 +1,59 @@
 """
 Name: build.py
-Python to clone and build a repo and if requested run Integration tests.
+Python to check out and build a repo and if requested run Integration tests.
 """
 
 # Imports
-import datetime
+import glob
 import logging
-import time
 import os
-from configparser import ConfigParser as config_parser
+import re
+import shutil
 
+from baseline import BaselineComparator
+from jobs.buildcache import BuildCache
+from jobs.checkout import Checkout, pr_dir
+from jobs.scale import ScalingSweep
+from logwatch import LogWatcher
+from metrics import count, event, experiment, span
+from perf import PerfTracker
+from slurm import cancel_jobs, elapsed_seconds, format_job, is_terminal, \
+    parse_job_id, query_jobs
+
+# Words to search for in the log to signal success or failure
+COMPLETE_STRING = 'geoflow: do shutdown...'
+FAILED_STRING = 'Force Terminated'
 
 def run(job_obj):
     """
     Runs a CI test for a PR
     """
+    # Jobs of the same PR share a working tree, each compiler builds in
+    # its own directory of it
+    with Checkout(job_obj) as checkout:
+        run_in_checkout(job_obj, checkout)
+
+
+def run_in_checkout(job_obj, checkout):
     logger = logging.getLogger('BUILD/RUN')
-    pr_repo_loc, repo_dir_str = clone_pr_repo(job_obj, job_obj.workdir)
-    build_script_loc = pr_repo_loc + '/GeoFLOW/ci_tests'
-    log_name = 'build.out'
-    # passing in machine for build
-    create_build_commands = [[f'./build.sh >& {log_name}',
-                             build_script_loc]]
-    logger.info('Running test build script')
-    job_obj.run_commands(logger, create_build_commands)
-    # Read the build log to see whether it succeeded
-    build_success = post_process(job_obj, build_script_loc, log_name,
-                                 pr_repo_loc)
+    head_sha = checkout.update()
+    job_obj.comment_append(f'Repo location: {checkout.path}')
+    if checkout.changed_files is not None:
+        job_obj.comment_append(f'{len(checkout.changed_files)} files '
+                               f'changed since the last {job_obj.compiler} '
+                               'build in this tree')
+    job_obj.store.set_job_sha(job_obj.job_id, head_sha)
+    if job_obj.preq_dict['action'] in ['int', 'scale']:
+        # Tests of an older commit still running only use the allocation
+        supersede_older_tests(job_obj, head_sha)
+    build_success = build(job_obj, checkout, head_sha)
     logger.info('After build post-processing')
     logger.info(f'Action: {job_obj.preq_dict["action"]}')
     # Comments have not yet been written
     issue_id = 0
     if build_success:
         job_obj.comment_append('Build was Successful')
-        if job_obj.preq_dict["action"] == 'int':
-            # See if a previous job on same PR is still running
-            cfg_file = 'Longjob.cfg'
-            # See if there are any tests already running for this PR
-            if os.path.exists(cfg_file):
-                config = config_parser()
-                config.read(cfg_file)
-                num_sections = len(config.sections())
-                num_tests = 0
-                # Remove any older tests with the same PR ID
-                for ci_log in config.sections():
-                    if str(job_obj.preq_dict["preq"].id) in ci_log:
-                        num_tests = num_tests + 1
-                        config.remove_section(ci_log)
-                # If those were the only tests, delete the file
-                if num_sections == num_tests:
-                    os.remove(cfg_file)
-                    # Still need to remove cron jobs and maybe output dirs
-                    # Maybe write a message to PR (older issue id)
-
-            # Set directories to submit integration_tests script
-            # To expand number of integration tests, create a directory containing input.jsn files for each test in GeoFLOW repo,
-            # then create a python list of tests based on that directory in GeoFLOW to iterate over 
-            expt_script_loc = os.path.join(pr_repo_loc, 'GeoFLOW/ci_tests/integration_tests')
-            expts_base_dir = os.path.join(expt_script_loc, 'expt_dirs')
-            run_dir = os.path.join(expts_base_dir, 'test_inertgrav2d')
-            integration_script = expt_script_loc + '/integration_tests.sh'
-            input_json = pr_repo_loc + '/GeoFLOW/ci_tests/test_inertgrav2d.jsn'
-            geoflow_cdg = pr_repo_loc + '/GeoFLOW/build/bin/geoflow_cdg'
-            log_name = 'integration_test.out'
-            # To expand the number integration tests, iterate over a list of them, replacing {run_dir} with a path for each test
-            # Submit integration_tests.sh script
-            if os.path.exists(integration_script):
-                logger.info('Creating expt_dirs')
-                create_expt_dir_commands = \
-                    [[f'mkdir -p "{run_dir}"', os.getcwd()]]
-                job_obj.run_commands(logger, create_expt_dir_commands)
-                logger.info('Running integration test')
-                create_expt_commands = \
-                    [[f'bash integration_tests.sh {run_dir} {geoflow_cdg} {input_json} >&'
-                      f'{log_name}', expt_script_loc]]
-                job_obj.run_commands(logger, create_expt_commands)
-                logger.info('After integration_tests script')
-                 
-                # no experiment dir or no test dirs in it suggests error
-                if os.path.exists(expts_base_dir) and len(os.listdir(expts_base_dir)):
-                    job_obj.comment_append('Integration test jobs started')
-                    # If workflow running, comments will be written
-                    issue_id = process_expt(job_obj, expts_base_dir)
-                else:
-                    setup_log = os.path.join(expt_script_loc, log_name)
-                    if os.path.exists(setup_log):
-                        process_setup(job_obj, setup_log)
-            else:
-                job_obj.comment_append(f'Script {integration_script} '
-                                       'does not exist in repo')
-                job_obj.comment_append('Cannot run Integration tests')
+        issue_id = launch_tests(job_obj, checkout)
     else:
         job_obj.comment_append('Build Failed')
 
@@ -99,42 +63,298 @@ def run(job_obj):
         logger.debug(f'Issue comment id is {issue_id}')
 
 
-def clone_pr_repo(job_obj, workdir):
-    ''' clone the GitHub pull request repo, via command line '''
-   
-    logger = logging.getLogger('BUILD/CLONE_PR_REPO')
+def build(job_obj, checkout, head_sha):
+    ''' Build the tree in the compiler's build directory, or reuse an
+        identical earlier build from the build cache. Returns whether
+        the build succeeded. '''
+    build_script_loc = checkout.path + '/GeoFLOW/ci_tests'
+    # Builds of other compilers run in the same tree at the same time
+    log_name = f'build_{job_obj.compiler}.out'
+    build_log = os.path.join(build_script_loc, log_name)
+    geoflow_cdg = os.path.join(checkout.build_loc, 'bin', 'geoflow_cdg')
+
+    # Reuse an identical earlier build if there is one
+    build_cache = BuildCache(os.path.join(job_obj.workdir, 'build_cache'),
+                             job_obj.build_cache_mb * 1024 * 1024)
+    cache_key = BuildCache.key(head_sha, job_obj.machine, job_obj.compiler,
+                               os.path.join(build_script_loc, 'build.sh'))
+    cache_hit = build_cache.fetch(cache_key, geoflow_cdg, build_log)
+    if cache_hit:
+        event('build_cache', result='hit')
+        job_obj.comment_append(f'Reusing earlier build of {head_sha}')
+    else:
+        run_build(job_obj, checkout, build_script_loc, log_name,
+                  geoflow_cdg)
+    # Read the build log to see whether it succeeded
+    build_success = post_process(job_obj, build_script_loc, log_name,
+                                 geoflow_cdg)
+    build_cache.store(cache_key, geoflow_cdg, build_log)
+    if build_success and not cache_hit:
+        # A cached executable leaves the build directory as it was
+        checkout.built(head_sha)
+    return build_success
+
+
+def run_build(job_obj, checkout, build_script_loc, log_name, geoflow_cdg):
+    ''' Run build.sh on the files changed since the last build in the
+        compiler's build directory '''
+    logger = logging.getLogger('BUILD/RUN_BUILD')
+    pr_repo_loc = checkout.path
+    changed_files = checkout.changed_files
+    # passing in machine for build
+    stats_log = os.path.join(pr_repo_loc,
+                             f'ccache_stats_{job_obj.compiler}.log')
+    changed_list = None
+    if changed_files is not None:
+        changed_list = os.path.join(
+            pr_repo_loc, f'changed_files_{job_obj.compiler}.txt')
+        with open(changed_list, 'w') as fname:
+            fname.writelines(f'{name}\n' for name in changed_files)
+    # The build directory is kept between commits, so an executable
+    # from an earlier build must not count as this build's
+    for old_file in [geoflow_cdg, stats_log]:
+        if os.path.exists(old_file):
+            os.remove(old_file)
+    env = build_env(job_obj, pr_repo_loc, checkout.build_loc, stats_log,
+                    changed_list)
+    create_build_commands = [
+        [f'{env} ./build.sh >& {log_name}', build_script_loc,
+         job_obj.build_timeout]]
+    logger.info('Running test build script')
+    with span('build') as fields:
+        # A failed build is reported by post_process
+        job_obj.run_commands(logger, create_build_commands, check=False)
+        fields['changed_files'] = len(changed_files) \
+            if changed_files is not None else None
+    if os.path.exists(stats_log):
+        hits, misses = ccache_stats(stats_log)
+        event('ccache', hits=hits, misses=misses)
+        rate = 100 * hits / (hits + misses) if hits + misses else 0
+        job_obj.comment_append(f'Compiler cache: {hits} hits, '
+                               f'{misses} misses ({rate:.0f}% hits)')
+
+
+def launch_tests(job_obj, checkout):
+    ''' Start the tests of an int or scale job on the built executable.
+        Returns the id of the PR comment if it was already written. '''
+    if job_obj.preq_dict['action'] not in ['int', 'scale']:
+        return 0
+    # Tests run from a copy, the next job may update the tree before
+    # they are done
+    pr_repo_loc = checkout.snapshot()
+    job_obj.run_locs.append(pr_repo_loc)
+    geoflow_cdg = pr_repo_loc + '/GeoFLOW/build/bin/geoflow_cdg'
+    job_obj.comment_append(f'Test location: {pr_repo_loc}')
+    if job_obj.preq_dict['action'] == 'int':
+        return run_integration_tests(job_obj, pr_repo_loc, geoflow_cdg)
+    return run_scaling_sweep(job_obj, pr_repo_loc, geoflow_cdg)
+
+
+def run_integration_tests(job_obj, pr_repo_loc, geoflow_cdg):
+    ''' Submit every *.jsn test under ci_tests in one Slurm job array,
+        each test with its own run directory, and wait for them '''
+    logger = logging.getLogger('BUILD/RUN_INTEGRATION_TESTS')
+    ci_tests_loc = os.path.join(pr_repo_loc, 'GeoFLOW/ci_tests')
+    expt_script_loc = os.path.join(ci_tests_loc, 'integration_tests')
+    expts_base_dir = os.path.join(expt_script_loc, 'expt_dirs')
+    integration_script = expt_script_loc + '/integration_tests.sh'
+    tests = find_tests(ci_tests_loc)
+    logger.info(f'Integration tests: {[name for name, _ in tests]}')
+    if not tests:
+        job_obj.comment_append(f'No *.jsn tests found in {ci_tests_loc}')
+        job_obj.comment_append('Cannot run Integration tests')
+        return 0
+    if not os.path.exists(integration_script):
+        job_obj.comment_append(f'Script {integration_script} '
+                               'does not exist in repo')
+        job_obj.comment_append('Cannot run Integration tests')
+        return 0
+
+    array_id, slurm_ids, setup_log = submit_tests(
+        job_obj, expt_script_loc, expts_base_dir, geoflow_cdg, tests)
+    if not array_id:
+        if os.path.exists(setup_log):
+            process_setup(job_obj, setup_log)
+        return 0
+    job_obj.comment_append(f'Integration test jobs started: '
+                           f'{len(tests)} tests in Slurm '
+                           f'job array {array_id}')
+    # If workflow running, comments will be written
+    with span('expt_wait'):
+        return process_expt(job_obj, expts_base_dir, slurm_ids)
+
+
+def submit_tests(job_obj, expt_script_loc, expts_base_dir, geoflow_cdg,
+                 tests):
+    ''' Create the run directories and submit the tests as one Slurm job
+        array. Returns the array's job ID, {test name: array element ID}
+        and the log of the submission. '''
+    logger = logging.getLogger('BUILD/SUBMIT_TESTS')
+    test_list = os.path.join(expt_script_loc, 'tests.list')
+    log_name = 'integration_test.out'
+    logger.info('Creating expt_dirs')
+    run_dirs = ' '.join(f'"{os.path.join(expts_base_dir, name)}"'
+                        for name, _ in tests)
+    create_expt_dir_commands = [[f'mkdir -p {run_dirs}', os.getcwd()]]
+    job_obj.run_commands(logger, create_expt_dir_commands)
+    with open(test_list, 'w') as fname:
+        for name, input_json in tests:
+            fname.write(f'{name} {input_json}\n')
+    logger.info('Running integration test')
+    create_expt_commands = \
+        [[f'bash integration_tests.sh --array {expts_base_dir} '
+          f'{geoflow_cdg} {test_list} >& {log_name}', expt_script_loc]]
+    with span('slurm_submit') as fields:
+        # A failed submission is reported by process_setup
+        job_obj.run_commands(logger, create_expt_commands, check=False)
+        logger.info('After integration_tests script')
+        setup_log = os.path.join(expt_script_loc, log_name)
+        # Array element N runs the test on line N+1 of the list
+        array_id = parse_job_id(setup_log)
+        slurm_ids = {name: f'{array_id}_{index}'
+                     for index, (name, _) in enumerate(tests)} \
+            if array_id else {}
+        fields['slurm_jobs'] = len(slurm_ids)
+    count('ci_slurm_jobs_submitted_total', len(slurm_ids))
+    logger.info(f'Slurm job IDs: {slurm_ids}')
+    job_obj.slurm_ids += slurm_ids.values()
+    return array_id, slurm_ids, setup_log
+
+
+def run_scaling_sweep(job_obj, pr_repo_loc, geoflow_cdg):
+    ''' Submit one Slurm job per point of the rank/thread grid and wait
+        for them '''
+    sweep = ScalingSweep.from_config()
+    with span('slurm_submit') as fields:
+        scale_base_dir, slurm_ids = sweep.submit(job_obj, pr_repo_loc,
+                                                 geoflow_cdg)
+        fields['slurm_jobs'] = len(slurm_ids)
+    count('ci_slurm_jobs_submitted_total', len(slurm_ids))
+    job_obj.slurm_ids += slurm_ids.values()
+    if not slurm_ids:
+        job_obj.comment_append('Cannot run scaling sweep')
+        return 0
+    job_obj.comment_append(f'Scaling runs started: '
+                           f'{len(slurm_ids)} Slurm jobs')
+    # The scaling table is posted once every run is done
+    with span('expt_wait'):
+        return process_expt(
+            job_obj, scale_base_dir, slurm_ids,
+            on_complete=lambda elapsed: job_obj.comment_append(
+                sweep.report(scale_base_dir, elapsed)))
+
 
-    # These are for the new/head repo in the PR
-    new_repo = job_obj.preq_dict['preq'].head.repo.full_name
-    new_branch = job_obj.preq_dict['preq'].head.ref
-   
-    # The new repo is the default repo
-    git_url = f'https://${{ghapitoken}}@github.com/{new_repo}'
+def supersede_older_tests(job_obj, head_sha):
+    ''' Stop the experiments that jobs of the same PR and action started
+        for other commits: cancel their Slurm jobs, stop tracking them,
+        remove their test run directories and say so in their comments '''
+    logger = logging.getLogger('BUILD/SUPERSEDE_OLDER_TESTS')
+    preq = job_obj.preq_dict['preq']
+    superseded = job_obj.store.supersede_experiments(
+        job_obj.repo['address'], preq.number, job_obj.preq_dict['action'],
+        head_sha)
+    if not superseded:
+        return
+    for expt_row in superseded:
+        logger.info(f'Superseded experiment: {expt_row["log_path"]}')
+    cancel_jobs([expt_row['slurm_id'] for expt_row in superseded])
+    remove_run_locs(pr_dir(job_obj.workdir, preq.id), superseded)
+    mark_superseded(preq, superseded, head_sha)
+    job_obj.comment_append(f'Superseded {len(superseded)} experiments of '
+                           'an older commit')
 
 
-    logger.info(f'GIT URL: {git_url}')
-    logger.info(f'app branch: {new_branch}')
-    logger.info('Starting repo clone')
-    repo_dir_str = f'{workdir}/'\
-                   f'{str(job_obj.preq_dict["preq"].id)}/'\
-                   f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}'
-    pr_repo_loc = f'{repo_dir_str}'
-    job_obj.comment_append(f'Repo location: {pr_repo_loc}')
+def remove_run_locs(pr_loc, superseded):
+    ''' Remove the test run directories of superseded experiments '''
+    logger = logging.getLogger('BUILD/REMOVE_RUN_LOCS')
+    # Tests run from snapshots in <PR dir>/runs/
+    runs_dir = os.path.join(pr_loc, 'runs')
+    run_locs = set()
+    for expt_row in superseded:
+        rel_path = os.path.relpath(expt_row['log_path'], runs_dir)
+        if not rel_path.startswith(os.pardir):
+            run_locs.add(os.path.join(runs_dir, rel_path.split(os.sep)[0]))
+    for run_loc in sorted(run_locs):
+        logger.info(f'Removing {run_loc}')
+        shutil.rmtree(run_loc, ignore_errors=True)
 
-    create_repo_commands = [
-        [f'mkdir -p "{repo_dir_str}"', os.getcwd()],
-        [f'git clone -b {new_branch} {git_url}', repo_dir_str]]
-    
-    job_obj.run_commands(logger, create_repo_commands)
 
-    logger.info('Finished repo clone')
-    return pr_repo_loc, repo_dir_str
+def mark_superseded(preq, superseded, head_sha):
+    ''' Say in the comments of superseded experiments that they were
+        stopped '''
+    logger = logging.getLogger('BUILD/MARK_SUPERSEDED')
+    comments = {}
+    for expt_row in superseded:
+        if expt_row['comment_id']:
+            comments.setdefault(expt_row['comment_id'], []) \
+                .append(expt_row['expt'])
+    for comment_id, expts in comments.items():
+        try:
+            issue_comm = preq.get_issue_comment(comment_id)
+            issue_comm.edit(f'{issue_comm.body}Superseded by {head_sha}: '
+                            f'stopped {len(expts)} experiments '
+                            f'({", ".join(expts)})\n')
+        except Exception as e:
+            logger.critical(f'Marking comment {comment_id} superseded '
+                            f'FAILED. Exception:{e}')
 
 
-def post_process(job_obj, build_script_loc, log_name, pr_repo_loc):
+def find_tests(ci_tests_loc):
+    ''' (test name, input file) of every *.jsn integration test under
+        ci_tests, named after its path below ci_tests '''
+    tests = []
+    for input_json in sorted(glob.glob(os.path.join(ci_tests_loc, '**',
+                                                    '*.jsn'),
+                                       recursive=True)):
+        rel_path = os.path.relpath(input_json, ci_tests_loc)
+        # Skip the run directories and baseline outputs
+        if rel_path.split(os.sep)[0] in ['integration_tests',
+                                         'test_baselines']:
+            continue
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_',
+                      os.path.splitext(rel_path)[0])
+        tests.append((name, input_json))
+    return tests
+
+
+def build_env(job_obj, pr_repo_loc, build_loc, stats_log,
+              changed_list=None):
+    ''' Environment settings for build.sh: the build directory of the
+        compiler, make parallelism, the compiler cache shared by all
+        builds on this machine and the files changed since the last
+        build in the directory '''
+    env = f'CI_BUILD_DIR={build_loc} BUILD_JOBS={job_obj.build_jobs}'
+    if changed_list:
+        env += f' CI_CHANGED_FILES={changed_list}'
+    if job_obj.ccache_dir:
+        # Paths under the clone are hashed relative to it, so builds in
+        # different clone directories share cache entries
+        env += f' CCACHE_DIR={job_obj.ccache_dir}'            \
+               f' CCACHE_MAXSIZE={job_obj.ccache_max_gb}G'     \
+               f' CCACHE_BASEDIR={pr_repo_loc}'                \
+               ' CCACHE_NOHASHDIR=true'                       \
+               f' CCACHE_STATSLOG={stats_log}'
+    return env
+
+
+def ccache_stats(stats_log):
+    ''' Count the compiler cache hits and misses of one build from its
+        ccache stats log '''
+    hits = 0
+    misses = 0
+    with open(stats_log) as fname:
+        for line in fname:
+            line = line.strip()
+            if line in ['direct_cache_hit', 'preprocessed_cache_hit']:
+                hits = hits + 1
+            elif line == 'cache_miss':
+                misses = misses + 1
+    return hits, misses
+
+
+def post_process(job_obj, build_script_loc, log_name, geoflow_cdg):
     logger = logging.getLogger('BUILD/POST_PROCESS')
     ci_log = f'{build_script_loc}/{log_name}'
-    geoflow_cdg = pr_repo_loc + '/GeoFLOW/build/bin/geoflow_cdg'
     build_succeeded = False
 
     if os.path.exists(ci_log):
@@ -174,80 +394,144 @@ def process_setup(job_obj, setup_log):
     if setup_failed:
         raise Exception('Slurm job Submission could not complete ')
 
-def process_expt(job_obj, expts_base_dir):
+def process_expt(job_obj, expts_base_dir, slurm_ids=None,
+                 on_complete=None):
     """
     Runs after a integration test has been submitted to run one or more expts.
     Assumes that more expt directories can appear after this job has started
-    Checks for success or failure for each expt
+    Checks for success or failure for each expt, from its log and from the
+    Slurm state of its job (slurm_ids maps expt names to Slurm job IDs)
+    If all expts finish, on_complete is called with their elapsed seconds
     """
     logger = logging.getLogger('BUILD/PROCESS_EXPT')
-    expt_done = 0
     # wait time for workflow is time_mult * sleep_time seconds
     time_mult = 2
     sleep_time = 6
-    repeat_count = time_mult
-    complete_expts = []
-    expt_list = os.listdir(expts_base_dir)
-    complete_string = "geoflow: do shutdown..."
-    failed_string = "Force Terminated"
-
+    watcher = LogWatcher({'done': COMPLETE_STRING, 'failed': FAILED_STRING})
+    slurm_ids = slurm_ids or {}
+    expt_list, complete_expts, elapsed = poll_expts(
+        job_obj, expts_base_dir, slurm_ids, watcher, time_mult, sleep_time)
+    logger.info(f'Done: {len(complete_expts)} of {len(expt_list)}')
+    undone = [expt for expt in expt_list if expt not in complete_expts]
+    if undone:
+        # Saved in the state store for the long job checker
+        return track_expts(job_obj, expts_base_dir, slurm_ids, watcher,
+                           len(expt_list), undone)
+    if on_complete:
+        on_complete(elapsed)
     # Set issue id for cases where workflow does not start
-    issue_id = 0
+    return 0
 
-    while (expt_done < len(expt_list)) and repeat_count > 0:
-        time.sleep(sleep_time)
-        repeat_count = repeat_count - 1
+
+def poll_expts(job_obj, expts_base_dir, slurm_ids, watcher, passes,
+               sleep_time):
+    ''' Check the experiments every sleep_time seconds, at most passes
+        times, until all are done, and add the finished ones to the
+        comment. Returns the experiments, the finished ones and their
+        elapsed seconds. '''
+    logger = logging.getLogger('BUILD/POLL_EXPTS')
+    comparator = BaselineComparator.from_config()
+    tracker = PerfTracker.from_config(job_obj.store)
+    expt_list = os.listdir(expts_base_dir)
+    complete_expts = []
+    elapsed = {}
+    # Completed without a result in the log on an earlier pass
+    completed_no_result = set()
+    wait_cycles = 0
+    while len(complete_expts) < len(expt_list) and wait_cycles < passes:
+        job_obj.sleep(sleep_time)
+        wait_cycles = wait_cycles + 1
         expt_list = os.listdir(expts_base_dir)
         logger.info('Experiment dir after return of integration tests')
         logger.info(expt_list)
-        for expt in expt_list:
-            expt_log = os.path.join(expts_base_dir, expt, 'slurm.out')
-            if os.path.exists(expt_log) and expt not in complete_expts:
-                with open(expt_log) as fname:
-                    for line in fname:
-                        if complete_string in line:
-                            expt_done = expt_done + 1
-                            job_obj.comment_append(f'Experiment done: {expt}')
-                            job_obj.comment_append(f'{line.rstrip()}')
-                            logger.info(f'Experiment done: {expt}')
-                            complete_expts.append(expt)
-                        elif failed_string in line:
-                            expt_done = expt_done + 1
-                            job_obj.comment_append('Experiment failed: '
-                                                   f'{expt}')
-                            job_obj.comment_append(f'{line.rstrip()}')
-                            logger.info(f'Experiment failed: {expt}')
-                            complete_expts.append(expt)
-    logger.info(f'Wait Cycles completed: {time_mult - repeat_count}')
-    logger.info(f'Done: {len(complete_expts)} of {len(expt_list)}')
+        running = [expt for expt in expt_list if expt not in complete_expts]
+        # One Slurm query for all experiments still running
+        slurm_jobs = query_jobs([slurm_ids.get(expt) for expt in running])
+        for expt in running:
+            slurm_job = slurm_jobs.get(slurm_ids.get(expt))
+            if slurm_job:
+                logger.info(format_job(slurm_job))
+                seconds = elapsed_seconds(slurm_job.elapsed)
+                if seconds is not None:
+                    elapsed[expt] = seconds
+            run_dir = os.path.join(expts_base_dir, expt)
+            result = expt_result(watcher, run_dir, expt, slurm_job,
+                                 completed_no_result)
+            if result:
+                report_expt(job_obj, comparator, tracker, run_dir, expt,
+                            result, slurm_job)
+                complete_expts.append(expt)
+    logger.info(f'Wait Cycles completed: {wait_cycles}')
+    return expt_list, complete_expts, elapsed
 
-    # If not all experiments completed, writes a list in a config file
-    if len(complete_expts) < len(expt_list):
-        job_obj.comment_append(f'Long term tracking will be done'
-                               f' on {len(expt_list)} experiments')
 
-        # Write out comments so far and save issue id for later appending
-        issue_id = job_obj.send_comment_text()
-        logger.debug(f'Issue comment id is {issue_id}')
+def expt_result(watcher, run_dir, expt, slurm_job, completed_no_result):
+    ''' (status, line) of an experiment that ended, from the lines its
+        log gained since the last pass or from the Slurm state of its
+        job, or None while it runs '''
+    results = watcher.scan(os.path.join(run_dir, 'slurm.out'))
+    if results:
+        status, line = results[0]
+        return status, line.rstrip()
+    if not slurm_job or not is_terminal(slurm_job.state):
+        return None
+    # Ended without writing either string, e.g. killed for running out
+    # of memory or time. A completed run's log may not be flushed yet,
+    # it is read once more first.
+    if slurm_job.state != 'COMPLETED':
+        return 'failed', 'No result in log, Slurm job ended'
+    if expt in completed_no_result:
+        return 'failed', 'No result in log, Slurm job completed'
+    completed_no_result.add(expt)
+    return None
 
-        undone = list(set(expt_list) - set(complete_expts))
-        config = config_parser()
-        file_name = 'Longjob.cfg'
-        if os.path.exists(file_name):
-            config.read(file_name)
-        for expt in undone:
-            expt_log = os.path.join(expts_base_dir, expt, 'slurm.out')
-            logger.info(f'expt log: {expt_log}')
-            pr_repo = job_obj.repo["address"]
-            pr_num = job_obj.preq_dict['preq'].number
-            config[expt_log] = {}
-            config[expt_log]['expt'] = expt
-            config[expt_log]['machine'] = job_obj.machine
-            config[expt_log]['pr_repo'] = pr_repo
-            config[expt_log]['pr_num'] = str(pr_num)
-            config[expt_log]['issue_id'] = str(issue_id.id)
-        with open(file_name, 'w') as fname:
-            config.write(fname)
 
-    return issue_id
+def report_expt(job_obj, comparator, tracker, run_dir, expt, result,
+                slurm_job):
+    ''' Add an experiment that ended to the comment. A finished run must
+        also match its baseline; its timers are compared with those of
+        the base branch. '''
+    logger = logging.getLogger('BUILD/REPORT_EXPT')
+    status, line = result
+    tables = []
+    if status == 'done':
+        passed, table = comparator.check(run_dir)
+        tables.append(table)
+        if passed is False:
+            status = 'failed'
+            line = 'Outputs differ from baseline'
+        else:
+            tables.append(tracker.check(run_dir, expt,
+                                        job_obj.store.job(job_obj.job_id),
+                                        slurm_job))
+    job_obj.comment_append(f'Experiment {status}: {expt}')
+    logger.info(f'Experiment {status}: {expt}')
+    job_obj.comment_append(line)
+    if slurm_job:
+        job_obj.comment_append(format_job(slurm_job))
+    experiment(expt, status, slurm_job)
+    for table in tables:
+        if table:
+            job_obj.comment_append(table)
+
 
+def track_expts(job_obj, expts_base_dir, slurm_ids, watcher, expt_count,
+                undone):
+    ''' Write out the comment so far and hand the experiments still
+        running to the long job checker. Returns the comment. '''
+    logger = logging.getLogger('BUILD/TRACK_EXPTS')
+    job_obj.comment_append(f'Long term tracking will be done'
+                           f' on {expt_count} experiments')
+
+    # Write out comments so far and save issue id for later appending
+    issue_id = job_obj.send_comment_text()
+    logger.debug(f'Issue comment id is {issue_id}')
+
+    for expt in undone:
+        expt_log = os.path.join(expts_base_dir, expt, 'slurm.out')
+        logger.info(f'expt log: {expt_log}')
+        # Saved with where the long job checker continues reading the log
+        job_obj.store.add_experiment(expt_log, expt, job_obj, issue_id.id,
+                                     slurm_ids.get(expt),
+                                     watcher.get_state(expt_log))
+    return issue_id
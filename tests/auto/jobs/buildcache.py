@@ -0,0 +1,96 @@
+"""
+Name: buildcache.py
+Content-addressed cache of GeoFLOW builds. An entry holds the
+geoflow_cdg executable and the build log, keyed by the head commit SHA,
+machine, compiler and a hash of build.sh. Entries are evicted least
+recently used first to keep the cache under a size cap.
+"""
+
+# Imports
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+CACHED_FILES = ['geoflow_cdg', 'build.out']
+
+
+class BuildCache:
+    '''
+    This class stores and restores build outputs
+    ...
+
+    Attributes
+    ----------
+    cache_dir : str
+        Directory holding one subdirectory per cached build
+    max_bytes : int
+        Total size of the cache that eviction keeps below
+    '''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.logger = logging.getLogger('BUILDCACHE')
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(sha, machine, compiler, build_script):
+        ''' Cache key for a build of commit sha with build_script '''
+        with open(build_script, 'rb') as fname:
+            script_hash = hashlib.sha256(fname.read()).hexdigest()
+        return hashlib.sha256(f'{sha} {machine} {compiler} {script_hash}'
+                              .encode('utf8')).hexdigest()[:32]
+
+    def fetch(self, key, geoflow_cdg, build_log):
+        ''' Copy a cached build to its place in the clone.
+            Returns False if the build is not cached. '''
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            self.logger.info(f'Build cache miss: {key}')
+            return False
+        os.makedirs(os.path.dirname(geoflow_cdg), exist_ok=True)
+        shutil.copy2(os.path.join(entry, 'geoflow_cdg'), geoflow_cdg)
+        shutil.copy2(os.path.join(entry, 'build.out'), build_log)
+        # Mark as recently used
+        os.utime(entry)
+        self.logger.info(f'Build cache hit: {key}')
+        return True
+
+    def store(self, key, geoflow_cdg, build_log):
+        ''' Add a successful build to the cache '''
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            return
+        tmp_entry = f'{entry}.tmp{os.getpid()}'
+        os.makedirs(tmp_entry, exist_ok=True)
+        shutil.copy2(geoflow_cdg, os.path.join(tmp_entry, 'geoflow_cdg'))
+        shutil.copy2(build_log, os.path.join(tmp_entry, 'build.out'))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another job stored the same build first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.logger.info(f'Build stored in cache: {key}')
+        self.evict()
+
+    def evict(self):
+        ''' Remove least recently used entries until under max_bytes '''
+        entries = []
+        with os.scandir(self.cache_dir) as scan:
+            for item in scan:
+                if not item.is_dir() or '.tmp' in item.name:
+                    continue
+                size = sum(os.path.getsize(os.path.join(item.path, name))
+                           for name in CACHED_FILES
+                           if os.path.exists(os.path.join(item.path, name)))
+                entries.append((item.stat().st_mtime, size, item.path))
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.logger.info(f'Evicting build unused for '
+                             f'{(time.time() - mtime) / 3600:.1f} h: {path}')
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
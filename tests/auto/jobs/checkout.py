@@ -0,0 +1,296 @@
+"""
+Name: checkout.py
+Keeps one working tree per PR, in {workdir}/{pr.id}/src, instead of a
+fresh clone for every job. Each compiler builds in its own directory of
+the tree, build_<compiler>, so the gnu and intel jobs of a commit share
+one clone and build at the same time. New commits are fetched from the
+repo's mirror and checked out with git reset --hard, so unchanged sources
+keep their timestamps and the build directories are reused.
+Jobs hold a shared lock on the tree while they use it; only an update to
+another commit takes it exclusively. Tests run from a snapshot of the
+tree in {workdir}/{pr.id}/runs/, so the next job can update the tree
+while they are still queued or running.
+Trees of closed and merged PRs are removed by gc_checkouts, which asks
+GitHub for the states of all PRs with a tree in one GraphQL query.
+"""
+
+# Imports
+import datetime
+import fcntl
+import glob
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from graphql_pulls import get_pull_states
+from jobs.gitmirror import log_transfer, update_mirror
+from metrics import span
+
+# Repo address and number of the PR a directory belongs to
+PR_FILE = 'pr.json'
+# Commit checked out in a tree or run directory
+SHA_FILE = 'head_sha'
+# Directory of the tree shared by the jobs of a PR
+TREE_DIR = 'src'
+
+# Jobs of this process that check the same tree do it one at a time, so
+# the second one finds the commit the first checked out
+_update_locks = {}
+_update_locks_lock = threading.Lock()
+
+
+def pr_dir(workdir, pr_id):
+    return os.path.join(workdir, str(pr_id))
+
+
+def write_sha(path, repo_loc, file_name=SHA_FILE):
+    ''' Save the commit of repo_loc in path, for the workspace index '''
+    head = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_loc,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          universal_newlines=True)
+    with open(os.path.join(path, file_name), 'w') as fname:
+        fname.write(head.stdout)
+
+
+def read_sha(path, file_name=SHA_FILE):
+    try:
+        with open(os.path.join(path, file_name)) as fname:
+            return fname.read().strip() or None
+    except OSError:
+        return None
+
+
+def update_lock(path):
+    with _update_locks_lock:
+        return _update_locks.setdefault(path, threading.Lock())
+
+
+class Checkout:
+    '''
+    This class updates the working tree of a job's PR and holds it at
+    the job's commit while the job uses it
+    ...
+
+    Attributes
+    ----------
+    job_obj : Job
+        The job using the tree
+    path : str
+        Directory holding the clone, the pr_repo_loc of the build
+    repo_loc : str
+        The clone itself
+    build_loc : str
+        Build directory of the job's compiler in the clone
+    changed_files : list
+        Files changed since the commit of the last build in build_loc,
+        None if there was none
+    '''
+
+    def __init__(self, job_obj):
+        self.logger = logging.getLogger('CHECKOUT')
+        preq = job_obj.preq_dict['preq']
+        self.job_obj = job_obj
+        self.pr_dir = pr_dir(job_obj.workdir, preq.id)
+        self.path = os.path.join(self.pr_dir, TREE_DIR)
+        self.repo_loc = os.path.join(self.path, preq.head.repo.name)
+        self.build_loc = os.path.join(self.repo_loc,
+                                      f'build_{job_obj.compiler}')
+        # Commit of the last build in build_loc
+        self.build_sha_file = f'{job_obj.compiler}_{SHA_FILE}'
+        self.changed_files = None
+        self.lock = None
+
+    def __enter__(self):
+        os.makedirs(self.pr_dir, exist_ok=True)
+        # Locked by update()
+        self.lock = open(f'{self.path}.lock', 'w')
+        with open(os.path.join(self.pr_dir, PR_FILE), 'w') as fname:
+            json.dump({'repo': self.job_obj.repo['address'].strip('/'),
+                       'number': self.job_obj.preq_dict['preq'].number},
+                      fname)
+        return self
+
+    def __exit__(self, *args):
+        self.lock.close()
+        self.lock = None
+
+    def git(self, logger, command, timeout=None):
+        step = [f'git {command}', self.repo_loc]
+        if timeout:
+            step.append(timeout)
+        return self.job_obj.run_commands(logger, [step], check=False)[0]
+
+    def has_commit(self, logger, sha):
+        return self.git(logger, f'cat-file -e {sha}^{{commit}}') \
+            .returncode == 0
+
+    def update(self):
+        ''' Bring the tree to the PR's head commit, unless another job
+            already did, and find the files changed since the last build
+            of the job's compiler. Returns the head commit. '''
+        logger = logging.getLogger('CHECKOUT/UPDATE')
+        new_sha = self.job_obj.preq_dict['preq'].head.sha
+        with span('checkout') as fields, update_lock(self.path):
+            fcntl.flock(self.lock, fcntl.LOCK_SH)
+            fields['fetched'] = read_sha(self.path) != new_sha
+            if fields['fetched']:
+                # Jobs of other commits finish with the tree first
+                fcntl.flock(self.lock, fcntl.LOCK_EX)
+                try:
+                    self.fetch(logger)
+                finally:
+                    fcntl.flock(self.lock, fcntl.LOCK_SH)
+            else:
+                logger.info(f'Tree {self.repo_loc} already at {new_sha}')
+        old_sha = read_sha(self.path, self.build_sha_file)
+        if old_sha:
+            # Read directly, the command output kept in memory is
+            # only its tail
+            diff = subprocess.run(
+                ['git', 'diff', '--name-only', old_sha, 'HEAD'],
+                cwd=self.repo_loc, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, universal_newlines=True)
+            self.changed_files = diff.stdout.split() \
+                if diff.returncode == 0 else None
+        logger.info(f'Tree {self.repo_loc} at {new_sha}, changed files '
+                    f'for {self.build_loc}: {self.changed_files}')
+        return new_sha
+
+    def built(self, sha):
+        ''' Record that build_loc was built from sha. Only a build that
+            succeeded there counts: the next one rebuilds the changes
+            since. '''
+        with open(os.path.join(self.path, self.build_sha_file),
+                  'w') as fname:
+            fname.write(f'{sha}\n')
+
+    def fetch(self, logger):
+        ''' Check out the PR's head commit, cloning the repo first if
+            there is no clone yet '''
+        preq = self.job_obj.preq_dict['preq']
+        new_sha = preq.head.sha
+        new_branch = preq.head.ref
+        git_url = f'https://${{ghapitoken}}@github.com/' \
+                  f'{preq.head.repo.full_name}'
+        timeout = self.job_obj.clone_timeout
+
+        # Objects already in the local mirror of the base repo are not
+        # downloaded again
+        mirror = update_mirror(self.job_obj)
+        start = time.time()
+        if not os.path.isdir(os.path.join(self.repo_loc, '.git')):
+            logger.info(f'Cloning {git_url} branch {new_branch}')
+            if os.path.exists(self.repo_loc):
+                # Left over from a clone that did not finish
+                shutil.rmtree(self.repo_loc)
+            results = self.job_obj.run_commands(logger, [
+                [f'mkdir -p "{self.path}"', os.getcwd()],
+                [f'git clone --progress --reference-if-able {mirror} '
+                 f'--dissociate -b {new_branch} {git_url}', self.path,
+                 timeout]])
+        else:
+            # The mirror has the head of every PR, forks included
+            results = [self.git(logger, f'fetch --no-tags --progress '
+                                        f'{mirror} refs/pull/{preq.number}/'
+                                        'head', timeout)]
+            if not self.has_commit(logger, new_sha):
+                logger.info(f'{new_sha} not in mirror, fetching {git_url}')
+                results.append(self.git(
+                    logger, f'fetch --no-tags --progress {git_url} '
+                            f'{new_branch}', timeout))
+        log_transfer(logger, 'Checkout update', start, results)
+
+        if self.has_commit(logger, new_sha):
+            # The build directories are not in the repo and are kept
+            self.job_obj.run_commands(logger, [
+                [f'git reset --hard {new_sha}', self.repo_loc],
+                ["git clean -ffdx -e '/build_*/'", self.repo_loc]])
+        else:
+            # The tree would still be at an older commit
+            self.job_obj.comment_append(f'Head commit {new_sha} of '
+                                        f'{new_branch} is not available')
+            raise Exception(f'Commit {new_sha} not found')
+        write_sha(self.path, self.repo_loc)
+
+    def snapshot(self):
+        ''' Copy ci_tests and the executable to a run directory laid out
+            like the tree, and return it for use as pr_repo_loc. ci_tests
+            is hard linked: git replaces files rather than writing into
+            them, so the links keep the old contents. The executable
+            goes to build/bin whatever the compiler. '''
+        logger = logging.getLogger('CHECKOUT/SNAPSHOT')
+        run_loc = os.path.join(
+            self.pr_dir, 'runs',
+            f'{self.job_obj.compiler}_'
+            f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}')
+        src = self.repo_loc
+        dst = os.path.join(run_loc, os.path.basename(self.repo_loc))
+        self.job_obj.run_commands(logger, [
+            [f'mkdir -p "{dst}/build/bin"', os.getcwd()],
+            [f'cp -al "{src}/ci_tests" "{dst}/ci_tests"', os.getcwd()],
+            [f'cp -p "{self.build_loc}/bin/geoflow_cdg" "{dst}/build/bin/"',
+             os.getcwd()]])
+        write_sha(run_loc, self.repo_loc)
+        return run_loc
+
+
+def gc_checkouts(ghinterface_obj, workdir, store):
+    ''' Remove the directories of closed and merged PRs, except those of
+        experiments still being tracked. Returns the removed directories. '''
+    logger = logging.getLogger('CHECKOUT/GC')
+    prs = read_pr_files(workdir)
+    if not prs:
+        return []
+    states = get_pull_states(ghinterface_obj, prs.values())
+    running = [row['log_path'] for row in store.experiments('running')]
+    removed = []
+    for path, pr in prs.items():
+        if states.get(pr) not in ['CLOSED', 'MERGED']:
+            continue
+        if any(log_path.startswith(path + os.sep) for log_path in running):
+            logger.info(f'{path}: experiments still running')
+            continue
+        if remove_unused(path):
+            removed.append(path)
+            logger.info(f'Removed {path} of {pr[0]}#{pr[1]} '
+                        f'({states[pr].lower()})')
+        else:
+            logger.info(f'{path}: in use')
+    return removed
+
+
+def read_pr_files(workdir):
+    ''' {PR directory: (repo address, PR number)} of the workdir '''
+    logger = logging.getLogger('CHECKOUT/READ_PR_FILES')
+    prs = {}
+    for pr_file in glob.glob(os.path.join(workdir, '*', PR_FILE)):
+        try:
+            with open(pr_file) as fname:
+                pr_info = json.load(fname)
+            prs[os.path.dirname(pr_file)] = (pr_info['repo'],
+                                             pr_info['number'])
+        except (OSError, ValueError, KeyError) as e:
+            logger.info(f'Skipping {pr_file}. Exception:{e}')
+    return prs
+
+
+def remove_unused(path):
+    ''' Remove a PR directory unless a job still uses one of its trees,
+        which holds its lock. Returns whether it was removed. '''
+    locks = [open(lock_file, 'w') for lock_file in
+             glob.glob(os.path.join(path, '*.lock'))]
+    try:
+        for lock in locks:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+        return True
+    finally:
+        for lock in locks:
+            lock.close()
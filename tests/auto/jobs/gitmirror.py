@@ -0,0 +1,72 @@
+"""
+Name: gitmirror.py
+Keeps a bare mirror of each upstream repo in the workdir, refreshed with
+an incremental fetch, so that PR clones made with --reference only
+download the objects the mirror does not already have.
+"""
+
+# Imports
+import fcntl
+import logging
+import os
+import re
+import time
+
+from metrics import event, span
+
+UNITS = {'bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+
+def mirror_path(workdir, address):
+    ''' Location of the bare mirror of a GitHub repo address '''
+    return os.path.join(workdir, 'mirrors', f'{address.strip("/")}.git')
+
+
+def update_mirror(job_obj):
+    ''' Create the mirror of the job's base repo, or fetch new objects
+        into it, and return its path '''
+    logger = logging.getLogger('GITMIRROR/UPDATE_MIRROR')
+    address = job_obj.repo['address'].strip('/')
+    mirror = mirror_path(job_obj.workdir, address)
+    git_url = f'https://${{ghapitoken}}@github.com/{address}'
+    os.makedirs(os.path.dirname(mirror), exist_ok=True)
+
+    # Jobs for different PRs of the same repo share the mirror
+    with open(f'{mirror}.lock', 'w') as lock, span('mirror_update'):
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(mirror):
+            logger.info(f'Fetching into mirror {mirror}')
+            mirror_commands = [[f'git --git-dir={mirror} fetch --prune '
+                                '--progress origin', os.getcwd(),
+                                job_obj.clone_timeout]]
+        else:
+            logger.info(f'Creating mirror {mirror}')
+            mirror_commands = [[f'git clone --mirror --progress {git_url} '
+                                f'{mirror}', os.getcwd(),
+                                job_obj.clone_timeout]]
+        start = time.time()
+        # Without the mirror the clone downloads everything, but works
+        results = job_obj.run_commands(logger, mirror_commands, check=False)
+    log_transfer(logger, 'Mirror update', start, results)
+    return mirror
+
+
+def transfer_bytes(results):
+    ''' Sum the sizes git reports in "Receiving objects" progress lines '''
+    total = 0
+    for result in results:
+        received = re.findall(r'Receiving objects:\s+100%.*?,\s+'
+                              r'([\d.]+) (bytes|KiB|MiB|GiB)',
+                              ' '.join(result.tail))
+        if received:
+            size, unit = received[-1]
+            total += int(float(size) * UNITS[unit])
+    return total
+
+
+def log_transfer(logger, what, start, results):
+    seconds = time.time() - start
+    received = transfer_bytes(results)
+    logger.info(f'{what} took {seconds:.1f} s, received {received} bytes')
+    event('transfer', what=what, seconds=round(seconds, 3),
+          received_bytes=received)
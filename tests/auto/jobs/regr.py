@@ -9,7 +9,10 @@ import datetime
 import logging
 import time
 import os
-from configparser import ConfigParser as config_parser
+
+from jobs.gitmirror import log_transfer, update_mirror
+from logwatch import LogWatcher
+from metrics import span
 
 
 def run(job_obj):
@@ -27,7 +30,8 @@ def run(job_obj):
                              [f'module use modulefiles;module load gsi_{job_obj.machine}.{job_obj.compiler}', pr_repo_loc],
                              [f'./build.sh ../ ' f' >& {log_name}', build_script_loc]]
     logger.info('Running test build script')
-    job_obj.run_commands(logger, create_build_commands)
+    # A failed build is reported by post_process
+    job_obj.run_commands(logger, create_build_commands, check=False)
     # Read the build log to see whether it succeeded
     build_success = post_process(job_obj, build_script_loc, log_name,
                                  pr_repo_loc)
@@ -44,7 +48,7 @@ def run(job_obj):
             create_regr_commands = \
                 [[f'ctest --verbose >& '
                   f'{log_name}', ctest_loc]]
-            job_obj.run_commands(logger, create_regr_commands)
+            job_obj.run_commands(logger, create_regr_commands, check=False)
             logger.info('After GSI regression test')
             ci_log = f'{ctest_loc}/{log_name}'
             error_strings = ['Test #', 'Test  #', 'ed the', 'Thus',
@@ -83,10 +87,18 @@ def clone_pr_repo(job_obj, workdir):
     pr_repo_loc = f'{repo_dir_str}'
     job_obj.comment_append(f'Repo location: {pr_repo_loc}')
 
+    # Objects already in the local mirror of the base repo are not
+    # downloaded again
+    mirror = update_mirror(job_obj)
     create_repo_commands = [
         [f'mkdir -p "{repo_dir_str}"', os.getcwd()],
-        [f'git clone -b {new_branch} {git_url}', repo_dir_str]]
-    job_obj.run_commands(logger, create_repo_commands)
+        [f'git clone --progress --reference-if-able {mirror} --dissociate '
+         f'-b {new_branch} {git_url}', repo_dir_str,
+         job_obj.clone_timeout]]
+    start = time.time()
+    with span('clone'):
+        results = job_obj.run_commands(logger, create_repo_commands)
+    log_transfer(logger, 'Repo clone', start, results)
 
     logger.info('Finished repo clone')
     return pr_repo_loc, repo_dir_str
@@ -154,12 +166,13 @@ def process_expt(job_obj, expts_base_dir):
     expt_list = os.listdir(expts_base_dir)
     complete_string = "This cycle is complete"
     failed_string = "DEAD"
+    watcher = LogWatcher({'done': complete_string, 'failed': failed_string})
 
     # Set issue id for cases where workflow does not start
     issue_id = 0
 
     while (expt_done < len(expt_list)) and repeat_count > 0:
-        time.sleep(sleep_time)
+        job_obj.sleep(sleep_time)
         repeat_count = repeat_count - 1
         expt_list = os.listdir(expts_base_dir)
         logger.info('Experiment dir after return of end_to_end')
@@ -167,26 +180,25 @@ def process_expt(job_obj, expts_base_dir):
         for expt in expt_list:
             expt_log = os.path.join(expts_base_dir, expt,
                                     'log/FV3LAM_wflow.log')
-            if os.path.exists(expt_log) and expt not in complete_expts:
-                with open(expt_log) as fname:
-                    for line in fname:
-                        if complete_string in line:
-                            expt_done = expt_done + 1
-                            job_obj.comment_append(f'Experiment done: {expt}')
-                            job_obj.comment_append(f'{line.rstrip()}')
-                            logger.info(f'Experiment done: {expt}')
-                            complete_expts.append(expt)
-                        elif failed_string in line:
-                            expt_done = expt_done + 1
-                            job_obj.comment_append('Experiment failed: '
-                                                   f'{expt}')
-                            job_obj.comment_append(f'{line.rstrip()}')
-                            logger.info(f'Experiment failed: {expt}')
-                            complete_expts.append(expt)
+            if expt in complete_expts:
+                continue
+            # Only the lines appended since the last pass are read
+            for status, line in watcher.scan(expt_log):
+                if expt in complete_expts:
+                    break
+                expt_done = expt_done + 1
+                if status == 'done':
+                    job_obj.comment_append(f'Experiment done: {expt}')
+                    logger.info(f'Experiment done: {expt}')
+                else:
+                    job_obj.comment_append(f'Experiment failed: {expt}')
+                    logger.info(f'Experiment failed: {expt}')
+                job_obj.comment_append(f'{line.rstrip()}')
+                complete_expts.append(expt)
     logger.info(f'Wait Cycles completed: {time_mult - repeat_count}')
     logger.info(f'Done: {len(complete_expts)} of {len(expt_list)}')
 
-    # If not all experiments completed, writes a list in a config file
+    # If not all experiments completed, saves them in the state store
     if len(complete_expts) < len(expt_list):
         job_obj.comment_append(f'Long term tracking will be done'
                                f' on {len(expt_list)} experiments')
@@ -196,23 +208,14 @@ def process_expt(job_obj, expts_base_dir):
         logger.debug(f'Issue comment id is {issue_id}')
 
         undone = list(set(expt_list) - set(complete_expts))
-        config = config_parser()
-        file_name = 'Longjob.cfg'
-        if os.path.exists(file_name):
-            config.read(file_name)
         for expt in undone:
             expt_log = os.path.join(expts_base_dir, expt,
                                     'log/FV3LAM_wflow.log')
             logger.info(f'expt log: {expt_log}')
-            pr_repo = job_obj.repo["address"]
-            pr_num = job_obj.preq_dict['preq'].number
-            config[expt_log] = {}
-            config[expt_log]['expt'] = expt
-            config[expt_log]['machine'] = job_obj.machine
-            config[expt_log]['pr_repo'] = pr_repo
-            config[expt_log]['pr_num'] = str(pr_num)
-            config[expt_log]['issue_id'] = str(issue_id.id)
-        with open(file_name, 'w') as fname:
-            config.write(fname)
+            # Saved with where the long job checker continues reading
+            # the log
+            job_obj.store.add_experiment(expt_log, expt, job_obj,
+                                         issue_id.id,
+                                         log_state=watcher.get_state(expt_log))
 
     return issue_id
@@ -3,6 +3,8 @@ import datetime
 import logging
 import os
 
+from metrics import span
+
 
 def run(job_obj):
     logger = logging.getLogger('RT/RUN')
@@ -43,7 +45,8 @@ def run_regression_test(job_obj, pr_repo_loc):
     elif job_obj.compiler == 'intel':
         rt_command = [[f'export RT_COMPILER="{job_obj.compiler}" && cd tests '
                        '&& /bin/bash --login ./rt.sh -e', pr_repo_loc]]
-    job_obj.run_commands(logger, rt_command)
+    # Failed tests are reported by post_process from the RT log
+    job_obj.run_commands(logger, rt_command, check=False)
 
 
 def remove_pr_data(job_obj, pr_repo_loc, repo_dir_str, rt_dir):
@@ -80,7 +83,8 @@ def clone_pr_repo(job_obj, workdir):
          f'{repo_dir_str}/{repo_name}']
     ]
 
-    job_obj.run_commands(logger, create_repo_commands)
+    with span('clone'):
+        job_obj.run_commands(logger, create_repo_commands)
 
     logger.info('Finished repo clone')
     return branch, pr_repo_loc, repo_dir_str
@@ -0,0 +1,194 @@
+"""
+Name: scale.py
+Scaling sweep for the scale action: one input file is run on a grid of
+MPI rank and OpenMP thread counts, each grid point as its own Slurm job
+with its own run directory. When all runs are done their times to
+solution give the speedup and parallel efficiency of each point, posted
+as a table and saved as scaling.csv (and scaling.png with matplotlib).
+"""
+
+# Imports
+import csv
+import logging
+import os
+import re
+from configparser import ConfigParser as config_parser
+
+from perf import parse_gptl
+from slurm import parse_job_id
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+SCALE_PREFIX = 'scale_'
+
+
+def run_name(ranks, threads):
+    return f'{SCALE_PREFIX}r{ranks}_t{threads}'
+
+
+def parse_run_name(name):
+    ''' (ranks, threads) of a scaling run directory name, or None '''
+    match = re.match(rf'{SCALE_PREFIX}r(\d+)_t(\d+)$', name)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def int_list(text):
+    return [int(item) for item in text.split(',') if item.strip()]
+
+
+class ScalingSweep:
+    '''
+    This class submits the runs of a scaling sweep and reports on them
+    ...
+
+    Attributes
+    ----------
+    ranks : list
+        MPI rank counts of the grid
+    threads : list
+        OpenMP threads per rank of the grid
+    input_name : str
+        Input .jsn file, relative to ci_tests
+    mode : str
+        strong, the same problem on more cores. Weak scaling would need
+        an input that grows with the cores and is not supported yet.
+    '''
+
+    def __init__(self, ranks, threads, input_name, mode='strong'):
+        self.logger = logging.getLogger('SCALE')
+        self.ranks = ranks
+        self.threads = threads
+        self.input_name = input_name
+        self.mode = mode
+
+    @classmethod
+    def from_config(cls, file_name='CImachine.cfg'):
+        ''' Build the sweep from the optional scale_* entries of the
+            machine config file '''
+        config = config_parser()
+        config.read(file_name)
+        mode = config['DEFAULT'].get('scale_mode', fallback='strong')
+        if mode != 'strong':
+            # Every grid point runs the same input, so the problem size
+            # never grows with the cores
+            raise ValueError(f'scale_mode={mode} is not supported, only '
+                             'strong scaling is')
+        return cls(int_list(config['DEFAULT'].get('scale_ranks',
+                                                  fallback='1,2,4,8')),
+                   int_list(config['DEFAULT'].get('scale_threads',
+                                                  fallback='1')),
+                   config['DEFAULT'].get('scale_input',
+                                         fallback='test_inertgrav2d.jsn'),
+                   mode)
+
+    def submit(self, job_obj, pr_repo_loc, geoflow_cdg):
+        ''' Submit one Slurm job per grid point. Returns the directory
+            holding the run directories and {run name: Slurm job ID} of
+            the runs that were submitted. '''
+        logger = logging.getLogger('SCALE/SUBMIT')
+        ci_tests_loc = os.path.join(pr_repo_loc, 'GeoFLOW/ci_tests')
+        expt_script_loc = os.path.join(ci_tests_loc, 'integration_tests')
+        scale_base_dir = os.path.join(expt_script_loc, 'scale_dirs')
+        input_json = os.path.join(ci_tests_loc, self.input_name)
+        if not os.path.exists(input_json):
+            job_obj.comment_append(f'Scaling input {input_json} does not '
+                                   'exist in repo')
+            return scale_base_dir, {}
+        slurm_ids = {}
+        for ranks in self.ranks:
+            for threads in self.threads:
+                name = run_name(ranks, threads)
+                run_dir = os.path.join(scale_base_dir, name)
+                setup_log = os.path.join(expt_script_loc, f'{name}.out')
+                job_obj.run_commands(logger, [
+                    [f'mkdir -p "{run_dir}"', os.getcwd()],
+                    [f'CI_NTASKS={ranks} CI_NTHREADS={threads} '
+                     f'bash integration_tests.sh {run_dir} {geoflow_cdg} '
+                     f'{input_json} >& {setup_log}', expt_script_loc]],
+                    check=False)
+                slurm_id = parse_job_id(setup_log)
+                if slurm_id:
+                    slurm_ids[name] = slurm_id
+                else:
+                    job_obj.comment_append(f'Submission of {name} failed')
+                    if os.path.exists(setup_log):
+                        with open(setup_log) as fname:
+                            for line in fname.readlines()[-5:]:
+                                job_obj.comment_append(line.rstrip())
+                    # Without a job the run directory is not tracked
+                    if os.path.isdir(run_dir):
+                        os.rmdir(run_dir)
+        logger.info(f'Scaling runs: {slurm_ids}')
+        return scale_base_dir, slurm_ids
+
+    def report(self, scale_base_dir, elapsed=None):
+        ''' Scaling table of the runs in scale_base_dir, from the GPTL
+            total timer of each run, or its elapsed seconds (run name:
+            seconds) without one. Also writes scaling.csv/.png next to
+            scale_base_dir. '''
+        elapsed = elapsed or {}
+        points = []
+        for name in sorted(os.listdir(scale_base_dir)):
+            grid = parse_run_name(name)
+            if not grid:
+                continue
+            seconds = parse_gptl(os.path.join(scale_base_dir, name)) \
+                .get('total') or elapsed.get(name)
+            if seconds:
+                points.append((*grid, seconds))
+        if not points:
+            return 'Scaling sweep: no run times found'
+
+        # Efficiency is relative to the run on the fewest cores
+        points.sort(key=lambda point: (point[0] * point[1], point[0]))
+        ranks_0, threads_0, time_0 = points[0]
+        rows = []
+        for ranks, threads, seconds in points:
+            speedup = time_0 / seconds
+            efficiency = speedup * ranks_0 * threads_0 / (ranks * threads)
+            rows.append((ranks, threads, ranks * threads, seconds, speedup,
+                         efficiency))
+
+        out_dir = os.path.dirname(scale_base_dir)
+        csv_file = os.path.join(out_dir, 'scaling.csv')
+        with open(csv_file, 'w', newline='') as fname:
+            writer = csv.writer(fname)
+            writer.writerow(['ranks', 'threads', 'cores', 'seconds',
+                             'speedup', 'efficiency'])
+            writer.writerows(rows)
+        artifacts = [csv_file]
+        if plt is not None:
+            artifacts.append(self.plot(rows, os.path.join(out_dir,
+                                                          'scaling.png')))
+
+        lines = [f'{self.mode.capitalize()} scaling of {self.input_name}:',
+                 '| ranks | threads | cores | time (s) | speedup | '
+                 'efficiency |',
+                 '|---|---|---|---|---|---|']
+        for ranks, threads, cores, seconds, speedup, efficiency in rows:
+            lines.append(f'| {ranks} | {threads} | {cores} | {seconds:.2f} '
+                         f'| {speedup:.2f} | {efficiency:.0%} |')
+        lines.append(f'Scaling results: {" ".join(artifacts)}')
+        return '\n'.join(lines)
+
+    def plot(self, rows, png_file):
+        ''' Efficiency against cores, one curve per thread count '''
+        figure, axes = plt.subplots()
+        for threads in sorted(set(row[1] for row in rows)):
+            curve = [row for row in rows if row[1] == threads]
+            axes.plot([row[2] for row in curve], [row[5] for row in curve],
+                      marker='o', label=f'{threads} threads per rank')
+        axes.set_xscale('log', base=2)
+        axes.set_xlabel('cores')
+        axes.set_ylabel('parallel efficiency')
+        axes.set_title(f'{self.mode.capitalize()} scaling of '
+                       f'{self.input_name}')
+        axes.legend()
+        figure.savefig(png_file)
+        plt.close(figure)
+        return png_file
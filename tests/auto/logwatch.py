@@ -0,0 +1,108 @@
+"""
+Name: logwatch.py
+Incremental scanning of experiment logs. The byte offset reached in each
+log is remembered, so every scan only reads data appended since the last
+one. A log that shrank, was replaced (new inode) or was rewritten (its
+first bytes changed) is read from the start.
+"""
+
+# Imports
+import logging
+import os
+import zlib
+
+CHUNK_BYTES = 1024 * 1024
+# Bytes at the start of a log used to notice that it was rewritten
+HEAD_BYTES = 64
+
+
+class LogWatcher:
+    '''
+    This class finds registered patterns in newly appended log lines
+    ...
+
+    Attributes
+    ----------
+    patterns : dict
+        Name of each pattern mapped to the string that signals it,
+        e.g. {'Succeeded': 'geoflow: do shutdown...'}
+    state : dict
+        Log path mapped to {'inode': int, 'offset': int, 'head': int};
+        can be saved with get_state() and restored with set_state()
+        between runs
+    '''
+
+    def __init__(self, patterns, state=None):
+        self.logger = logging.getLogger('LOGWATCH')
+        self.patterns = dict(patterns)
+        self.state = dict(state or {})
+
+    def register(self, name, pattern):
+        self.patterns[name] = pattern
+
+    def get_state(self, path):
+        return self.state.get(path, {'inode': 0, 'offset': 0, 'head': 0})
+
+    def set_state(self, path, state):
+        self.state[path] = {'inode': int(state['inode']),
+                            'offset': int(state['offset']),
+                            'head': int(state.get('head', 0))}
+
+    @staticmethod
+    def head_checksum(fname, offset):
+        ''' Checksum of the first bytes of the log already read '''
+        fname.seek(0)
+        return zlib.crc32(fname.read(min(offset, HEAD_BYTES)))
+
+    def scan(self, path):
+        ''' Return (pattern name, line) for every registered pattern found
+            in the complete lines appended to path since the last scan '''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return []
+        with open(path, 'rb') as fname:
+            offset = self.start_offset(path, stat, fname)
+            matches, offset = self.read_matches(fname, offset)
+            head = self.head_checksum(fname, offset)
+        self.state[path] = {'inode': stat.st_ino, 'offset': offset,
+                            'head': head}
+        return matches
+
+    def start_offset(self, path, stat, fname):
+        ''' Offset reached by the last scan, or 0 if the log was replaced,
+            truncated or rewritten since '''
+        state = self.get_state(path)
+        offset = state['offset']
+        if state['inode'] and state['inode'] != stat.st_ino:
+            self.logger.info(f'{path} was replaced, reading from start')
+            return 0
+        if stat.st_size < offset:
+            self.logger.info(f'{path} was truncated, reading from start')
+            return 0
+        if offset and state['head'] and \
+           self.head_checksum(fname, offset) != state['head']:
+            self.logger.info(f'{path} was rewritten, reading from start')
+            return 0
+        return offset
+
+    def read_matches(self, fname, offset):
+        ''' (pattern name, line) of the pattern matches in the complete
+            lines after offset, and the offset after the last of them '''
+        matches = []
+        fname.seek(offset)
+        partial = b''
+        while True:
+            chunk = fname.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            lines = (partial + chunk).split(b'\n')
+            # The last piece has no newline yet, keep it for later
+            partial = lines.pop()
+            for raw_line in lines:
+                offset += len(raw_line) + 1
+                line = raw_line.decode('utf8', errors='replace')
+                for name, pattern in self.patterns.items():
+                    if pattern in line:
+                        matches.append((name, line))
+        return matches, offset
@@ -0,0 +1,293 @@
+"""
+Name: metrics.py
+Timing and counts of what the CI spends its time on. Code runs in spans,
+e.g.
+    with span('checkout'):
+        ...
+that record their duration and outcome. Each finished span, and each
+event, is appended as one JSON object per line to
+{metrics_dir}/events_<date>.ndjson, tagged with the job the thread works
+for (set_context), so a job's queue wait, checkout, build, Slurm
+submission and run can be lined up. Span durations also go into
+histograms, and count() adds to counters; both are written in the
+Prometheus text format to {metrics_dir}/<process>.prom, for the node
+exporter textfile collector, by write_textfile().
+With metrics_dir empty in the machine config file nothing is written.
+"""
+
+# Imports
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from configparser import ConfigParser as config_parser
+
+from runner import JobCancelled
+from slurm import elapsed_seconds, queue_seconds
+
+# Name, type, help text and histogram buckets of every metric
+METRICS = {
+    'ci_span_seconds': ('histogram', 'Duration of CI phases',
+                        [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600,
+                         7200, 14400]),
+    'ci_github_request_seconds': ('histogram',
+                                  'Duration of GitHub API requests',
+                                  [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                                   30]),
+    'ci_command_seconds': ('histogram', 'Duration of job commands',
+                           [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600,
+                            7200, 14400]),
+    'ci_spans_total': ('counter', 'Finished CI phases by outcome', None),
+    'ci_github_requests_total': ('counter', 'GitHub API requests by '
+                                 'method, resource and status', None),
+    'ci_github_retries_total': ('counter', 'GitHub API requests sent '
+                                'again', None),
+    'ci_github_cache_total': ('counter', 'GitHub response cache lookups '
+                              'by result', None),
+    'ci_commands_total': ('counter', 'Job commands by outcome', None),
+    'ci_jobs_total': ('counter', 'Finished jobs by final state', None),
+    'ci_slurm_jobs_submitted_total': ('counter', 'Slurm jobs submitted',
+                                      None),
+    'ci_experiments_total': ('counter', 'Finished experiments by state',
+                             None),
+}
+
+_context = threading.local()
+
+
+def context():
+    ''' Fields of the job the current thread works for '''
+    return getattr(_context, 'fields', {})
+
+
+def set_context(**fields):
+    ''' Tag the events of the current thread, e.g. with its job '''
+    _context.fields = fields
+
+
+def phase():
+    ''' Name of the innermost span open on the current thread '''
+    stack = getattr(_context, 'spans', [])
+    return stack[-1] if stack else ''
+
+
+def label_text(labels):
+    ''' {name="value",...} of a series, nothing without labels '''
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"'
+                          for name, value in labels) + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Metrics:
+    '''
+    This class keeps the counters and histograms of a process and writes
+    its events
+    ...
+
+    Attributes
+    ----------
+    metrics_dir : str
+        Directory of the event and textfile output, None to write
+        nothing
+    process : str
+        Name of the textfile, e.g. ci_auto
+    counters : dict
+        Value of each counter, by (name, labels)
+    histograms : dict
+        [bucket counts, sum, count] of each histogram, by (name, labels)
+    '''
+
+    def __init__(self, metrics_dir=None, process='ci'):
+        self.logger = logging.getLogger('METRICS')
+        self.metrics_dir = metrics_dir
+        self.process = process
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        if metrics_dir:
+            os.makedirs(metrics_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, process='ci', file_name='CImachine.cfg'):
+        ''' Build the metrics from the optional metrics_dir entry of the
+            machine config file '''
+        config = config_parser()
+        config.read(file_name)
+        return cls(config['DEFAULT'].get('metrics_dir', fallback='metrics')
+                   or None, process)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+            histogram = self.histograms[key]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def event(self, name, **fields):
+        ''' Append an event, with the context of the thread, to the
+            events file of the day '''
+        if not self.metrics_dir:
+            return
+        record = {'time': round(time.time(), 3), 'event': name,
+                  'process': self.process, 'pid': os.getpid()}
+        record.update(context())
+        record.update(fields)
+        line = json.dumps(record, default=str) + '\n'
+        path = os.path.join(
+            self.metrics_dir,
+            f'events_{datetime.date.today().strftime("%Y%m%d")}.ndjson')
+        try:
+            # One write of a whole line; ci_auto and ci_long append to
+            # the same file
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o644)
+            try:
+                os.write(fd, line.encode('utf8'))
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self.logger.info(f'Could not write event. Exception:{e}')
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        ''' Time the code in the with block as phase name. Fields are
+            added to its event; fields set on the yielded dict too. '''
+        stack = getattr(_context, 'spans', None)
+        if stack is None:
+            stack = _context.spans = []
+        stack.append(name)
+        extra = {}
+        start = time.time()
+        outcome = 'ok'
+        try:
+            yield extra
+        except BaseException as e:
+            outcome = 'cancelled' if isinstance(e, JobCancelled) \
+                else 'error'
+            extra.setdefault('error', f'{type(e).__name__}: {e}')
+            raise
+        finally:
+            stack.pop()
+            seconds = time.time() - start
+            self.observe('ci_span_seconds', seconds, span=name)
+            self.count('ci_spans_total', span=name, outcome=outcome)
+            fields.update(extra)
+            self.event('span', span=name, parent=phase(),
+                       start=round(start, 3), seconds=round(seconds, 3),
+                       outcome=outcome, **fields)
+
+    def textfile(self):
+        ''' The metrics in the Prometheus text format '''
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: [list(value[0]), value[1], value[2]]
+                          for key, value in self.histograms.items()}
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(METRICS.items()):
+            if kind == 'counter':
+                series = sorted((labels, value) for (metric, labels), value
+                                in counters.items() if metric == name)
+            else:
+                series = sorted((labels, value) for (metric, labels), value
+                                in histograms.items() if metric == name)
+            if not series:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in series:
+                if kind == 'counter':
+                    lines.append(f'{name}{label_text(labels)} {value}')
+                    continue
+                bucket_counts, total, count = value
+                for bound, bucket_count in zip(buckets, bucket_counts):
+                    bucket_labels = label_text(labels + (('le', bound),))
+                    lines.append(f'{name}_bucket{bucket_labels} '
+                                 f'{bucket_count}')
+                bucket_labels = label_text(labels + (('le', '+Inf'),))
+                lines.append(f'{name}_bucket{bucket_labels} {count}')
+                lines.append(f'{name}_sum{label_text(labels)} '
+                             f'{total:.3f}')
+                lines.append(f'{name}_count{label_text(labels)} '
+                             f'{count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self):
+        ''' Replace the process's textfile, atomically so the node
+            exporter never reads half of it '''
+        if not self.metrics_dir:
+            return
+        path = os.path.join(self.metrics_dir, f'{self.process}.prom')
+        with open(f'{path}.tmp', 'w') as fname:
+            fname.write(self.textfile())
+        os.replace(f'{path}.tmp', path)
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics(process=None):
+    ''' The Metrics of the process, built from the machine config file
+        on first use; the first call names the textfile '''
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics.from_config(process or 'ci')
+        return _metrics
+
+
+def span(name, **fields):
+    return get_metrics().span(name, **fields)
+
+
+def event(name, **fields):
+    get_metrics().event(name, **fields)
+
+
+def count(name, value=1, **labels):
+    get_metrics().count(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    get_metrics().observe(name, value, **labels)
+
+
+def experiment(expt, state, slurm_job=None, **fields):
+    ''' Count a finished experiment. The run time of its Slurm job goes
+        into the span histogram as experiment, and its wait in the Slurm
+        queue as slurm_queue. '''
+    fields.update(expt=expt, state=state)
+    if slurm_job:
+        fields.update(slurm_id=slurm_job.job_id,
+                      slurm_state=slurm_job.state,
+                      max_rss_kb=slurm_job.max_rss)
+        seconds = elapsed_seconds(slurm_job.elapsed)
+        if seconds is not None:
+            observe('ci_span_seconds', seconds, span='experiment')
+            fields['seconds'] = seconds
+        queue = queue_seconds(slurm_job)
+        if queue is not None:
+            observe('ci_span_seconds', queue, span='slurm_queue')
+            fields['queue_seconds'] = queue
+    count('ci_experiments_total', state=state)
+    event('experiment', **fields)
@@ -0,0 +1,247 @@
+"""
+Name: perf.py
+Performance tracking of integration tests. The GPTL timers of every
+finished test run, and its Slurm wall time, are saved in the state store
+by commit, machine, compiler and test. Each run is compared with the
+median of the latest runs of commits on the base branch; timers slower
+by more than a threshold are flagged in the PR comment.
+A commit counts as on the base branch once it is reachable from the
+branch in the repo's mirror, i.e. after its PR was merged with a merge
+commit, or once a recent base branch commit has the same tree, i.e.
+after a squash or rebase merge of a PR that was up to date with the
+branch. A PR squashed or rebased while behind its base branch is not
+found, as its commits and trees never reach the branch.
+"""
+
+# Imports
+import logging
+import os
+import statistics
+import subprocess
+from configparser import ConfigParser as config_parser
+
+from jobs.gitmirror import mirror_path
+from slurm import elapsed_seconds
+
+# Rows of the timer table in the PR comment
+TABLE_ROWS = 10
+# Latest base branch commits whose trees are matched against PR commits
+BASE_TREES = 1000
+
+
+def parse_gptl(run_dir):
+    ''' Return {timer name: seconds} from the GPTL output of a run:
+        timing.summary (mean over ranks) if GPTL wrote one,
+        else timing.0 (rank 0) '''
+    summary = os.path.join(run_dir, 'timing.summary')
+    if os.path.exists(summary):
+        return parse_timer_table(summary, 'name', ['mean_time', 'wallmax'],
+                                 name_column=True)
+    rank_0 = os.path.join(run_dir, 'timing.0')
+    if os.path.exists(rank_0):
+        return parse_timer_table(rank_0, 'Called', ['Wallclock'],
+                                 name_column=False)
+    return {}
+
+
+def parse_timer_table(file_name, marker, columns, name_column):
+    ''' Read the first GPTL table of a file: its header line contains
+        marker, and the seconds are in the first of columns found in
+        it. name_column says whether the header names the timer
+        column, which timing.<rank> files do not. '''
+    timers = {}
+    index = None
+    with open(file_name, errors='replace') as fname:
+        for line in fname:
+            tokens = line.split()
+            if index is None:
+                if marker in tokens:
+                    found = [tokens.index(column) for column in columns
+                             if column in tokens]
+                    if found:
+                        index = found[0] + (0 if name_column else 1)
+                continue
+            if not tokens or tokens[0].startswith('Overhead'):
+                # End of the table
+                break
+            # Timers with several parents are marked with a *
+            if tokens[0] == '*':
+                tokens = tokens[1:]
+            try:
+                timers[tokens[0].lstrip('*')] = float(tokens[index])
+            except (IndexError, ValueError):
+                continue
+    return timers
+
+
+class PerfTracker:
+    '''
+    This class saves test run timers and compares them with the history
+    of the base branch
+    ...
+
+    Attributes
+    ----------
+    store : StateStore
+        Database of jobs, with the saved timers
+    workdir : str
+        Work directory holding the repo mirrors
+    threshold : float
+        Relative slowdown that is flagged, e.g. 0.1 for 10%
+    history : int
+        Number of latest base branch runs to take the median of
+    min_seconds : float
+        Timers that take less time on the base branch are not flagged
+    not_base : set
+        (repo, commit) pairs found not to be on the base branch, asked
+        again only by the next tracker: a commit can still be merged
+    base_trees : dict
+        Trees of the latest base branch commits by (repo, branch), read
+        once per tracker
+    '''
+
+    def __init__(self, store, workdir, threshold=0.1, history=5,
+                 min_seconds=0.1):
+        self.logger = logging.getLogger('PERF')
+        self.store = store
+        self.workdir = workdir
+        self.threshold = threshold
+        self.history = history
+        self.min_seconds = min_seconds
+        self.not_base = set()
+        self.base_trees = {}
+
+    @classmethod
+    def from_config(cls, store, file_name='CImachine.cfg'):
+        ''' Build the tracker from the optional perf_* entries of the
+            machine config file '''
+        config = config_parser()
+        config.read(file_name)
+        return cls(store, config['DEFAULT']['workdir'],
+                   config['DEFAULT'].getfloat('perf_threshold',
+                                              fallback=0.1),
+                   config['DEFAULT'].getint('perf_history', fallback=5),
+                   config['DEFAULT'].getfloat('perf_min_seconds',
+                                              fallback=0.1))
+
+    def on_base_branch(self, job_row, sha):
+        ''' Whether a commit is on the base branch of the job's repo '''
+        if self.store.is_base_commit(job_row['pr_repo'], sha):
+            return True
+        # Without this every finished test ran git for every PR commit
+        # in its history
+        if (job_row['pr_repo'], sha) in self.not_base:
+            return False
+        mirror = mirror_path(self.workdir, job_row['pr_repo'].strip('/'))
+        base_ref = f'refs/heads/{job_row["base"]}'
+        result = subprocess.run(
+            ['git', f'--git-dir={mirror}', 'merge-base', '--is-ancestor',
+             sha, base_ref],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Only a yes is saved: a commit can still be merged later
+        if result.returncode == 0 or \
+                self.tree(mirror, sha) in self.trees(mirror, job_row):
+            self.store.add_base_commit(job_row['pr_repo'], sha)
+            return True
+        self.not_base.add((job_row['pr_repo'], sha))
+        return False
+
+    @staticmethod
+    def tree(mirror, sha):
+        ''' Tree of a commit in the mirror, or None '''
+        result = subprocess.run(
+            ['git', f'--git-dir={mirror}', 'rev-parse', '--verify', '-q',
+             f'{sha}^{{tree}}'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True)
+        return result.stdout.strip() or None
+
+    def trees(self, mirror, job_row):
+        ''' Trees of the latest base branch commits: a squash or rebase
+            merge of an up to date PR has the tree of its head commit '''
+        key = (job_row['pr_repo'], job_row['base'])
+        if key not in self.base_trees:
+            result = subprocess.run(
+                ['git', f'--git-dir={mirror}', 'log', '--format=%T',
+                 f'-n{BASE_TREES}', f'refs/heads/{job_row["base"]}'],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                universal_newlines=True)
+            self.base_trees[key] = set(result.stdout.split())
+        return self.base_trees[key]
+
+    def base_timers(self, job_row, test):
+        ''' {timer: [seconds]} of the latest base branch runs of test '''
+        by_sha = {}
+        skipped = set()
+        for row in self.store.timings(job_row['machine'],
+                                      job_row['compiler'], test):
+            sha = row['sha']
+            if sha == job_row['sha'] or sha in skipped:
+                continue
+            if sha not in by_sha:
+                if len(by_sha) == self.history:
+                    break
+                if not self.on_base_branch(job_row, sha):
+                    skipped.add(sha)
+                    continue
+                by_sha[sha] = {}
+            by_sha[sha].setdefault(row['timer'], row['seconds'])
+        timers = {}
+        for sha_timers in by_sha.values():
+            for timer, seconds in sha_timers.items():
+                timers.setdefault(timer, []).append(seconds)
+        return timers
+
+    def check(self, run_dir, test, job_row, slurm_job=None):
+        ''' Save the timers of a finished run and return a comment
+            comparing them with the base branch history '''
+        if job_row is None or not job_row['sha']:
+            return ''
+        timers = parse_gptl(run_dir)
+        wall_time = elapsed_seconds(slurm_job.elapsed) if slurm_job \
+            else None
+        if wall_time is not None:
+            timers['wall_time'] = wall_time
+        if not timers:
+            return ''
+        try:
+            base = self.base_timers(job_row, test)
+        except OSError as e:
+            self.logger.info(f'Could not read base history. Exception:{e}')
+            base = {}
+        self.store.add_timings(job_row, test, timers)
+        if not base:
+            return f'Saved {len(timers)} timers, no base branch runs ' \
+                   'to compare with yet'
+        return self.table(timers, base)
+
+    def table(self, timers, base):
+        ''' Markdown table of the timers that changed the most '''
+        changes = []
+        for timer, seconds in timers.items():
+            if timer not in base:
+                continue
+            base_seconds = statistics.median(base[timer])
+            if base_seconds <= 0:
+                continue
+            change = seconds / base_seconds - 1
+            flagged = change > self.threshold and \
+                base_seconds >= self.min_seconds
+            changes.append((timer, base_seconds, seconds, change, flagged))
+        # Regressions first, then the largest changes either way
+        changes.sort(key=lambda row: (not row[4], -abs(row[3])))
+        slower = sum(1 for row in changes if row[4])
+        runs = max(len(seconds) for seconds in base.values())
+        lines = [f'Timers against the median of {runs} base branch runs '
+                 f'(threshold {self.threshold:.0%}):']
+        if slower:
+            lines.append(f'Performance regression in {slower} timers')
+        lines += ['| timer | base (s) | this run (s) | change |',
+                  '|---|---|---|---|']
+        for timer, base_seconds, seconds, change, flagged in \
+                changes[:TABLE_ROWS]:
+            note = ' slower' if flagged else \
+                ' faster' if change < -self.threshold else ''
+            lines.append(f'| {timer} | {base_seconds:.3f} | {seconds:.3f} '
+                         f'| {change:+.1%}{note} |')
+        return '\n'.join(lines)
@@ -0,0 +1,159 @@
+"""
+Name: runner.py
+Runs a shell command while streaming its output line by line to a
+rotating log file. Only a bounded tail of the output is kept in memory,
+for logging and PR comments when the command fails.
+A command runs in its own process group, which is killed when the
+command times out or is cancelled.
+"""
+
+# Imports
+import collections
+import os
+import signal
+import subprocess
+import threading
+import time
+
+# Size of one command log before it is rotated, and rotated files kept
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUPS = 3
+# Output lines kept in memory
+TAIL_LINES = 200
+# Seconds between SIGTERM and SIGKILL when a command is stopped
+KILL_GRACE = 10
+
+CommandResult = collections.namedtuple(
+    'CommandResult',
+    ['command', 'cwd', 'returncode', 'wall_time', 'max_rss_kb',
+     'log_file', 'tail', 'killed_by'])
+
+
+class CommandFailed(Exception):
+    ''' A command exited with a non-zero exit code '''
+
+    def __init__(self, result):
+        super().__init__(f'`{result.command}` exited with '
+                         f'{result.returncode} after '
+                         f'{result.wall_time:.0f} s')
+        self.result = result
+
+
+class CommandTimeout(CommandFailed):
+    ''' A command ran longer than its timeout and was killed '''
+
+    def __init__(self, result, timeout):
+        super(CommandFailed, self).__init__(
+            f'`{result.command}` timed out after {timeout} s')
+        self.result = result
+
+
+class JobCancelled(Exception):
+    ''' The job was cancelled while it was running '''
+
+
+class RotatingOutput:
+    ''' Appends lines to a log file, rotating it to log_file.1,
+        log_file.2, ... when it grows past max_bytes '''
+
+    def __init__(self, log_file, max_bytes=LOG_MAX_BYTES,
+                 backups=LOG_BACKUPS):
+        self.log_file = log_file
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.fname = open(log_file, 'ab')
+
+    def write(self, data):
+        if self.fname.tell() + len(data) > self.max_bytes:
+            self.rotate()
+        self.fname.write(data)
+
+    def rotate(self):
+        self.fname.close()
+        for index in range(self.backups - 1, 0, -1):
+            older = f'{self.log_file}.{index}'
+            if os.path.exists(older):
+                os.replace(older, f'{self.log_file}.{index + 1}')
+        if self.backups:
+            os.replace(self.log_file, f'{self.log_file}.1')
+        self.fname = open(self.log_file, 'wb')
+
+    def close(self):
+        self.fname.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def kill_group(process, finished):
+    ''' Stop a command and everything it started '''
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        if not finished.wait(KILL_GRACE):
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def watchdog(process, finished, timeout, cancel_event, killed_by):
+    ''' Kill the command when it times out or the job is cancelled '''
+    deadline = time.time() + timeout if timeout else None
+    while not finished.wait(1):
+        if cancel_event is not None and cancel_event.is_set():
+            killed_by.append('cancel')
+        elif deadline and time.time() > deadline:
+            killed_by.append('timeout')
+        else:
+            continue
+        kill_group(process, finished)
+        return
+
+
+def run_command(command, cwd, log_file, timeout=None, cancel_event=None,
+                tail_lines=TAIL_LINES):
+    ''' Run command through the shell in cwd, stream its combined
+        stdout/stderr to log_file and return a CommandResult.
+        The command is killed after timeout seconds, or when
+        cancel_event is set; killed_by then says which. '''
+    start = time.time()
+    tail = collections.deque(maxlen=tail_lines)
+    # The commands use bash redirections (>&), /bin/sh is not bash
+    # everywhere
+    process = subprocess.Popen(command, shell=True, cwd=cwd,
+                               executable='/bin/bash',
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    finished = threading.Event()
+    killed_by = []
+    guard = threading.Thread(target=watchdog,
+                             args=(process, finished, timeout, cancel_event,
+                                   killed_by),
+                             name=f'{threading.current_thread().name}'
+                                  '/watchdog',
+                             daemon=True)
+    guard.start()
+    try:
+        with RotatingOutput(log_file) as output:
+            for line in process.stdout:
+                output.write(line)
+                tail.append(line.decode('utf8', errors='replace')
+                            .rstrip('\n'))
+        process.stdout.close()
+
+        # wait4 also returns the resource usage of the finished command
+        _, status, usage = os.wait4(process.pid, 0)
+    finally:
+        finished.set()
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    process.returncode = returncode
+
+    return CommandResult(command, cwd, returncode, time.time() - start,
+                         usage.ru_maxrss, log_file, list(tail),
+                         killed_by[0] if killed_by else None)
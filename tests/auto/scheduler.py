@@ -0,0 +1,222 @@
+"""
+Name: scheduler.py
+Runs Job objects from ci_auto.py concurrently on a bounded set of worker
+threads, with limits per machine and per compiler.
+A PR/label has one job at a time. A job for a newer head commit of the
+PR supersedes the one already queued or running: that one is cancelled
+and the new one starts once it has stopped.
+"""
+
+# Imports
+import datetime
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from metrics import event, observe, set_context, span
+
+# Start of the cancel reason of a job replaced by one for a newer commit
+SUPERSEDED = 'superseded by'
+
+
+def head_sha(job):
+    return job.preq_dict['preq'].head.sha
+
+
+class JobLogFilter(logging.Filter):
+    ''' Pass only the records emitted from one job's worker thread '''
+
+    def __init__(self, thread_name):
+        super().__init__()
+        self.thread_name = thread_name
+
+    def filter(self, record):
+        # Helper threads of a job are named <job key>/<helper>
+        return record.threadName == self.thread_name or \
+            record.threadName.startswith(f'{self.thread_name}/')
+
+
+class JobScheduler:
+    '''
+    This class runs Jobs concurrently on worker threads
+    ...
+
+    Attributes
+    ----------
+    max_jobs : int
+        Maximum number of jobs running at once on this machine
+    max_per_compiler : int
+        Maximum number of jobs running at once for each compiler
+    lockdir : str
+        Directory holding the per PR/label lock files, shared by every
+        ci_auto.py process on this machine
+    queued : dict
+        Jobs submitted and not finished, waiting or running, by key
+    workers : dict
+        Worker thread of each job in queued, by key
+    '''
+
+    def __init__(self, max_jobs, max_per_compiler, lockdir):
+        self.logger = logging.getLogger('SCHEDULER')
+        self.max_jobs = max_jobs
+        self.max_per_compiler = max_per_compiler
+        self.lockdir = lockdir
+        self.machine_slots = threading.BoundedSemaphore(max_jobs)
+        self.compiler_slots = {}
+        self.active_keys = set()
+        self.queued = {}
+        self.workers = {}
+        self.running = {}
+        self.threads = []
+        self.stopping = False
+        self.lock = threading.Lock()
+        os.makedirs(self.lockdir, exist_ok=True)
+
+    def _compiler_slot(self, compiler):
+        with self.lock:
+            if compiler not in self.compiler_slots:
+                self.compiler_slots[compiler] = \
+                    threading.BoundedSemaphore(self.max_per_compiler)
+            return self.compiler_slots[compiler]
+
+    def _acquire_key_lock(self, key):
+        ''' Take an exclusive lock file for the PR/label so that no other
+            ci_auto.py process works on it at the same time '''
+        lock_file = os.path.join(self.lockdir, f'{key}.lock')
+        fd = open(lock_file, 'w')
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fd.close()
+            return None
+        fd.write(f'{os.getpid()}\n')
+        fd.flush()
+        return fd
+
+    def submit(self, job):
+        ''' Queue a job unless the same PR/label is already being handled
+            for the same commit. A job for another commit supersedes the
+            one being handled. '''
+        previous = None
+        with self.lock:
+            if self.stopping:
+                return False
+            if job.key in self.active_keys:
+                old_job = self.queued.get(job.key)
+                if old_job is None or head_sha(old_job) == head_sha(job) or \
+                        old_job.cancel_event.is_set():
+                    self.logger.info(f'Skipping {job.key}: already queued')
+                    return False
+                old_job.cancel(f'{SUPERSEDED} {head_sha(job)}')
+                previous = self.workers[job.key]
+            self.active_keys.add(job.key)
+            self.queued[job.key] = job
+            job.submitted = time.time()
+            thread = threading.Thread(target=self._worker,
+                                      args=(job, previous),
+                                      name=job.key, daemon=True)
+            self.workers[job.key] = thread
+            self.threads = [old_thread for old_thread in self.threads
+                            if old_thread.is_alive()] + [thread]
+        thread.start()
+        self.logger.info(f'Queued {job.key}')
+        return True
+
+    def _release_key(self, job):
+        with self.lock:
+            self.running.pop(job.key, None)
+            # A job superseding this one has taken the key over
+            if self.queued.get(job.key) is job:
+                self.queued.pop(job.key)
+                self.workers.pop(job.key, None)
+                self.active_keys.discard(job.key)
+
+    def _worker(self, job, previous=None):
+        logger = logging.getLogger('SCHEDULER/WORKER')
+        if previous is not None:
+            # The superseded job stops at its next command or sleep
+            logger.info(f'Waiting for the superseded {job.key} to stop')
+            previous.join()
+        key_lock = self._acquire_key_lock(job.key)
+        if key_lock is None:
+            logger.info(f'Skipping {job.key}: locked by another process')
+            self._release_key(job)
+            return
+
+        handler = logging.FileHandler(
+            f'ci_auto_'
+            f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}_'
+            f'{job.key}.log', mode='w')
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s:%(name)s:%(message)s'))
+        handler.addFilter(JobLogFilter(job.key))
+        logging.getLogger().addHandler(handler)
+        try:
+            with self._compiler_slot(job.compiler), self.machine_slots:
+                with self.lock:
+                    if self.stopping:
+                        # Label was not touched yet, a restart picks it up
+                        logger.info(f'Not starting {job.key}: shutting down')
+                        return
+                    self.running[job.key] = job
+                preq = job.preq_dict['preq']
+                set_context(job=job.key, repo=job.repo['address'],
+                            pr=preq.number, sha=head_sha(job),
+                            action=job.preq_dict['action'],
+                            compiler=job.compiler)
+                queue_wait = time.time() - job.submitted
+                observe('ci_span_seconds', queue_wait, span='queue_wait')
+                event('span', span='queue_wait', parent='',
+                      start=round(job.submitted, 3),
+                      seconds=round(queue_wait, 3), outcome='ok')
+                logger.info(f'Starting {job.key}')
+                with span('job'):
+                    job.run()
+        except Exception as e:
+            logger.critical(f'{job.key} FAILED. Exception:{e}')
+        finally:
+            logger.info(f'Finished {job.key}')
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+            fcntl.flock(key_lock, fcntl.LOCK_UN)
+            key_lock.close()
+            self._release_key(job)
+
+    def cancel_pr(self, pr_id, reason):
+        ''' Cancel the queued and running jobs of a PR. Returns the
+            cancelled jobs. '''
+        with self.lock:
+            jobs = [job for job in self.queued.values()
+                    if job.preq_dict['preq'].id == pr_id]
+        for job in jobs:
+            job.cancel(reason)
+        return jobs
+
+    def wait(self):
+        ''' Block until every submitted job has finished '''
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join()
+
+    def shutdown(self, grace, kill_grace=30):
+        ''' Stop starting queued jobs and give running jobs up to grace
+            seconds to finish, then cancel the rest.
+            Returns the jobs that were cancelled. '''
+        with self.lock:
+            self.stopping = True
+            threads = list(self.threads)
+        deadline = time.time() + grace
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        with self.lock:
+            unfinished = list(self.running.values())
+        for job in unfinished:
+            self.logger.info(f'Job still running at shutdown: {job.key}')
+            job.cancel('shutdown')
+        deadline = time.time() + kill_grace
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        return unfinished
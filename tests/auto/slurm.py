@@ -0,0 +1,182 @@
+"""
+Name: slurm.py
+Queries Slurm for the state of submitted experiments. All tracked jobs
+are looked up with a single sacct call per poll, with squeue as the
+fallback when accounting is not available. Jobs of superseded tests
+are cancelled with one scancel call.
+The commands can be replaced, e.g. by fake scripts for testing, through
+the CI_SACCT, CI_SQUEUE and CI_SCANCEL environment variables.
+"""
+
+# Imports
+import collections
+import datetime
+import logging
+import os
+import re
+import subprocess
+
+SACCT = os.environ.get('CI_SACCT', 'sacct')
+SQUEUE = os.environ.get('CI_SQUEUE', 'squeue')
+SCANCEL = os.environ.get('CI_SCANCEL', 'scancel')
+
+# States after which a job will not run any more
+TERMINAL_STATES = ['BOOT_FAIL', 'CANCELLED', 'COMPLETED', 'DEADLINE',
+                   'FAILED', 'NODE_FAIL', 'OUT_OF_MEMORY', 'PREEMPTED',
+                   'REVOKED', 'TIMEOUT']
+
+RSS_UNITS = {'K': 1, 'M': 1024, 'G': 1024 ** 2, 'T': 1024 ** 3}
+
+# Submit and Start are sacct timestamps, None from squeue
+SlurmJob = collections.namedtuple('SlurmJob',
+                                  ['job_id', 'state', 'elapsed', 'max_rss',
+                                   'submit', 'start'])
+
+
+def parse_job_id(submit_log):
+    ''' Slurm job ID from the output of sbatch, or None '''
+    if not os.path.exists(submit_log):
+        return None
+    with open(submit_log) as fname:
+        match = re.search(r'Submitted batch job (\d+)', fname.read())
+    return match.group(1) if match else None
+
+
+def expand_array_id(job_id):
+    ''' Element IDs of a job array record such as 123_[0-3,5%2], which
+        sacct and squeue print for elements that have not started '''
+    match = re.match(r'(\d+)_\[([^\]]*)\]$', job_id)
+    if not match:
+        return [job_id]
+    elements = []
+    # A %N suffix limits how many elements run at once
+    for part in match.group(2).split('%')[0].split(','):
+        first, _, last = part.partition('-')
+        elements += [f'{match.group(1)}_{index}'
+                     for index in range(int(first), int(last or first) + 1)]
+    return elements
+
+
+def is_terminal(state):
+    return state in TERMINAL_STATES
+
+
+def rss_kb(text):
+    ''' Convert a sacct MaxRSS value such as 1234K or 1.5G to kB '''
+    match = re.match(r'([\d.]+)([KMGT]?)', text or '')
+    if not match:
+        return 0
+    return int(float(match.group(1)) * RSS_UNITS.get(match.group(2), 1)
+               / (1024 if not match.group(2) else 1))
+
+
+def elapsed_seconds(elapsed):
+    ''' Seconds of a Slurm elapsed time, [D-]HH:MM:SS or MM:SS, or None
+        for a value that is not a time, such as INVALID or UNLIMITED
+        from squeue '''
+    match = re.match(r'(?:(\d+)-)?([\d:.]+)$', (elapsed or '').strip())
+    if not match:
+        return None
+    days, clock = match.groups()
+    seconds = 0
+    for part in clock.split(':'):
+        try:
+            seconds = seconds * 60 + float(part or 0)
+        except ValueError:
+            return None
+    return seconds + int(days or 0) * 86400
+
+
+def queue_seconds(slurm_job):
+    ''' Seconds a job waited in the Slurm queue, from its Submit and
+        Start times, or None if it has not started (Start is Unknown) '''
+    try:
+        submit, start = [
+            datetime.datetime.strptime(stamp or '', '%Y-%m-%dT%H:%M:%S')
+            for stamp in [slurm_job.submit, slurm_job.start]]
+    except ValueError:
+        return None
+    return max((start - submit).total_seconds(), 0)
+
+
+def format_job(slurm_job):
+    ''' One line summary for logs and PR comments '''
+    return f'Slurm job {slurm_job.job_id}: {slurm_job.state}, ' \
+           f'elapsed {slurm_job.elapsed}, MaxRSS {slurm_job.max_rss} kB'
+
+
+def query_jobs(job_ids):
+    ''' Return {job id: SlurmJob} for the given Slurm job IDs, which can
+        be job array elements (123_4), looked up with one sacct call
+        (or one squeue call) '''
+    logger = logging.getLogger('SLURM/QUERY_JOBS')
+    job_ids = sorted(set(str(job_id) for job_id in job_ids if job_id))
+    if not job_ids:
+        return {}
+    try:
+        return _sacct(job_ids)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.info(f'sacct failed, using squeue. Exception:{e}')
+    try:
+        return _squeue(job_ids)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.critical(f'squeue failed. Exception:{e}')
+        return {}
+
+
+def cancel_jobs(job_ids):
+    ''' Cancel the given Slurm jobs or job array elements with one
+        scancel call. Returns whether scancel succeeded, which it does
+        not for jobs that already left the queue. '''
+    logger = logging.getLogger('SLURM/CANCEL_JOBS')
+    job_ids = sorted(set(str(job_id) for job_id in job_ids if job_id))
+    if not job_ids:
+        return True
+    logger.info(f'Cancelling Slurm jobs {job_ids}')
+    try:
+        subprocess.run([SCANCEL] + job_ids, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE, check=True,
+                       universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.info(f'scancel failed. Exception:{e}')
+        return False
+    return True
+
+
+def _sacct(job_ids):
+    output = subprocess.run(
+        [SACCT, '-j', ','.join(job_ids), '--noheader', '--parsable2',
+         '--format=JobID,State,Elapsed,MaxRSS,Submit,Start'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+        universal_newlines=True).stdout
+    jobs = {}
+    max_rss = collections.defaultdict(int)
+    for line in output.splitlines():
+        fields = line.split('|')
+        if len(fields) < 6:
+            continue
+        step_id, state, elapsed, rss, submit, start = fields[:6]
+        # Steps (123.batch, 123_4.0) carry the memory use of the job
+        job_id = step_id.split('.')[0]
+        max_rss[job_id] = max(max_rss[job_id], rss_kb(rss))
+        if '.' not in step_id:
+            # "CANCELLED by 1234" -> CANCELLED
+            for element_id in expand_array_id(job_id):
+                jobs[element_id] = SlurmJob(element_id, state.split()[0],
+                                            elapsed, 0, submit, start)
+    return {job_id: slurm_job._replace(max_rss=max_rss[job_id])
+            for job_id, slurm_job in jobs.items()}
+
+
+def _squeue(job_ids):
+    output = subprocess.run(
+        [SQUEUE, '-h', '-r', '-j', ','.join(job_ids), '-o', '%i|%T|%M'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+        universal_newlines=True).stdout
+    jobs = {}
+    for line in output.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) == 3:
+            jobs[fields[0]] = SlurmJob(fields[0], fields[1], fields[2], 0,
+                                       None, None)
+    return jobs
@@ -8,10 +8,11 @@ set -eu
 
 function usage {
   echo
-  echo "Usage: $0 machine py_prog | -h"
+  echo "Usage: $0 machine py_prog [py_args...] | -h"
   echo
   echo "       machine       [required] is one of: ${machines[@]}"
   echo "       py_prog       [required] Python program to run"
+  echo "       py_args       [optional] arguments for py_prog, e.g. --daemon"
   echo "       -h            display this help"
   echo
   return 1
@@ -42,6 +43,5 @@ else
   exit 1
 fi
 
-python ${py_prog}
-
-exit 0
+# exec so that SIGTERM reaches the Python program in daemon mode
+exec python ${py_prog} "${@:3}"
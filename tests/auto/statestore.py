@@ -0,0 +1,395 @@
+"""
+Name: statestore.py
+SQLite store for the state shared by ci_auto and ci_long: the CI jobs
+that ran and the long running experiments they submitted, with their
+Slurm job IDs, PR comment IDs, log offsets and timings, and the queue
+of received webhook events.
+The database runs in WAL mode, so readers do not block the writer, and
+every change is made in one transaction. Experiments that are no longer
+running are kept, with their final state, as a history.
+Replaces Longjob.cfg; an existing Longjob.cfg is imported once.
+"""
+
+# Imports
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from configparser import ConfigParser as config_parser
+
+# Schema changes, applied in order. PRAGMA user_version holds the number
+# of migrations already applied to a database.
+MIGRATIONS = [
+    ['''CREATE TABLE jobs (
+            id INTEGER PRIMARY KEY,
+            pr_repo TEXT NOT NULL,
+            pr_num INTEGER NOT NULL,
+            label TEXT NOT NULL,
+            machine TEXT NOT NULL,
+            compiler TEXT NOT NULL,
+            action TEXT NOT NULL,
+            state TEXT NOT NULL,
+            started REAL NOT NULL,
+            finished REAL)''',
+     'CREATE INDEX jobs_pr ON jobs (pr_repo, pr_num, state)',
+     '''CREATE TABLE experiments (
+            log_path TEXT PRIMARY KEY,
+            job_id INTEGER REFERENCES jobs (id),
+            expt TEXT NOT NULL,
+            machine TEXT NOT NULL,
+            pr_repo TEXT NOT NULL,
+            pr_num INTEGER NOT NULL,
+            comment_id INTEGER,
+            slurm_id TEXT,
+            state TEXT NOT NULL,
+            slurm_state TEXT,
+            elapsed TEXT,
+            max_rss_kb INTEGER,
+            log_inode INTEGER NOT NULL DEFAULT 0,
+            log_offset INTEGER NOT NULL DEFAULT 0,
+            log_head INTEGER NOT NULL DEFAULT 0,
+            submitted REAL NOT NULL,
+            finished REAL)''',
+     'CREATE INDEX experiments_state ON experiments (state)',
+     'CREATE INDEX experiments_pr ON experiments (pr_repo, pr_num, state)'],
+    ['ALTER TABLE jobs ADD COLUMN base TEXT',
+     'ALTER TABLE jobs ADD COLUMN sha TEXT',
+     '''CREATE TABLE timings (
+            id INTEGER PRIMARY KEY,
+            sha TEXT NOT NULL,
+            machine TEXT NOT NULL,
+            compiler TEXT NOT NULL,
+            test TEXT NOT NULL,
+            timer TEXT NOT NULL,
+            seconds REAL NOT NULL,
+            pr_repo TEXT NOT NULL,
+            pr_num INTEGER NOT NULL,
+            recorded REAL NOT NULL)''',
+     'CREATE INDEX timings_test ON timings (machine, compiler, test, '
+     'recorded)',
+     '''CREATE TABLE base_commits (
+            pr_repo TEXT NOT NULL,
+            sha TEXT NOT NULL,
+            PRIMARY KEY (pr_repo, sha))'''],
+    ['''CREATE TABLE webhook_events (
+            id INTEGER PRIMARY KEY,
+            delivery TEXT UNIQUE,
+            event TEXT NOT NULL,
+            action TEXT,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL,
+            received REAL NOT NULL,
+            handled REAL)''',
+     'CREATE INDEX webhook_events_state ON webhook_events (state, id)'],
+]
+
+# Seconds a writer waits for another one to finish
+BUSY_TIMEOUT = 60
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(path):
+    ''' The StateStore of the database at path, shared by all threads
+        of the process '''
+    path = os.path.abspath(path)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = StateStore(path)
+        return _stores[path]
+
+
+class StateStore:
+    '''
+    This class keeps CI jobs and experiments in an SQLite database
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Database file
+    '''
+
+    def __init__(self, path):
+        self.logger = logging.getLogger('STATESTORE')
+        self.path = path
+        # sqlite3 connections can not be shared between threads
+        self.local = threading.local()
+        self.migrate()
+
+    @classmethod
+    def from_config(cls, file_name='CImachine.cfg'):
+        ''' Open the database named by the optional state_db entry
+            of the machine config file '''
+        config = config_parser()
+        config.read(file_name)
+        return open_store(config['DEFAULT'].get('state_db',
+                                                fallback='ci_state.db'))
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Transactions are started explicitly in transaction()
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                                   isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self.local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        ''' Run the block in one write transaction, rolled back if the
+            block raises '''
+        conn = self.connection()
+        # IMMEDIATE takes the write lock now, so two processes can not
+        # both read and then overwrite each other's changes
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def migrate(self):
+        with self.transaction() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number, statements in enumerate(MIGRATIONS[version:],
+                                                version + 1):
+                self.logger.info(f'{self.path}: applying migration {number}')
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {number}')
+
+    # Jobs
+
+    def start_job(self, job_obj):
+        ''' Record a job that starts running, return its id '''
+        preq = job_obj.preq_dict['preq']
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                'INSERT INTO jobs (pr_repo, pr_num, base, label, machine,'
+                ' compiler, action, state, started)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_obj.repo['address'], preq.number, job_obj.repo['base'],
+                 job_obj.preq_dict['label'].name, job_obj.machine,
+                 job_obj.compiler, job_obj.preq_dict['action'], 'running',
+                 time.time()))
+        return cursor.lastrowid
+
+    def finish_job(self, job_id, state):
+        with self.transaction() as conn:
+            conn.execute('UPDATE jobs SET state = ?, finished = ? '
+                         'WHERE id = ?', (state, time.time(), job_id))
+
+    def set_job_sha(self, job_id, sha):
+        ''' Record the commit a job tested '''
+        with self.transaction() as conn:
+            conn.execute('UPDATE jobs SET sha = ? WHERE id = ?',
+                         (sha, job_id))
+
+    def job(self, job_id):
+        ''' The job with this id, or None '''
+        if job_id is None:
+            return None
+        return self.connection().execute('SELECT * FROM jobs WHERE id = ?',
+                                         (job_id,)).fetchone()
+
+    def jobs(self, pr_repo, pr_num, state=None):
+        ''' Jobs of a PR, newest first '''
+        query = 'SELECT * FROM jobs WHERE pr_repo = ? AND pr_num = ?'
+        args = [pr_repo, pr_num]
+        if state:
+            query += ' AND state = ?'
+            args.append(state)
+        return self.connection().execute(query + ' ORDER BY id DESC',
+                                         args).fetchall()
+
+    # Experiments
+
+    def add_experiment(self, log_path, expt, job_obj, comment_id,
+                       slurm_id=None, log_state=None):
+        ''' Track an experiment that is still running '''
+        log_state = log_state or {'inode': 0, 'offset': 0, 'head': 0}
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO experiments (log_path, job_id, expt,'
+                ' machine, pr_repo, pr_num, comment_id, slurm_id, state,'
+                ' log_inode, log_offset, log_head, submitted)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (log_path, getattr(job_obj, 'job_id', None), expt,
+                 job_obj.machine, job_obj.repo['address'],
+                 job_obj.preq_dict['preq'].number, comment_id, slurm_id,
+                 'running', log_state['inode'], log_state['offset'],
+                 log_state['head'], time.time()))
+
+    def experiments(self, state='running', pr_repo=None, pr_num=None):
+        ''' Experiments in a state, optionally only those of one PR '''
+        query = 'SELECT * FROM experiments WHERE state = ?'
+        args = [state]
+        if pr_repo is not None:
+            query += ' AND pr_repo = ? AND pr_num = ?'
+            args += [pr_repo, pr_num]
+        return self.connection().execute(query + ' ORDER BY submitted',
+                                         args).fetchall()
+
+    def comment_experiments(self, comment_id):
+        ''' All experiments reported in one PR comment, in any state '''
+        return self.connection().execute(
+            'SELECT * FROM experiments WHERE comment_id = ?'
+            ' ORDER BY submitted', (comment_id,)).fetchall()
+
+    @staticmethod
+    def log_state(expt_row):
+        ''' LogWatcher state saved with an experiment '''
+        return {'inode': expt_row['log_inode'],
+                'offset': expt_row['log_offset'],
+                'head': expt_row['log_head']}
+
+    def update_experiment(self, log_path, log_state, slurm_job=None):
+        ''' Save how far the log of a running experiment has been read,
+            and its latest Slurm state '''
+        with self.transaction() as conn:
+            conn.execute(
+                'UPDATE experiments SET log_inode = ?, log_offset = ?,'
+                ' log_head = ?, slurm_state = COALESCE(?, slurm_state),'
+                ' elapsed = COALESCE(?, elapsed),'
+                ' max_rss_kb = COALESCE(?, max_rss_kb)'
+                ' WHERE log_path = ? AND state = ?',
+                (log_state['inode'], log_state['offset'], log_state['head'],
+                 *self._slurm_fields(slurm_job), log_path, 'running'))
+
+    def finish_experiment(self, log_path, state, slurm_job=None):
+        ''' Mark a running experiment succeeded or failed. Returns False
+            if it was no longer running, e.g. superseded meanwhile. '''
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                'UPDATE experiments SET state = ?, finished = ?,'
+                ' slurm_state = COALESCE(?, slurm_state),'
+                ' elapsed = COALESCE(?, elapsed),'
+                ' max_rss_kb = COALESCE(?, max_rss_kb)'
+                ' WHERE log_path = ? AND state = ?',
+                (state, time.time(), *self._slurm_fields(slurm_job),
+                 log_path, 'running'))
+        return cursor.rowcount == 1
+
+    def supersede_experiments(self, pr_repo, pr_num, action=None,
+                              sha=None):
+        ''' Stop tracking the running experiments of a PR when a new test
+            of it starts: those of jobs with the same action and another
+            commit, or all of them if action is None. Experiments without
+            a job, imported from Longjob.cfg, are always superseded.
+            Returns the superseded experiments. '''
+        query = 'SELECT experiments.* FROM experiments' \
+                ' LEFT JOIN jobs ON jobs.id = experiments.job_id' \
+                ' WHERE experiments.pr_repo = ? AND experiments.pr_num = ?' \
+                ' AND experiments.state = ?'
+        args = [pr_repo, pr_num, 'running']
+        if action is not None:
+            query += ' AND (jobs.id IS NULL OR (jobs.action = ? AND' \
+                     ' (jobs.sha IS NULL OR jobs.sha != ?)))'
+            args += [action, sha]
+        with self.transaction() as conn:
+            rows = conn.execute(query, args).fetchall()
+            conn.executemany(
+                'UPDATE experiments SET state = ?, finished = ?'
+                ' WHERE log_path = ? AND state = ?',
+                [('superseded', time.time(), row['log_path'], 'running')
+                 for row in rows])
+        return rows
+
+    # Webhook events
+
+    def add_webhook_event(self, delivery, event, action, payload):
+        ''' Queue a webhook delivery. Returns False if it was already
+            queued, GitHub redelivers on timeouts. '''
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO webhook_events (delivery, event,'
+                ' action, payload, state, received)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (delivery, event, action, payload, 'queued', time.time()))
+        return cursor.rowcount == 1
+
+    def webhook_events(self, state='queued'):
+        ''' Webhook events in a state, oldest first '''
+        return self.connection().execute(
+            'SELECT * FROM webhook_events WHERE state = ? ORDER BY id',
+            (state,)).fetchall()
+
+    def finish_webhook_event(self, event_id, state):
+        with self.transaction() as conn:
+            conn.execute('UPDATE webhook_events SET state = ?, handled = ?'
+                         ' WHERE id = ?', (state, time.time(), event_id))
+
+    # Timings
+
+    def add_timings(self, job_row, test, timers):
+        ''' Save the timers (name: seconds) of a test run of a job '''
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                'INSERT INTO timings (sha, machine, compiler, test, timer,'
+                ' seconds, pr_repo, pr_num, recorded)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(job_row['sha'], job_row['machine'], job_row['compiler'],
+                  test, timer, seconds, job_row['pr_repo'],
+                  job_row['pr_num'], now)
+                 for timer, seconds in timers.items()])
+
+    def timings(self, machine, compiler, test):
+        ''' Saved timers of a test on one machine and compiler,
+            newest first '''
+        return self.connection().execute(
+            'SELECT * FROM timings WHERE machine = ? AND compiler = ?'
+            ' AND test = ? ORDER BY recorded DESC',
+            (machine, compiler, test)).fetchall()
+
+    def is_base_commit(self, pr_repo, sha):
+        return self.connection().execute(
+            'SELECT 1 FROM base_commits WHERE pr_repo = ? AND sha = ?',
+            (pr_repo, sha)).fetchone() is not None
+
+    def add_base_commit(self, pr_repo, sha):
+        ''' Remember that a commit is on the base branch of a repo '''
+        with self.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO base_commits (pr_repo, sha)'
+                         ' VALUES (?, ?)', (pr_repo, sha))
+
+    @staticmethod
+    def _slurm_fields(slurm_job):
+        if slurm_job is None:
+            return None, None, None
+        return slurm_job.state, slurm_job.elapsed, slurm_job.max_rss
+
+    def import_longjob_cfg(self, file_name='Longjob.cfg'):
+        ''' Move the experiments of an old Longjob.cfg into the store.
+            The file is renamed afterwards, so this runs only once. '''
+        if not os.path.exists(file_name):
+            return 0
+        config = config_parser()
+        config.read(file_name)
+        with self.transaction() as conn:
+            for log_path in config.sections():
+                section = config[log_path]
+                conn.execute(
+                    'INSERT OR IGNORE INTO experiments (log_path, expt,'
+                    ' machine, pr_repo, pr_num, comment_id, slurm_id, state,'
+                    ' log_inode, log_offset, log_head, submitted)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (log_path, section['expt'], section['machine'],
+                     section['pr_repo'], int(section['pr_num']),
+                     int(section['issue_id']), section.get('slurm_id'),
+                     'running', int(section.get('log_inode', 0)),
+                     int(section.get('log_offset', 0)),
+                     int(section.get('log_head', 0)),
+                     os.path.getmtime(file_name)))
+        os.replace(file_name, f'{file_name}.imported')
+        self.logger.info(f'Imported {len(config.sections())} experiments '
+                         f'from {file_name}')
+        return len(config.sections())
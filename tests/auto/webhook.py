@@ -0,0 +1,167 @@
+"""
+Name: webhook.py
+Optional HTTP listener for GitHub webhooks, so labeled PRs are seen as
+soon as GitHub sends the event instead of at the next poll.
+pull_request deliveries with the actions in HANDLED_ACTIONS are checked
+against their X-Hub-Signature-256 HMAC and queued in the state store,
+where ci_auto.py turns them into Jobs. The queue is durable: events
+received while ci_auto.py was busy or stopped are handled after it.
+Polling stays as a slower reconciliation in case a delivery is lost.
+"""
+
+# Imports
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+HANDLED_ACTIONS = ['labeled', 'synchronize', 'closed']
+
+# GitHub does not send larger payloads
+MAX_PAYLOAD_BYTES = 25 * 1024 * 1024
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    ''' HTTP server with a thread per request. Python 3.6 has no
+        http.server.ThreadingHTTPServer. '''
+    daemon_threads = True
+
+
+def signature(secret, body):
+    ''' X-Hub-Signature-256 header value of a payload '''
+    return 'sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret, body, header):
+    return header is not None and \
+        hmac.compare_digest(signature(secret, body), header)
+
+
+def read_secret(file_name='webhook_secret'):
+    ''' The webhook secret, from a file only its owner can read '''
+    if not os.path.exists(file_name):
+        raise FileNotFoundError(f'Cannot find file "{file_name}"')
+    if os.stat(file_name).st_mode & 0o077:
+        raise Exception(f'File permission of {file_name} needs to be "600"')
+    with open(file_name, 'rb') as fname:
+        return fname.read().strip()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    ''' Answers one delivery; the server holds the receiver '''
+
+    def log_message(self, format, *args):
+        self.server.receiver.logger.info(format % args)
+
+    def reply(self, status, text):
+        body = f'{text}\n'.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_PAYLOAD_BYTES:
+            self.reply(413, 'payload too large')
+            return
+        body = self.rfile.read(length)
+        if not verify_signature(receiver.secret, body,
+                                self.headers.get('X-Hub-Signature-256')):
+            receiver.logger.info(f'Bad signature from {self.client_address}')
+            self.reply(401, 'bad signature')
+            return
+        event = self.headers.get('X-GitHub-Event', '')
+        delivery = self.headers.get('X-GitHub-Delivery')
+        status, text = receiver.receive(event, delivery, body)
+        self.reply(status, text)
+
+
+class WebhookReceiver:
+    '''
+    This class runs the webhook listener on its own threads
+    ...
+
+    Attributes
+    ----------
+    store : StateStore
+        Database holding the event queue
+    secret : bytes
+        Shared secret of the webhook on GitHub
+    host : str
+        Address to listen on
+    port : int
+        Port to listen on
+    record_dir : str
+        If set, every accepted delivery is also saved there, in the
+        format fake_github.py replays
+    on_queued : function
+        Called after an event is queued, e.g. to wake the daemon
+    '''
+
+    def __init__(self, store, secret, host='127.0.0.1', port=8080,
+                 record_dir=None, on_queued=None):
+        self.logger = logging.getLogger('WEBHOOK')
+        self.store = store
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.record_dir = record_dir
+        self.server = None
+        self.on_queued = on_queued
+
+    def receive(self, event, delivery, body):
+        ''' Queue a verified delivery. Returns the HTTP status and text
+            of the reply. '''
+        if event == 'ping':
+            return 200, 'pong'
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, 'payload is not JSON'
+        action = payload.get('action')
+        if event != 'pull_request' or action not in HANDLED_ACTIONS:
+            return 202, f'ignored {event} {action}'
+        if self.record_dir:
+            self.record(event, delivery, payload)
+        if not self.store.add_webhook_event(delivery, event, action,
+                                            body.decode('utf8')):
+            return 200, 'already queued'
+        pull = payload.get('pull_request', {})
+        self.logger.info(f'Queued {event} {action} of '
+                         f'{payload.get("repository", {}).get("full_name")}'
+                         f'#{pull.get("number")} ({delivery})')
+        if self.on_queued:
+            self.on_queued()
+        return 202, 'queued'
+
+    def record(self, event, delivery, payload):
+        os.makedirs(self.record_dir, exist_ok=True)
+        name = f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")}_' \
+               f'{event}_{payload["action"]}.json'
+        with open(os.path.join(self.record_dir, name), 'w') as fname:
+            json.dump({'event': event, 'delivery': delivery,
+                       'payload': payload}, fname, indent=1)
+
+    def start(self):
+        self.server = _Server((self.host, self.port), WebhookHandler)
+        self.server.receiver = self
+        # Port 0 picks a free port
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='webhook', daemon=True)
+        thread.start()
+        self.logger.info(f'Listening for webhooks on {self.host}:{self.port}')
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
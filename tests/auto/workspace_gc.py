@@ -0,0 +1,330 @@
+"""
+Name: workspace_gc.py
+Keeps the disk usage of the workdir under a byte budget. One parallel
+os.scandir pass indexes the workdir: PR working trees, test run
+directories, old per-job clones, job log directories and script logs,
+by PR, commit and time of last change, plus everything else (mirrors,
+caches) that only counts towards the total. Directories of running jobs
+and of experiments still tracked in the state store are kept; the rest
+is removed least recently used first until the total is under budget.
+Script logs older than gc_log_days, or tiny and older than
+gc_min_age_hours, are always removed, as log_clean.sh did.
+
+Run once with
+    python workspace_gc.py [--dry-run]
+or every gc_interval seconds from ci_auto.py --daemon.
+"""
+
+# Imports
+import argparse
+import collections
+import datetime
+import fcntl
+import logging
+import os
+import queue
+import re
+import shutil
+import stat
+import threading
+import time
+from configparser import ConfigParser as config_parser
+
+from jobs.checkout import read_sha
+from statestore import StateStore
+
+# Script logs smaller than this only say the script started
+TINY_LOG_BYTES = 400
+
+Unit = collections.namedtuple(
+    'Unit', ['path', 'kind', 'pr_id', 'sha', 'bytes', 'last_used'])
+
+
+def entries_of(path):
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except OSError:
+        return []
+
+
+def dir_usage(path, subdirs):
+    ''' Bytes and newest mtime of the entries of one directory; its
+        subdirectories are added to subdirs to be walked in turn '''
+    size = 0
+    newest = 0.0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    entry_stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                blocks = entry_stat.st_blocks * 512
+                if stat.S_ISDIR(entry_stat.st_mode):
+                    subdirs.append(entry.path)
+                else:
+                    blocks //= max(entry_stat.st_nlink, 1)
+                size += blocks
+                newest = max(newest, entry_stat.st_mtime)
+    except OSError:
+        pass
+    return size, newest
+
+
+def scan_worker(dirs, add):
+    ''' Walk the (root, directory) items of the dirs queue until a None,
+        counting their usage towards their root with add '''
+    while True:
+        item = dirs.get()
+        if item is None:
+            return
+        root, path = item
+        subdirs = []
+        add(root, *dir_usage(path, subdirs))
+        for subdir in subdirs:
+            dirs.put((root, subdir))
+        dirs.task_done()
+
+
+def scan(roots, workers=8):
+    ''' Disk usage of each root, {root: [bytes, newest mtime]}, from one
+        walk of all their directories on a pool of threads. A hard
+        linked file counts for each of its links in equal parts. '''
+    usage = {root: [0, 0.0] for root in roots}
+    lock = threading.Lock()
+    dirs = queue.Queue()
+
+    def add(root, size, mtime):
+        with lock:
+            usage[root][0] += size
+            usage[root][1] = max(usage[root][1], mtime)
+
+    for root in roots:
+        try:
+            root_stat = os.stat(root, follow_symlinks=False)
+        except OSError:
+            continue
+        add(root, root_stat.st_blocks * 512, root_stat.st_mtime)
+        if stat.S_ISDIR(root_stat.st_mode):
+            dirs.put((root, root))
+    threads = [threading.Thread(target=scan_worker, args=(dirs, add),
+                                daemon=True,
+                                name=f'workspace_gc/scan_{index}')
+               for index in range(workers)]
+    for thread in threads:
+        thread.start()
+    dirs.join()
+    for thread in threads:
+        dirs.put(None)
+    return usage
+
+
+class WorkspaceGC:
+    '''
+    This class indexes the workdir and removes what is over budget
+    ...
+
+    Attributes
+    ----------
+    workdir : str
+        Work directory of the CI
+    budget : int
+        Bytes the workdir may use
+    min_age : float
+        Seconds since its last change before a directory may be removed
+    log_age : float
+        Seconds after which script logs are removed
+    workers : int
+        Threads of the directory scan
+    '''
+
+    def __init__(self, workdir, budget, min_age=24 * 3600,
+                 log_age=7 * 24 * 3600, workers=8):
+        self.logger = logging.getLogger('WORKSPACE_GC')
+        self.workdir = os.path.abspath(workdir)
+        self.budget = budget
+        self.min_age = min_age
+        self.log_age = log_age
+        self.workers = workers
+
+    @classmethod
+    def from_config(cls, file_name='CImachine.cfg'):
+        ''' Build the collector from the workdir and the optional gc_*
+            entries of the machine config file '''
+        config = config_parser()
+        config.read(file_name)
+        return cls(config['DEFAULT']['workdir'],
+                   int(config['DEFAULT'].getfloat('gc_budget_gb',
+                                                  fallback=500) * 1024 ** 3),
+                   config['DEFAULT'].getfloat('gc_min_age_hours',
+                                              fallback=24) * 3600,
+                   config['DEFAULT'].getfloat('gc_log_days',
+                                              fallback=7) * 24 * 3600,
+                   config['DEFAULT'].getint('gc_workers', fallback=8))
+
+    def units(self):
+        ''' (path, kind, PR id, commit) of everything that may be
+            removed; kind is tree, run, clone, log_dir or log '''
+        found = []
+        for entry in entries_of(self.workdir):
+            if entry.is_file(follow_symlinks=False) and \
+                    entry.name.endswith('.log'):
+                found.append((entry.path, 'log', None, None))
+            elif not entry.is_dir(follow_symlinks=False):
+                continue
+            elif entry.name == 'logs':
+                found += self.log_dir_units(entry.path)
+            elif entry.name.isdigit():
+                found += self.pr_units(entry.path, entry.name)
+        return found
+
+    @staticmethod
+    def log_dir_units(logs_dir):
+        ''' Job log directories, named <time>_<pr id>_<label> '''
+        found = []
+        for log_dir in entries_of(logs_dir):
+            match = re.match(r'\d+_(\d+)_', log_dir.name)
+            found.append((log_dir.path, 'log_dir',
+                          match.group(1) if match else None, None))
+        return found
+
+    @staticmethod
+    def pr_units(pr_loc, pr_id):
+        ''' Trees, test run directories and old clones of a PR directory,
+            named by the PR id '''
+        found = []
+        for pr_entry in entries_of(pr_loc):
+            if not pr_entry.is_dir(follow_symlinks=False):
+                continue
+            if pr_entry.name == 'runs':
+                for run_dir in entries_of(pr_entry.path):
+                    found.append((run_dir.path, 'run', pr_id,
+                                  read_sha(run_dir.path)))
+            elif re.match(r'\d{14}$', pr_entry.name):
+                # Clone of a job from before the trees were kept
+                found.append((pr_entry.path, 'clone', pr_id, None))
+            else:
+                found.append((pr_entry.path, 'tree', pr_id,
+                              read_sha(pr_entry.path)))
+        return found
+
+    def index(self):
+        ''' Return the Units that may be removed and the bytes used by
+            the whole workdir '''
+        found = self.units()
+        unit_paths = set(path for path, *_ in found)
+        # The rest of the workdir is scanned in the same pass, for the
+        # total; the PR directories are covered by their units
+        other = [entry.path for entry in entries_of(self.workdir)
+                 if entry.path not in unit_paths and
+                 entry.name not in ['logs'] and not entry.name.isdigit()]
+        usage = scan([path for path, *_ in found] + other, self.workers)
+        units = [Unit(path, kind, pr_id, sha, *usage[path])
+                 for path, kind, pr_id, sha in found]
+        total = sum(size for size, _ in usage.values())
+        return units, total
+
+    def in_use(self, unit, tracked):
+        ''' Whether a unit belongs to a running job or tracked
+            experiment, or changed too recently to tell '''
+        if time.time() - unit.last_used < self.min_age:
+            return True
+        if any(log_path.startswith(unit.path + os.sep)
+               for log_path in tracked):
+            return True
+        if unit.kind == 'tree':
+            # Jobs hold the lock of their tree
+            with open(f'{unit.path}.lock', 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return True
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return False
+
+    def expired(self, unit):
+        ''' Script logs that are removed whatever the budget '''
+        if unit.kind != 'log':
+            return False
+        age = time.time() - unit.last_used
+        try:
+            # Apparent size, a tiny file still takes a whole block
+            tiny = os.path.getsize(unit.path) < TINY_LOG_BYTES
+        except OSError:
+            return False
+        return tiny and age > self.min_age or age > self.log_age
+
+    def plan(self, units, total, tracked):
+        ''' Units to remove: expired logs, then the least recently used
+            until the total is under budget '''
+        remove = [unit for unit in units if self.expired(unit)]
+        total -= sum(unit.bytes for unit in remove)
+        for unit in sorted(units, key=lambda unit: unit.last_used):
+            if total <= self.budget:
+                break
+            if unit in remove or self.in_use(unit, tracked):
+                continue
+            remove.append(unit)
+            total -= unit.bytes
+        return remove, total
+
+    def collect(self, store, dry_run=False):
+        ''' Index the workdir and remove what is over budget. Returns the
+            removed Units. '''
+        start = time.time()
+        units, total = self.index()
+        self.logger.info(f'Indexed {len(units)} directories and logs, '
+                         f'{total / 1024 ** 3:.1f} GiB in use, budget '
+                         f'{self.budget / 1024 ** 3:.1f} GiB, '
+                         f'scan took {time.time() - start:.1f} s')
+        by_pr = collections.Counter()
+        for unit in units:
+            if unit.pr_id:
+                by_pr[unit.pr_id] += unit.bytes
+        for pr_id, size in by_pr.most_common(5):
+            self.logger.info(f'PR {pr_id}: {size / 1024 ** 3:.1f} GiB')
+
+        tracked = [row['log_path'] for row in store.experiments('running')]
+        remove, left = self.plan(units, total, tracked)
+        for unit in remove:
+            age = datetime.timedelta(
+                seconds=int(time.time() - unit.last_used))
+            self.logger.info(f'{"Would remove" if dry_run else "Removing"} '
+                             f'{unit.kind} {unit.path} (PR {unit.pr_id}, '
+                             f'{unit.sha or "no commit"}, '
+                             f'{unit.bytes / 1024 ** 2:.0f} MiB, '
+                             f'unchanged for {age})')
+            if dry_run:
+                continue
+            if unit.kind == 'log':
+                os.remove(unit.path)
+            else:
+                shutil.rmtree(unit.path, ignore_errors=True)
+        if left > self.budget:
+            self.logger.critical(f'{left / 1024 ** 3:.1f} GiB still in use, '
+                                 'over budget, the rest is in use')
+        return remove
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Remove what is over the disk budget of the workdir')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only log what would be removed')
+    args = parser.parse_args()
+
+    # handle logging
+    log_filename = f'workspace_gc_'\
+                   f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.log'
+    logging.basicConfig(filename=log_filename, filemode='w',
+                        level=logging.INFO)
+    logger = logging.getLogger('MAIN')
+    logger.info('Starting Script')
+
+    WorkspaceGC.from_config().collect(StateStore.from_config(),
+                                      args.dry_run)
+
+
+if __name__ == '__main__':
+    main()